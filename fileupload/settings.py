@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'rest_framework',
     'upload',
 ]
 
@@ -50,6 +51,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Removes itself unless PROFILER_ENABLED, see below
+    'upload.profiling.ProfilerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -82,6 +85,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Upload workers write from separate processes, wait for locks instead of failing
+        'OPTIONS': {
+            'timeout': 20,
+        },
     }
 }
 
@@ -132,6 +139,208 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# ML model
+# Load the model in the background when a web worker starts instead of on the
+# first upload. Ignored with UPLOAD_ASYNC_PROCESSING, where web workers never run
+# the model; run_upload_workers always warms up its processes. Other management
+# commands never load it.
+ML_WARMUP_ON_START = os.environ.get('ML_WARMUP_ON_START', '0') == '1'
+
+# Model artifact (see upload/artifacts.py). Downloads are verified against
+# ML_MODEL_SHA256 when it is set, otherwise against the checksum the hub reports,
+# and kept under ML_ARTIFACT_CACHE_DIR/<sha256>/. ML_MODEL_MIRROR_DIR is checked
+# before the network, for offline builds. The token defaults to HF_TOKEN.
+ML_MODEL_URL = os.environ.get('ML_MODEL_URL', 'https://huggingface.co/dostah01/shark/resolve/main/corn_model_1.keras')
+ML_MODEL_SHA256 = os.environ.get('ML_MODEL_SHA256', '')
+ML_MODEL_TOKEN = os.environ.get('ML_MODEL_TOKEN') or os.environ.get('HF_TOKEN', '')
+ML_ARTIFACT_CACHE_DIR = os.environ.get('ML_ARTIFACT_CACHE_DIR', os.path.join(BASE_DIR, '.cache', 'models'))
+ML_MODEL_MIRROR_DIR = os.environ.get('ML_MODEL_MIRROR_DIR', '')
+# Parallel ranged requests per download, and how many model versions to keep
+ML_DOWNLOAD_CONNECTIONS = int(os.environ.get('ML_DOWNLOAD_CONNECTIONS', '4'))
+ML_ARTIFACT_KEEP_VERSIONS = int(os.environ.get('ML_ARTIFACT_KEEP_VERSIONS', '3'))
+
+# Version name of the model, part of the prediction cache key. Change it when the
+# model file is replaced so duplicate uploads are classified again. Empty means
+# the model's file name.
+ML_MODEL_VERSION = os.environ.get('ML_MODEL_VERSION', '')
+
+# Inference backend: 'keras' (corn_model_1.keras through TensorFlow) or 'tflite'
+# (an export from `manage.py export_model`, lighter on CPU and memory). Empty
+# ML_TFLITE_MODEL_PATH means upload/Notebook/corn_model_1.tflite.
+ML_BACKEND = os.environ.get('ML_BACKEND', 'keras')
+ML_TFLITE_MODEL_PATH = os.environ.get('ML_TFLITE_MODEL_PATH', '')
+
+# Readiness marker written by `python -m upload.check_model`; empty means next to
+# the model file (<model>.ready.json)
+ML_READY_MARKER = os.environ.get('ML_READY_MARKER', '')
+
+# Model versions registered with `manage.py models`: which one is active and which
+# one, if any, scores a sample of traffic in shadow mode. Every process checks the
+# file every ML_MODEL_REGISTRY_POLL seconds and switches without a restart. Without
+# the file, the model above (ML_BACKEND, ML_MODEL_VERSION) is the only version.
+ML_MODEL_REGISTRY = os.environ.get('ML_MODEL_REGISTRY', os.path.join(ML_ARTIFACT_CACHE_DIR, 'registry.json'))
+ML_MODEL_REGISTRY_POLL = float(os.environ.get('ML_MODEL_REGISTRY_POLL', '5'))
+# Sampled batches waiting for the shadow model before new ones are dropped
+ML_SHADOW_QUEUE_SIZE = int(os.environ.get('ML_SHADOW_QUEUE_SIZE', '8'))
+
+# Concurrent predict_image() calls are grouped into one forward pass. A batch is
+# dispatched when it reaches ML_BATCH_MAX_SIZE images or its first image has
+# waited ML_BATCH_MAX_WAIT_MS milliseconds.
+ML_BATCHING_ENABLED = os.environ.get('ML_BATCHING_ENABLED', '1') == '1'
+ML_BATCH_MAX_SIZE = int(os.environ.get('ML_BATCH_MAX_SIZE', '16'))
+ML_BATCH_MAX_WAIT_MS = float(os.environ.get('ML_BATCH_MAX_WAIT_MS', '5'))
+
+# Image preprocessing for the model: 'pillow' (Pillow + NumPy, same resize as
+# TensorFlow) or 'tensorflow' (the original tf.io pipeline). ML_PREPROCESS_DRAFT=1
+# decodes large JPEGs at reduced scale, about 4x faster on 12 MP photos, but the
+# input is no longer the one the model was validated on; measure the accuracy
+# before turning it on.
+ML_PREPROCESS_BACKEND = os.environ.get('ML_PREPROCESS_BACKEND', 'pillow')
+ML_PREPROCESS_DRAFT = os.environ.get('ML_PREPROCESS_DRAFT', '0') == '1'
+
+# Upload processing
+# With UPLOAD_ASYNC_PROCESSING=1, uploads are queued in the ProcessingJob table and
+# processed by `manage.py run_upload_workers` (run.sh and render_start.sh start the
+# workers and turn it on). Otherwise they are processed on the request thread, so
+# a plain `manage.py runserver` works without a worker.
+UPLOAD_ASYNC_PROCESSING = os.environ.get('UPLOAD_ASYNC_PROCESSING', '0') == '1'
+UPLOAD_JOB_POLL_INTERVAL = float(os.environ.get('UPLOAD_JOB_POLL_INTERVAL', '0.5'))
+# Seconds before a running job is considered abandoned by a dead worker
+UPLOAD_JOB_TIMEOUT = int(os.environ.get('UPLOAD_JOB_TIMEOUT', '300'))
+UPLOAD_JOB_MAX_ATTEMPTS = int(os.environ.get('UPLOAD_JOB_MAX_ATTEMPTS', '3'))
+
+# Async views for the home page and /api/forecast/, which fetch the location name
+# and the forecast at the same time. fileupload/asgi.py turns them on, so they are
+# used when the app is served under ASGI (e.g. `uvicorn fileupload.asgi:application`).
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', '0') == '1'
+
+# Upload limits, enforced by upload.upload_handlers while the file streams in
+UPLOAD_MAX_IMAGE_SIZE = int(os.environ.get('UPLOAD_MAX_IMAGE_SIZE', str(20 * 1024 * 1024)))
+# Width x height; phone cameras produce up to ~50 MP
+UPLOAD_MAX_IMAGE_PIXELS = int(os.environ.get('UPLOAD_MAX_IMAGE_PIXELS', str(64 * 1000 * 1000)))
+# Bulk uploads (/api/uploads/bulk/): total request size, also the most that is
+# extracted from ZIP archives, and the number of images per request
+UPLOAD_MAX_BULK_SIZE = int(os.environ.get('UPLOAD_MAX_BULK_SIZE', str(1024 * 1024 * 1024)))
+UPLOAD_MAX_BULK_FILES = int(os.environ.get('UPLOAD_MAX_BULK_FILES', '500'))
+
+# Caches
+# Both caches are file based so every gunicorn and upload worker process shares
+# them (an upload worker invalidates entries the web workers read). The "http"
+# cache holds weather and geocoding API responses.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('DEFAULT_CACHE_DIR', os.path.join(BASE_DIR, '.cache', 'default')),
+    },
+    'http': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('HTTP_CACHE_DIR', os.path.join(BASE_DIR, '.cache', 'http')),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    },
+}
+
+# External weather/geocoding APIs. Point these at a local stub server in tests.
+OPEN_METEO_FORECAST_URL = os.environ.get('OPEN_METEO_FORECAST_URL', 'https://api.open-meteo.com/v1/forecast')
+OPEN_METEO_GEOCODING_URL = os.environ.get('OPEN_METEO_GEOCODING_URL', 'https://geocoding-api.open-meteo.com/v1/search')
+NOMINATIM_REVERSE_URL = os.environ.get('NOMINATIM_REVERSE_URL', 'https://nominatim.openstreetmap.org/reverse')
+
+# Shared HTTP client (upload/http_client.py)
+HTTP_CACHE_ALIAS = 'http'
+HTTP_CLIENT_USER_AGENT = 'TeamShark/1.0 (+https://teamshark.onrender.com)'
+HTTP_CLIENT_POOL_SIZE = 10
+HTTP_CLIENT_RETRIES = 3
+HTTP_CLIENT_BACKOFF = 0.5
+# Connect/read timeout of each request, and the deadline for the geocoding and
+# forecast requests an async view makes together (retries included)
+HTTP_CLIENT_TIMEOUT = 10
+HTTP_CLIENT_TOTAL_TIMEOUT = 20
+HTTP_CLIENT_DEFAULT_CONCURRENCY = 8
+# Nominatim's usage policy allows one request at a time
+HTTP_CLIENT_HOST_CONCURRENCY = {
+    'nominatim.openstreetmap.org': 1,
+}
+# Coordinates are rounded to this many decimals (3 is about 110 m) before
+# requests are sent, so nearby uploads share cached responses
+HTTP_CACHE_COORD_PRECISION = 3
+# Seconds to cache responses; None keeps them until evicted
+FORECAST_CACHE_TTL = 60 * 60
+# Uploads in the same geohash cell (precision 6 is about 1.2 km, finer than the
+# forecast model's grid) share one stored Forecast per day
+FORECAST_GEOHASH_PRECISION = 6
+# max-age sent with /api/forecast/ responses
+FORECAST_HTTP_MAX_AGE = 10 * 60
+GEOCODE_CACHE_TTL = None
+
+# Reverse geocoding cache (upload/geocode_cache.py). Points in the same geohash
+# cell share a place name; precision 7 cells are about 150 m across.
+GEOCODE_GEOHASH_PRECISION = int(os.environ.get('GEOCODE_GEOHASH_PRECISION', '7'))
+GEOCODE_MEMORY_CACHE_SIZE = 10000
+
+# Server-sent events to the home page (upload/events.py, /api/events/)
+# Under ASGI, seconds between checks for new events (one query per process for
+# every open stream)
+EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', '1'))
+EVENTS_KEEPALIVE = 15
+# Under WSGI a stream sends what is new and closes, so it never ties up a worker;
+# browsers reconnect after EVENTS_WSGI_RECONNECT seconds and poll their upload's
+# job status in between
+EVENTS_WSGI_RECONNECT = int(os.environ.get('EVENTS_WSGI_RECONNECT', '120'))
+# Upload workers refetch stale forecasts every EVENTS_FORECAST_REFRESH_INTERVAL
+# seconds, once per cell, for farmers whose stream was open within
+# EVENTS_SUBSCRIBER_TTL seconds, and push the changes to them
+EVENTS_FORECAST_REFRESH_INTERVAL = int(os.environ.get('EVENTS_FORECAST_REFRESH_INTERVAL', str(FORECAST_CACHE_TTL)))
+EVENTS_SUBSCRIBER_TTL = 10 * 60
+# Seconds events are kept for streams that reconnect
+EVENTS_RETENTION = 60 * 60
+
+# Metrics (upload/metrics.py, /metrics/ in Prometheus text format). Every process
+# writes its totals to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds; files of
+# processes gone for METRICS_RETENTION seconds are dropped. Staff users can read
+# the endpoint, and so can a scraper sending "Authorization: Bearer <METRICS_TOKEN>".
+# The same goes for the details of /api/model/status/; others only see whether the
+# model is ready.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(BASE_DIR, '.cache', 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_RETENTION = 24 * 60 * 60
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Request profiler (upload/profiling.py). When enabled, a request with ?_profile=1
+# from a staff user, or with a link from `manage.py profile_link`, runs under a
+# sampling profiler and is stored as a ProfileRecord in the admin. Disabled, the
+# middleware is removed at startup and costs nothing.
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', '0') == '1'
+# Milliseconds between stack samples
+PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', '5'))
+# Seconds a signed profile link stays valid
+PROFILER_LINK_MAX_AGE = 24 * 60 * 60
+PROFILER_MAX_QUERIES = 1000
+# Older profiles are deleted when a new one is stored
+PROFILER_KEEP = 200
+
+# Disease map (/api/map/diseases/, upload/disease_map.py). Uploads store the geohash
+# of their coordinates at UPLOAD_GEOHASH_PRECISION (9 is about 5 m); the map counts
+# predictions per cell, at the finest precision that keeps a bounding box within
+# DISEASE_MAP_MAX_CELLS cells, over the last DISEASE_MAP_DEFAULT_DAYS days by default.
+# Maps are cached (and max-age is sent) for DISEASE_MAP_CACHE_TTL seconds.
+UPLOAD_GEOHASH_PRECISION = 9
+DISEASE_MAP_MAX_CELLS = int(os.environ.get('DISEASE_MAP_MAX_CELLS', '1024'))
+DISEASE_MAP_DEFAULT_DAYS = 30
+DISEASE_MAP_CACHE_TTL = 60
+
+# Seconds the login page's community feed is cached for. Entries are also dropped
+# whenever an upload gets a prediction, this only bounds how stale "x minutes ago" gets.
+PUBLIC_FEED_CACHE_TTL = 60
+
+# Uploads shown per page on the home page (more load as the user scrolls)
+FILE_HISTORY_PAGE_SIZE = 20
+
+# WebP/JPEG quality of thumbnails and previews (upload/derivatives.py)
+IMAGE_DERIVATIVE_QUALITY = 80
+
 # Login/Logout URLs
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'home'
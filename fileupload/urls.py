@@ -24,10 +24,18 @@ from upload import views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('', views.home, name='home'),
+    path('', views.home_async if settings.ASYNC_VIEWS else views.home, name='home'),
     path('login/', views.login_view, name='login'),
     path('register/', views.register, name='register'),
     path('profile/', views.profile, name='profile'),
     path('delete/<int:file_id>/', views.delete_file, name='delete_file'),
     path('logout/', views.logout_view, name='logout'),
+    path('api/files/', views.file_history, name='file_history'),
+    path('api/uploads/bulk/', views.bulk_upload, name='bulk_upload'),
+    path('api/forecast/', views.forecast_async if settings.ASYNC_VIEWS else views.forecast, name='forecast'),
+    path('api/jobs/<int:job_id>/', views.job_status, name='job_status'),
+    path('api/events/', views.events_async if settings.ASYNC_VIEWS else views.events, name='events'),
+    path('api/map/diseases/', views.disease_map_view, name='disease_map'),
+    path('api/model/status/', views.model_status_view, name='model_status'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
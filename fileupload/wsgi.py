@@ -8,9 +8,19 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/wsgi/
 """
 
 import os
+import threading
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fileupload.settings')
 
 application = get_wsgi_application()
+
+# Load the ML model in the background so the worker can serve login/profile pages
+# right away; the first upload waits on the registry lock if loading isn't done yet.
+# When uploads are queued, only the upload workers run the model (and warm it up
+# themselves), so web workers don't import TensorFlow at all.
+if settings.ML_WARMUP_ON_START and not settings.UPLOAD_ASYNC_PROCESSING:
+    from upload.ml_processor import warm_up
+    threading.Thread(target=warm_up, name="model-warmup", daemon=True).start()
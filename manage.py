@@ -5,41 +5,11 @@
 import os
 import sys
 
-def download_corn_model():
-    """Tries to download the model but continues if it fails."""
-    try:
-        # First check if the required modules are installed
-        try:
-            import huggingface_hub
-            import tensorflow
-        except ImportError as e:
-            print(f"WARNING: ML dependencies missing ({str(e)}). Continuing without ML features.")
-            return
-            
-        from upload.Notebook.download_model import download_model
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        MODEL_PATH = os.path.join(BASE_DIR, "upload", "Notebook", "corn_model_1.keras")
-        if not os.path.exists(MODEL_PATH):
-            print("Attempting to download corn disease model...")
-            result = download_model()
-            if result:
-                print(f"Model setup complete: {result}")
-            else:
-                print("WARNING: Model download failed, but will continue with startup")
-    except Exception as e:
-        print(f"Error during model setup: {str(e)}")
-        print("WARNING: Will continue with startup without the model")
-
 def main():
     """Run administrative tasks."""
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fileupload.settings')
-    
-    # Try to download the model but don't stop if it fails
-    try:
-        download_corn_model()
-    except Exception as e:
-        print(f"Model setup failed but continuing: {str(e)}")
-    
+    # The model is installed by run.sh/render_start.sh (python -m upload.Notebook.download_model),
+    # not here, so management commands start without touching it
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
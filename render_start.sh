@@ -27,20 +27,27 @@ echo "=========================="
 echo "Applying migrations..."
 python3 manage.py migrate
 
-# Check if model already exists before trying to download
-MODEL_PATH="upload/Notebook/corn_model_1.keras"
-if [ -f "$MODEL_PATH" ]; then
-    echo "Model file already exists, skipping download"
-else
-    # Explicitly download the model with a timeout
-    echo "Downloading ML model..."
-    timeout 300 python -c "from upload.Notebook.download_model import download_model; download_model()" || echo "Warning: Model download timed out, continuing anyway"
-fi
+# Install the model from the artifact cache on the persistent disk, downloading it
+# only when the cached copy is missing or out of date. An interrupted download is
+# resumed on the next deploy.
+echo "Getting ML model..."
+timeout 600 python3 -m upload.Notebook.download_model || echo "Warning: Model download failed, continuing anyway"
+
+# Load the model once in a separate process to make sure it works and warm it up;
+# the readiness marker it writes is read by the web and upload workers
+echo "Checking ML model..."
+python3 -m upload.check_model || echo "Warning: Model check failed, uploads will report the model as unavailable"
 
 # Collect static files
 echo "Collecting static files..."
 python3 manage.py collectstatic --noinput
 
+# Start the upload workers (inference, geocoding, forecast) next to the web server,
+# and have the web server queue uploads for them
+echo "Starting upload workers..."
+export UPLOAD_ASYNC_PROCESSING=1
+python3 manage.py run_upload_workers --processes ${UPLOAD_WORKER_PROCESSES:-1} &
+
 # Start Gunicorn process for production
 echo "Starting Gunicorn server..."
 gunicorn fileupload.wsgi:application --bind 0.0.0.0:$PORT --log-level info --timeout 120 
\ No newline at end of file
@@ -7,4 +7,10 @@ else
     source .venv/bin/activate
 fi
 python manage.py migrate
+# Install the model if it's missing, the app still starts without it
+python -m upload.Notebook.download_model || echo "Warning: Model download failed, continuing anyway"
+# Uploads are queued for the workers started here
+export UPLOAD_ASYNC_PROCESSING=1
+python manage.py run_upload_workers &
+trap "kill $!" EXIT
 python manage.py runserver
\ No newline at end of file
@@ -1,6 +1,7 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
-from .models import Farmer, UploadedFile
+from .models import Farmer, UploadedFile, ProcessingJob, GeocodeCache, Forecast, PredictionCache, UploadBatch, ShadowPrediction, ProfileRecord
+from .profiling import flame_graph_html, query_table_html
 
 admin.site.register(Farmer, UserAdmin)
 
@@ -9,3 +10,74 @@ class UploadedFileAdmin(admin.ModelAdmin):
     list_display = ('title', 'uploaded_at')
     search_fields = ('title',)
     list_filter = ('uploaded_at',)
+
+@admin.register(ProcessingJob)
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'uploaded_file', 'status', 'attempts', 'worker', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('result', 'error', 'started_at', 'finished_at', 'worker')
+
+@admin.register(GeocodeCache)
+class GeocodeCacheAdmin(admin.ModelAdmin):
+    list_display = ('geohash', 'location_name', 'created_at')
+    search_fields = ('geohash', 'location_name')
+
+@admin.register(Forecast)
+class ForecastAdmin(admin.ModelAdmin):
+    list_display = ('geohash', 'days', 'units', 'issued_on', 'fetched_at')
+    list_filter = ('issued_on',)
+    search_fields = ('geohash',)
+
+@admin.register(PredictionCache)
+class PredictionCacheAdmin(admin.ModelAdmin):
+    list_display = ('content_hash', 'model_version', 'prediction', 'confidence', 'created_at')
+    list_filter = ('model_version', 'prediction')
+    search_fields = ('content_hash',)
+
+@admin.register(UploadBatch)
+class UploadBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'farmer', 'created_at')
+    readonly_fields = ('rejected',)
+
+@admin.register(ShadowPrediction)
+class ShadowPredictionAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'candidate_version', 'candidate_prediction', 'active_version', 'active_prediction', 'agrees')
+    list_filter = ('candidate_version', 'agrees')
+    actions = ['activate_candidate']
+
+    @admin.action(description="Switch to the candidate model of the selected predictions")
+    def activate_candidate(self, request, queryset):
+        from .ml_processor import activate_version
+
+        versions = set(queryset.values_list('candidate_version', flat=True))
+        if len(versions) != 1:
+            self.message_user(request, "Select predictions of a single candidate model", messages.ERROR)
+            return
+        version = versions.pop()
+        try:
+            activate_version(version)
+        except ValueError as e:
+            self.message_user(request, str(e), messages.ERROR)
+            return
+        self.message_user(request, f"Model {version} is now active, processes switch to it once it has loaded")
+
+@admin.register(ProfileRecord)
+class ProfileRecordAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'method', 'path', 'status_code', 'duration_ms', 'query_count', 'query_ms', 'user')
+    list_filter = ('method', 'status_code')
+    search_fields = ('path',)
+    fields = ('created_at', 'user', 'method', 'path', 'status_code', 'duration_ms', 'sample_count', 'interval_ms',
+              'query_count', 'query_ms', 'flame_graph', 'query_list', 'collapsed_stacks')
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        # Recorded by the profiler middleware
+        return False
+
+    @admin.display(description="Flame graph")
+    def flame_graph(self, obj):
+        return flame_graph_html(obj.collapsed_stacks)
+
+    @admin.display(description="SQL queries")
+    def query_list(self, obj):
+        return query_table_html(obj.queries)
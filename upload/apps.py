@@ -4,3 +4,18 @@ from django.apps import AppConfig
 class UploadConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'upload'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.backends.signals import connection_created
+
+        from . import signals  # noqa: F401
+        from .metrics import time_db_writes
+        from .profiling import record_queries
+
+        def add_execute_wrappers(sender, connection, **kwargs):
+            connection.execute_wrappers.append(time_db_writes)
+            if settings.PROFILER_ENABLED:
+                connection.execute_wrappers.append(record_queries)
+
+        connection_created.connect(add_execute_wrappers, weak=False, dispatch_uid='upload_execute_wrappers')
@@ -0,0 +1,406 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from django.conf import settings
+
+from .backends import format_error
+from .http_client import get_session
+
+'''
+    Model artifacts: getting the model file onto the machine, and making sure it
+    is the right one.
+
+    ensure_model() installs the model at MODEL_PATH from, in order:
+
+    1. the artifact cache, when the expected SHA-256 is already there,
+    2. ML_MODEL_MIRROR_DIR, a local directory for offline builds,
+    3. a download from ML_MODEL_URL.
+
+    Every file is checked against the expected SHA-256 (ML_MODEL_SHA256, or the
+    checksum the hub reports for the file) before it is renamed into the cache as
+    <cache>/<sha256>/<file name>. MODEL_PATH is a symlink to the cached copy that
+    is swapped in one step, so the app never sees a partial, corrupt or
+    placeholder model, and switching back to an earlier version needs no download.
+
+    Downloads use several ranged requests in parallel and save their progress, so
+    a download interrupted by e.g. a deploy timeout continues where it stopped.
+'''
+
+CHUNK_SIZE = 1024 * 1024
+# Smaller files are fetched with one request
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+REQUEST_TIMEOUT = 30
+RANGE_ATTEMPTS = 3
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class ArtifactError(Exception):
+    """The model could not be obtained, or did not verify"""
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def backend_for(filename):
+    return 'tflite' if filename.endswith('.tflite') else 'keras'
+
+
+def cache_path(sha256, filename):
+    return os.path.join(settings.ML_ARTIFACT_CACHE_DIR, sha256, filename)
+
+
+def is_verified(path, sha256):
+    return os.path.isfile(path) and file_sha256(path) == sha256
+
+
+def add_to_cache(path, sha256, filename, move=False):
+    """Put a verified file into the cache in one step and return its cached path"""
+    destination = cache_path(sha256, filename)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if move:
+        os.replace(path, destination)
+    else:
+        temp_path = f"{destination}.{os.getpid()}.tmp"
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, destination)
+    return destination
+
+
+def read_refs():
+    """Checksum each model URL resolved to last time, for when the hub can't be reached"""
+    try:
+        with open(os.path.join(settings.ML_ARTIFACT_CACHE_DIR, 'refs.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_ref(url, sha256):
+    refs = dict(read_refs(), **{url: sha256})
+    path = os.path.join(settings.ML_ARTIFACT_CACHE_DIR, 'refs.json')
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(refs, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def auth_headers(location, url):
+    # The token is only sent to the model's host, never to the CDN it redirects to
+    if settings.ML_MODEL_TOKEN and urlsplit(location).netloc == urlsplit(url).netloc:
+        return {'Authorization': f"Bearer {settings.ML_MODEL_TOKEN}"}
+    return {}
+
+
+def etag_sha256(value):
+    value = (value or '').strip().removeprefix('W/').strip('"').lower()
+    return value if SHA256_PATTERN.match(value) else None
+
+
+def remote_metadata(url):
+    """
+    Where the file at url is served from, its size and its checksum. The hub
+    redirects to a CDN and reports the SHA-256 of model files in X-Linked-Etag.
+
+    Returns:
+        dict with 'location', 'size', 'sha256' (either may be None) and whether
+        the server accepts 'ranges'
+    """
+    session = get_session()
+    location, size, sha256 = url, None, None
+    for _ in range(5):
+        response = session.head(location, headers=auth_headers(location, url),
+                                allow_redirects=False, timeout=REQUEST_TIMEOUT)
+        sha256 = sha256 or etag_sha256(response.headers.get('X-Linked-Etag'))
+        size = size or response.headers.get('X-Linked-Size')
+        if not response.is_redirect:
+            break
+        location = urljoin(location, response.headers['Location'])
+    response.raise_for_status()
+
+    return {
+        'location': location,
+        'size': int(size or response.headers.get('Content-Length') or 0) or None,
+        'sha256': sha256 or etag_sha256(response.headers.get('ETag')),
+        'ranges': response.headers.get('Accept-Ranges') == 'bytes',
+    }
+
+
+class Download:
+    """
+    Downloads a file into <destination>.part, in byte ranges fetched in parallel.
+
+    Progress is saved in <destination>.part.json, so a later Download of the same
+    file (same key and size) only fetches the ranges that are missing. Without a
+    known size or range support the file is fetched in one request, from the start.
+    """
+
+    def __init__(self, location, destination, key, size=None, ranges=False, headers=None, connections=4):
+        self.location = location
+        self.part_path = f"{destination}.part"
+        self.state_path = f"{self.part_path}.json"
+        self.key = key
+        self.size = size
+        self.headers = headers or {}
+        self.ranged = bool(size and ranges)
+        if self.ranged:
+            connections = 1 if size < PARALLEL_MIN_SIZE else max(1, connections)
+            self.ranges = self._resume() or self._split(connections)
+        self._lock = threading.Lock()
+        self._saved_at = 0
+
+    def _resume(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('key') != self.key or state.get('size') != self.size or not os.path.exists(self.part_path):
+            return None
+        print(f"Resuming download, {self.downloaded(state['ranges']) / (1024 * 1024):.1f} MB already fetched")
+        return state['ranges']
+
+    def _split(self, connections):
+        # [first byte, last byte, bytes fetched so far]
+        step = -(-self.size // connections)
+        ranges = [[start, min(start + step, self.size) - 1, 0] for start in range(0, self.size, step)]
+        os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+        with open(self.part_path, 'wb') as f:
+            f.truncate(self.size)
+        return ranges
+
+    @staticmethod
+    def downloaded(ranges):
+        return sum(byte_range[2] for byte_range in ranges)
+
+    def _save(self, force=False):
+        with self._lock:
+            if not force and time.monotonic() - self._saved_at < 1:
+                return
+            self._saved_at = time.monotonic()
+            state = {'key': self.key, 'size': self.size, 'ranges': [list(r) for r in self.ranges]}
+        temp_path = f"{self.state_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_path)
+
+    def _fetch_range(self, fd, byte_range):
+        session = get_session()
+        error = None
+        for attempt in range(RANGE_ATTEMPTS):
+            start, end = byte_range[0], byte_range[1]
+            if start + byte_range[2] > end:
+                return
+            try:
+                headers = dict(self.headers, Range=f"bytes={start + byte_range[2]}-{end}")
+                with session.get(self.location, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+                    if response.status_code != 206:
+                        raise ArtifactError(f"Server ignored the range request ({response.status_code})")
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        offset = start + byte_range[2]
+                        chunk = chunk[:end + 1 - offset]
+                        os.pwrite(fd, chunk, offset)
+                        byte_range[2] += len(chunk)
+                        self._save()
+                if start + byte_range[2] > end:
+                    return
+                error = f"connection closed after {byte_range[2]} bytes"
+            except requests.RequestException as e:
+                error = str(e)
+            time.sleep(2 ** attempt)
+        raise ArtifactError(f"Could not download bytes {byte_range[0]}-{byte_range[1]}: {error}")
+
+    def _fetch_whole(self):
+        os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+        with get_session().get(self.location, headers=self.headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            with open(self.part_path, 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+
+    def run(self):
+        """Fetch whatever is missing and return the path of the complete .part file"""
+        if not self.ranged:
+            self._fetch_whole()
+            return self.part_path
+
+        fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=len(self.ranges)) as pool:
+                for future in [pool.submit(self._fetch_range, fd, r) for r in self.ranges]:
+                    future.result()
+        finally:
+            os.close(fd)
+            self._save(force=True)
+        return self.part_path
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def find_local(sha256, filename):
+    """
+    A verified copy of the model from the cache or the mirror directory, without
+    using the network. Without an expected checksum only the mirror can be used.
+
+    Returns:
+        (source, path), or (None, None)
+    """
+    if sha256:
+        cached = cache_path(sha256, filename)
+        if is_verified(cached, sha256):
+            return 'cache', cached
+        if os.path.exists(cached):
+            print(f"Cached model {cached} is corrupt, removing it")
+            shutil.rmtree(os.path.dirname(cached), ignore_errors=True)
+
+    mirror = settings.ML_MODEL_MIRROR_DIR
+    if mirror:
+        candidates = ([os.path.join(mirror, sha256, filename)] if sha256 else []) + [os.path.join(mirror, filename)]
+        for candidate in candidates:
+            if not os.path.isfile(candidate):
+                continue
+            actual = file_sha256(candidate)
+            if sha256 and actual != sha256:
+                print(f"Mirror copy {candidate} has SHA-256 {actual}, expected {sha256}; ignoring it")
+                continue
+            error = format_error(backend_for(filename), candidate)
+            if error:
+                print(f"Mirror copy {candidate}: {error}; ignoring it")
+                continue
+            return 'mirror', add_to_cache(candidate, actual, filename)
+    return None, None
+
+
+def fetch_remote(url, filename, sha256=None):
+    """
+    Download the model unless the version at url is already cached
+
+    Returns:
+        (source, path) of the verified file in the cache
+    """
+    metadata = remote_metadata(url)
+    if sha256 and metadata['sha256'] and metadata['sha256'] != sha256:
+        raise ArtifactError(f"{url} now has SHA-256 {metadata['sha256']}, but ML_MODEL_SHA256 is {sha256}")
+    sha256 = sha256 or metadata['sha256']
+    if not sha256:
+        print(f"{url} reports no checksum, the download can only be checked for its format")
+
+    if sha256 and is_verified(cache_path(sha256, filename), sha256):
+        write_ref(url, sha256)
+        return 'cache', cache_path(sha256, filename)
+
+    size = f"{metadata['size'] / (1024 * 1024):.1f} MB" if metadata['size'] else "unknown size"
+    print(f"Downloading {url} ({size})...")
+    name = sha256 or hashlib.sha256(url.encode()).hexdigest()[:16]
+    download = Download(
+        metadata['location'],
+        os.path.join(settings.ML_ARTIFACT_CACHE_DIR, 'downloads', f"{name}-{filename}"),
+        key=url,
+        size=metadata['size'],
+        ranges=metadata['ranges'],
+        headers=auth_headers(metadata['location'], url),
+        connections=settings.ML_DOWNLOAD_CONNECTIONS,
+    )
+    part_path = download.run()
+
+    actual = file_sha256(part_path)
+    if sha256 and actual != sha256:
+        download.discard()
+        raise ArtifactError(f"Downloaded file has SHA-256 {actual}, expected {sha256}")
+    error = format_error(backend_for(filename), part_path)
+    if error:
+        download.discard()
+        raise ArtifactError(f"Downloaded file is not a model: {error}")
+
+    path = add_to_cache(part_path, actual, filename, move=True)
+    download.discard()
+    write_ref(url, actual)
+    return 'download', path
+
+
+def install(path, target):
+    """Point target at a cached model, replacing whatever was there in one step"""
+    if os.path.islink(target) and os.path.realpath(target) == os.path.realpath(path):
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.symlink(os.path.abspath(path), temp_path)
+    except OSError:
+        # Filesystems without symlinks get a copy
+        shutil.copyfile(path, temp_path)
+    os.replace(temp_path, target)
+
+
+def prune(current, keep):
+    """Delete all but the `keep` most recently used model versions"""
+    root = settings.ML_ARTIFACT_CACHE_DIR
+    versions = [name for name in os.listdir(root) if SHA256_PATTERN.match(name) and name != current]
+    versions.sort(key=lambda name: os.path.getmtime(os.path.join(root, name)), reverse=True)
+    for name in versions[max(0, keep - 1):]:
+        print(f"Removing old model version {name}")
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def ensure_model(target=None):
+    """
+    Make sure a verified copy of the model is installed at target
+
+    Args:
+        target: Where the app loads the model from, MODEL_PATH by default
+
+    Returns:
+        dict with the installed 'path', its 'sha256', where it came from ('source')
+        and how long that took
+
+    Raises:
+        ArtifactError: if no verified copy could be obtained. target is left as it was.
+    """
+    from .ml_processor import MODEL_PATH
+
+    target = target or MODEL_PATH
+    url = settings.ML_MODEL_URL
+    filename = os.path.basename(target)
+    sha256 = settings.ML_MODEL_SHA256.lower() or None
+    start = time.perf_counter()
+    os.makedirs(settings.ML_ARTIFACT_CACHE_DIR, exist_ok=True)
+
+    source, path = find_local(sha256, filename)
+    if path is None:
+        try:
+            source, path = fetch_remote(url, filename, sha256)
+        except (requests.RequestException, OSError) as e:
+            # Offline: use the version this URL resolved to last time, if it's cached
+            previous = None if sha256 else read_refs().get(url)
+            if not previous or not is_verified(cache_path(previous, filename), previous):
+                raise ArtifactError(f"Could not download {url}: {str(e)}") from e
+            print(f"Could not reach {url} ({str(e)}), using the cached version {previous}")
+            source, path = 'cache', cache_path(previous, filename)
+
+    install(path, target)
+    version = os.path.basename(os.path.dirname(path))
+    # The directory's mtime records when the version was last used, for pruning
+    os.utime(os.path.dirname(path))
+    prune(version, settings.ML_ARTIFACT_KEEP_VERSIONS)
+    return {
+        'path': target,
+        'artifact': path,
+        'sha256': version,
+        'source': source,
+        'seconds': round(time.perf_counter() - start, 2),
+    }
@@ -0,0 +1,117 @@
+import threading
+import zipfile
+
+import numpy as np
+
+'''
+    Inference backends for the corn disease model.
+
+    A backend is anything with predict_on_batch(images) -> (N, classes) array, which
+    is what ModelRegistry hands to classify_batch:
+
+    - keras:  the original corn_model_1.keras through Keras/TensorFlow.
+    - tflite: a TensorFlow Lite export (see `manage.py export_model`), optionally
+              int8 quantized. Runs through ai-edge-litert or tflite-runtime when
+              one is installed, which avoids importing TensorFlow at all, and
+              falls back to the interpreter bundled with TensorFlow.
+
+    ML_BACKEND selects the backend; check a new export with
+    `python -m upload.benchmarks.backends` before switching.
+'''
+
+
+def load_keras(path):
+    from keras.models import load_model
+    return load_model(path)
+
+
+def load_interpreter(path, num_threads=None):
+    """A TFLite interpreter from the lightest runtime that is installed"""
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=path, num_threads=num_threads)
+
+
+class TFLiteModel:
+    """
+    Runs a .tflite export with the same predict_on_batch interface as a Keras model.
+    Quantized inputs and outputs are converted using the tensors' scale and zero point.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.path = path
+        self.interpreter = load_interpreter(path, num_threads=num_threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+        # An interpreter holds its tensors in place, so one batch at a time
+        self._lock = threading.Lock()
+
+    @property
+    def input_shape(self):
+        # Same form as a Keras model's, with the batch dimension left open
+        return (None,) + tuple(int(size) for size in self.input['shape'][1:])
+
+    def _resize(self, batch_size):
+        if batch_size != self.batch_size:
+            shape = [batch_size] + list(self.input['shape'][1:])
+            self.interpreter.resize_tensor_input(self.input['index'], shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    def predict_on_batch(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        with self._lock:
+            self._resize(len(images))
+            self.interpreter.set_tensor(self.input['index'], quantize(images, self.input))
+            self.interpreter.invoke()
+            return dequantize(self.interpreter.get_tensor(self.output['index']), self.output)
+
+
+def quantize(values, details):
+    scale, zero_point = details['quantization']
+    dtype = details['dtype']
+    if not scale or dtype == np.float32:
+        return values.astype(dtype)
+    info = np.iinfo(dtype)
+    return np.clip(np.round(values / scale + zero_point), info.min, info.max).astype(dtype)
+
+
+def dequantize(values, details):
+    scale, zero_point = details['quantization']
+    if not scale or values.dtype == np.float32:
+        return values.astype(np.float32)
+    return (values.astype(np.float32) - zero_point) * scale
+
+
+def format_error(backend, path):
+    """Why the file can't be a model for the backend, or None if it looks like one"""
+    if backend == 'keras' and not zipfile.is_zipfile(path):
+        return "Not a .keras archive (a placeholder from a failed download?)"
+    if backend == 'tflite':
+        with open(path, 'rb') as f:
+            # FlatBuffer file identifier of TFLite models
+            if f.read(8)[4:8] != b'TFL3':
+                return "Not a TFLite model (a placeholder from a failed download?)"
+    return None
+
+
+BACKENDS = {
+    'keras': load_keras,
+    'tflite': TFLiteModel,
+}
+
+
+def load_backend(name, path):
+    """Load the model at path with the named backend"""
+    try:
+        loader = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown ML backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    return loader(path)
@@ -0,0 +1,74 @@
+'''
+    Benchmarks for the hot paths of the upload app.
+
+    Each module is a script, run from the project root:
+
+        python -m upload.benchmarks.forecast_format
+        python -m upload.benchmarks.preprocess
+        python -m upload.benchmarks.backends --images <photos>
+        python -m upload.benchmarks.inference
+        python -m upload.benchmarks.load_test
+
+    They print their results as JSON (--output also writes them to a file), so runs
+    on different commits can be checked for regressions with:
+
+        python -m upload.benchmarks.compare baseline.json current.json
+'''
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from datetime import datetime
+
+import numpy as np
+
+
+def setup_django():
+    """Configure Django so benchmark scripts can import the app's modules"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fileupload.settings')
+    import django
+    django.setup()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def percentiles(timings_ms):
+    """Summary of a list of timings in milliseconds"""
+    timings = np.asarray(timings_ms, dtype=np.float64)
+    if not len(timings):
+        return None
+    summary = {f"p{p}_ms": round(float(np.percentile(timings, p)), 2) for p in (50, 90, 95, 99)}
+    summary.update(mean_ms=round(float(timings.mean()), 2), max_ms=round(float(timings.max()), 2))
+    return summary
+
+
+def run_info():
+    """Where and on what a benchmark ran, so results from different commits can be told apart"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def emit(results, output=None):
+    """Print results as JSON, and write them to output if given"""
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+        print(f"Results written to {output}", file=sys.stderr)
+    print(text)
@@ -0,0 +1,177 @@
+"""
+Accuracy parity, latency and memory of the inference backends.
+
+Runs the Keras model and one or more TFLite exports on the same photos, each in
+its own process so that load time and peak RSS aren't mixed up between runtimes,
+and reports:
+
+- top-1 agreement with the Keras model and the largest probability difference,
+- accuracy, when the photos are sorted into folders named after the classes
+  (blight/, common_rust/, gray_leaf_spot/, healthy/),
+- load time, p50/p95 latency per batch size and peak RSS for every backend.
+
+Exits with status 1 if a backend agrees with Keras on fewer than --min-agreement
+of the photos, so it can gate switching ML_BACKEND.
+
+    python -m upload.benchmarks.backends --images DIR [--tflite PATH ...] [--batch-sizes 1,8,16]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from upload.benchmarks import peak_rss_mb
+
+
+def run_worker(backend, path, images_file, batch_sizes, repeat):
+    """Measure one backend in this process and print the results as JSON"""
+    from upload.backends import load_backend
+    from upload.preprocessing import preprocess_image
+
+    with open(images_file) as f:
+        paths = json.load(f)
+
+    baseline_rss = peak_rss_mb()
+    start = time.perf_counter()
+    model = load_backend(backend, path)
+    load_seconds = time.perf_counter() - start
+    rss_after_load = peak_rss_mb()
+
+    inputs = np.stack([preprocess_image(p) for p in paths])
+    probabilities = np.concatenate([
+        np.asarray(model.predict_on_batch(inputs[i:i + 16]), dtype=np.float32)
+        for i in range(0, len(inputs), 16)
+    ])
+
+    latency = {}
+    for batch_size in batch_sizes:
+        # Repeat the photos if there are fewer than the batch size
+        batch = inputs[np.arange(batch_size) % len(inputs)]
+        for _ in range(2):
+            model.predict_on_batch(batch)
+        timings = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            model.predict_on_batch(batch)
+            timings.append((time.perf_counter() - t) * 1000)
+        latency[str(batch_size)] = {
+            "p50_ms": round(float(np.percentile(timings, 50)), 2),
+            "p95_ms": round(float(np.percentile(timings, 95)), 2),
+            "per_image_ms": round(float(np.percentile(timings, 50)) / batch_size, 2),
+        }
+
+    print(json.dumps({
+        "backend": backend,
+        "path": path,
+        "model_size_mb": round(os.path.getsize(path) / (1024 * 1024), 2),
+        "load_seconds": round(load_seconds, 3),
+        "rss_before_load_mb": baseline_rss,
+        "rss_after_load_mb": rss_after_load,
+        "peak_rss_mb": peak_rss_mb(),
+        "latency": latency,
+        "probabilities": probabilities.tolist(),
+    }))
+
+
+def measure(backend, path, images_file, args):
+    """Run one backend in a fresh interpreter and return its results"""
+    command = [
+        sys.executable, '-m', 'upload.benchmarks.backends',
+        '--worker', backend, path, images_file,
+        '--batch-sizes', args.batch_sizes, '--repeat', str(args.repeat),
+    ]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {"backend": backend, "path": path, "error": completed.stderr.strip().splitlines()[-1:]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare(result, reference, labels, class_labels):
+    probabilities = np.asarray(result.pop("probabilities"))
+    predicted = probabilities.argmax(axis=1)
+    truth = np.asarray(labels)
+    known = truth >= 0
+    if known.any():
+        result["accuracy"] = round(float((predicted[known] == truth[known]).mean()), 4)
+    if reference is not None:
+        result["top1_agreement"] = round(float((predicted == reference.argmax(axis=1)).mean()), 4)
+        result["max_abs_probability_diff"] = round(float(np.abs(probabilities - reference).max()), 5)
+        result["disagreements"] = [
+            {"index": int(i), "keras": class_labels[int(reference[i].argmax())], "this": class_labels[int(predicted[i])]}
+            for i in np.flatnonzero(predicted != reference.argmax(axis=1))[:20]
+        ]
+    return probabilities
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', help="Directory of photos, optionally in one folder per class")
+    parser.add_argument('--tflite', nargs='*', help="TFLite exports to compare (default: the ML_TFLITE_MODEL_PATH file)")
+    parser.add_argument('--batch-sizes', default='1,8,16')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--min-agreement', type=float, default=0.99)
+    parser.add_argument('--worker', nargs=3, metavar=('BACKEND', 'MODEL', 'IMAGES_JSON'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    batch_sizes = [int(size) for size in args.batch_sizes.split(',')]
+
+    if args.worker:
+        run_worker(*args.worker, batch_sizes, args.repeat)
+        return
+
+    from upload.ml_processor import MODEL_PATH, TFLITE_MODEL_PATH, class_labels
+    from upload.preprocessing import list_images
+
+    if args.images:
+        paths = list_images(args.images)
+    else:
+        paths = [os.path.join(os.path.dirname(MODEL_PATH), "gray.png")]
+        print("No --images given, parity is only checked on the sample image", file=sys.stderr)
+    if not paths:
+        raise SystemExit("No images found")
+
+    # Class from the folder name, -1 if the folder isn't a class
+    index_of = {label: index for index, label in class_labels.items()}
+    labels = [index_of.get(os.path.basename(os.path.dirname(path)), -1) for path in paths]
+
+    tflite_paths = args.tflite or [os.environ.get('ML_TFLITE_MODEL_PATH') or TFLITE_MODEL_PATH]
+    backends = [('keras', MODEL_PATH)] + [('tflite', path) for path in tflite_paths]
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(paths, f)
+        images_file = f.name
+    try:
+        results = [measure(backend, path, images_file, args) for backend, path in backends]
+    finally:
+        os.remove(images_file)
+
+    reference = None
+    for result in results:
+        if "error" not in result:
+            probabilities = compare(result, reference, labels, class_labels)
+            if result["backend"] == 'keras':
+                reference = probabilities
+
+    failed = [
+        result for result in results
+        if "error" in result or result.get("top1_agreement", 1.0) < args.min_agreement
+    ]
+    print(json.dumps({
+        "benchmark": "backends",
+        "images": len(paths),
+        "labelled": sum(label >= 0 for label in labels),
+        "min_agreement": args.min_agreement,
+        "results": results,
+        "parity_ok": not failed and reference is not None,
+    }, indent=2))
+    if failed or reference is None:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
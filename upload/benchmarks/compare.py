@@ -0,0 +1,96 @@
+"""
+Compare two benchmark results and report regressions.
+
+Takes the JSON written by any benchmark in this package (--output) for a baseline
+and a current run, and compares every timing, memory and throughput figure they
+share. Figures ending in _ms, _seconds or _mb are better lower, figures ending
+in _per_second better higher; anything else (counts, settings) is ignored.
+Exits with status 1 if any figure got worse by more than --tolerance.
+
+    python -m upload.benchmarks.compare BASELINE.json CURRENT.json [--tolerance 0.1]
+"""
+
+import argparse
+import json
+
+LOWER_IS_BETTER = ('_ms', '_seconds', '_mb')
+HIGHER_IS_BETTER = ('_per_second',)
+
+
+def figures(results, prefix=''):
+    """Flatten nested results into {path: number} for the figures that can regress"""
+    flat = {}
+    if isinstance(results, dict):
+        items = results.items()
+    elif isinstance(results, list):
+        items = ((f"[{i}]", value) for i, value in enumerate(results))
+    else:
+        return flat
+
+    for key, value in items:
+        path = f"{prefix}.{key}" if prefix and not key.startswith('[') else f"{prefix}{key}"
+        if key == 'run':
+            continue
+        if isinstance(value, (dict, list)):
+            flat.update(figures(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and key.endswith(LOWER_IS_BETTER + HIGHER_IS_BETTER):
+            flat[path] = value
+    return flat
+
+
+def compare(baseline, current, tolerance):
+    """
+    Relative change of every figure in both results
+
+    Returns:
+        list of dicts with the figure's path, both values, the change and whether
+        it is a regression beyond the tolerance
+    """
+    old, new = figures(baseline), figures(current)
+    changes = []
+    for path in old.keys() & new.keys():
+        if not old[path]:
+            continue
+        change = (new[path] - old[path]) / abs(old[path])
+        worse = change if path.endswith(LOWER_IS_BETTER) else -change
+        changes.append({
+            "figure": path,
+            "baseline": old[path],
+            "current": new[path],
+            "change": round(change, 3),
+            "regression": worse > tolerance,
+        })
+    return sorted(changes, key=lambda change: change["figure"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Allowed relative slowdown before a figure counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get("benchmark") != current.get("benchmark"):
+        raise SystemExit(f"Can't compare a {baseline.get('benchmark')} run with a {current.get('benchmark')} run")
+
+    changes = compare(baseline, current, args.tolerance)
+    regressions = [change for change in changes if change["regression"]]
+    print(json.dumps({
+        "benchmark": current.get("benchmark"),
+        "baseline": baseline.get("run"),
+        "current": current.get("run"),
+        "tolerance": args.tolerance,
+        "regressions": regressions,
+        "changes": changes,
+    }, indent=2))
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
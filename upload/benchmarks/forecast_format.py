@@ -0,0 +1,89 @@
+"""
+Micro-benchmark for the per-day humidity aggregation in format_forecast_data.
+
+Compares summarize_hourly_by_day against the previous implementation, which
+scanned every hourly timestamp for every day, on synthetic 16-day responses.
+
+    python -m upload.benchmarks.forecast_format [--days 16] [--repeat 200]
+"""
+
+import argparse
+import json
+import random
+import timeit
+from datetime import date, timedelta
+
+from upload.benchmarks import setup_django
+
+
+def make_response(days):
+    """A synthetic Open-Meteo response with `days` days of hourly humidity and dew point"""
+    start = date(2025, 4, 4)
+    dates = [(start + timedelta(days=d)).isoformat() for d in range(days)]
+    times = [f"{d}T{h:02d}:00" for d in dates for h in range(24)]
+    rng = random.Random(42)
+    humidity = [rng.randint(30, 100) for _ in times]
+    # A few gaps, as the API returns null for missing values
+    for i in rng.sample(range(len(humidity)), len(humidity) // 50):
+        humidity[i] = None
+    dew_point = [round(rng.uniform(40, 70), 1) for _ in times]
+    return {
+        "daily": {"time": dates},
+        "hourly": {"time": times, "relative_humidity_2m": humidity, "dew_point_2m": dew_point},
+    }
+
+
+def legacy_daily_humidity(api_data):
+    """The original O(days x hours) loop from format_forecast_data"""
+    result = []
+    for date_str in api_data['daily']['time']:
+        avg_humidity = None
+        hourly_times = api_data['hourly']['time']
+        hourly_humidity = api_data['hourly']['relative_humidity_2m']
+
+        day_humidity = []
+        for j, hourly_time in enumerate(hourly_times):
+            if hourly_time.startswith(date_str) and j < len(hourly_humidity):
+                if hourly_humidity[j] is not None:
+                    day_humidity.append(hourly_humidity[j])
+
+        if day_humidity:
+            avg_humidity = round(sum(day_humidity) / len(day_humidity))
+        result.append(avg_humidity)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--days', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+    from upload.forecast import summarize_hourly_by_day
+
+    api_data = make_response(args.days)
+    dates = api_data['daily']['time']
+
+    def vectorized():
+        return [day['humidity'] for day in summarize_hourly_by_day(api_data['hourly'], dates)]
+
+    # Both implementations must agree before their timings mean anything
+    if vectorized() != legacy_daily_humidity(api_data):
+        raise SystemExit("Mismatch between vectorized and legacy humidity averages")
+
+    legacy_time = min(timeit.repeat(lambda: legacy_daily_humidity(api_data), number=args.repeat, repeat=5)) / args.repeat
+    vectorized_time = min(timeit.repeat(vectorized, number=args.repeat, repeat=5)) / args.repeat
+
+    print(json.dumps({
+        "benchmark": "forecast_format",
+        "days": args.days,
+        "hours": len(api_data['hourly']['time']),
+        "legacy_ms": round(legacy_time * 1000, 4),
+        "vectorized_ms": round(vectorized_time * 1000, 4),
+        "speedup": round(legacy_time / vectorized_time, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
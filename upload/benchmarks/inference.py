@@ -0,0 +1,177 @@
+"""
+Benchmark for model inference through predict_image, the path every upload takes.
+
+Reports:
+
+- cold start: a fresh process importing the app, loading the model and making its
+  first and second predictions (repeated --cold-starts times, median reported),
+- per-image latency percentiles of predict_image one request at a time, and of
+  the preprocessing step alone,
+- forward-pass latency and throughput at each batch size (classify_batch),
+- latency and throughput with several requests at once, which the batching
+  engine groups into shared forward passes,
+- peak RSS of the process.
+
+Uses the backend, model and ML_BATCH_* settings of the current environment.
+
+    python -m upload.benchmarks.inference [--images DIR] [--requests 64]
+        [--batch-sizes 1,4,8,16,32] [--concurrency 1,4,8,16] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from upload.benchmarks import emit, peak_rss_mb, percentiles, run_info, setup_django
+
+
+def cold_start(image_path):
+    """Time a first prediction in this (fresh) process and print the results as JSON"""
+    start = time.perf_counter()
+    setup_django()
+    from upload import ml_processor
+    imported = time.perf_counter()
+    ml_processor.get_model()
+    loaded = time.perf_counter()
+    ml_processor.predict_image(image_path)
+    first = time.perf_counter()
+    ml_processor.predict_image(image_path)
+    second = time.perf_counter()
+
+    print(json.dumps({
+        "import_seconds": round(imported - start, 3),
+        "load_seconds": round(loaded - imported, 3),
+        "first_prediction_seconds": round(first - loaded, 3),
+        "second_prediction_seconds": round(second - first, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }))
+
+
+def measure_cold_starts(image_path, repeat):
+    """Median of `repeat` cold starts, each in a new interpreter"""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, '-m', 'upload.benchmarks.inference', '--cold-start', image_path],
+            capture_output=True, text=True,
+        )
+        wall = time.perf_counter() - start
+        if completed.returncode != 0:
+            return {"error": completed.stderr.strip().splitlines()[-1:]}
+        run = json.loads(completed.stdout.strip().splitlines()[-1])
+        # Includes starting Python, which the process can't time itself
+        run["process_seconds"] = round(wall, 3)
+        runs.append(run)
+    return {key: round(float(np.median([run[key] for run in runs])), 3) for key in runs[0]}
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', help="Directory of photos to use instead of synthetic ones")
+    parser.add_argument('--count', type=int, default=8, help="Number of synthetic photos")
+    parser.add_argument('--size', default='4032x3024', help="Synthetic photo size, WIDTHxHEIGHT")
+    parser.add_argument('--requests', type=int, default=64, help="Predictions per latency/concurrency run")
+    parser.add_argument('--batch-sizes', default='1,4,8,16,32')
+    parser.add_argument('--concurrency', default='1,4,8,16')
+    parser.add_argument('--repeat', type=int, default=20, help="Forward passes per batch size")
+    parser.add_argument('--cold-starts', type=int, default=3)
+    parser.add_argument('--output', help="Also write the JSON results to this file")
+    parser.add_argument('--cold-start', metavar='IMAGE', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold_start:
+        cold_start(args.cold_start)
+        return
+
+    setup_django()
+    from django.conf import settings
+
+    from upload import ml_processor
+    from upload.benchmarks.preprocess import make_images
+    from upload.preprocessing import list_images
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.images:
+            paths = list_images(args.images)
+            if not paths:
+                raise SystemExit("No images found")
+        else:
+            width, height = (int(value) for value in args.size.lower().split('x'))
+            paths = make_images(directory, args.count, width, height)
+
+        results = {
+            "benchmark": "inference",
+            "run": run_info(),
+            "model": {
+                "backend": ml_processor.registry.current().backend,
+                "version": ml_processor.model_version(),
+                "batching": settings.ML_BATCHING_ENABLED,
+                "batch_max_size": settings.ML_BATCH_MAX_SIZE,
+                "batch_max_wait_ms": settings.ML_BATCH_MAX_WAIT_MS,
+            },
+            "images": len(paths),
+            "cold_start": measure_cold_starts(paths[0], args.cold_starts),
+        }
+
+        ml_processor.warm_up()
+        model = ml_processor.registry.current()
+        if not model.is_loaded:
+            raise SystemExit(f"Model failed to load: {model.error}")
+        results["rss_after_load_mb"] = peak_rss_mb()
+
+        # One request at a time, as a single upload sees it
+        requests = [paths[i % len(paths)] for i in range(args.requests)]
+        results["preprocess"] = percentiles([timed(ml_processor.load_and_preprocess_image, path) for path in requests])
+        results["predict_image"] = percentiles([timed(ml_processor.predict_image, path) for path in requests])
+
+        # Forward passes only, at each batch size
+        inputs = np.stack([ml_processor.load_and_preprocess_image(path) for path in paths])
+        batches = []
+        for batch_size in (int(size) for size in args.batch_sizes.split(',')):
+            # Repeat the photos if there are fewer than the batch size
+            batch = inputs[np.arange(batch_size) % len(inputs)]
+            for _ in range(2):
+                ml_processor.classify_batch(batch)
+            timings = [timed(ml_processor.classify_batch, batch) for _ in range(args.repeat)]
+            summary = percentiles(timings)
+            batches.append(dict(
+                batch_size=batch_size,
+                images_per_second=round(batch_size * 1000 / summary["p50_ms"], 1),
+                **summary,
+            ))
+        results["batch_sizes"] = batches
+
+        # Several requests at once, batched together by the engine
+        levels = []
+        for concurrency in (int(level) for level in args.concurrency.split(',')):
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                start = time.perf_counter()
+                timings = list(pool.map(lambda path: timed(ml_processor.predict_image, path), requests))
+                wall = time.perf_counter() - start
+            levels.append(dict(
+                concurrency=concurrency,
+                requests_per_second=round(len(requests) / wall, 1),
+                **percentiles(timings),
+            ))
+        results["concurrency"] = levels
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    emit(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
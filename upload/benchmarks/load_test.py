@@ -0,0 +1,294 @@
+"""
+End-to-end load test of the upload endpoint (POST /).
+
+Serves the app over HTTP on a local port and sends it photo uploads from several
+clients at once, with the weather and geocoding APIs replaced by a local stub
+server so results don't depend on (or hammer) Open-Meteo and Nominatim. Every
+upload is a different photo, so none of them is answered from the prediction
+cache.
+
+The test runs against a throwaway database, media folder and caches. With
+--mode inline uploads are processed on the request (UPLOAD_ASYNC_PROCESSING=0);
+with --mode queued they are processed by upload worker threads and each client
+polls its job's status URL until it finishes, as the home page does.
+
+Reports, per concurrency level: upload response time percentiles, time until the
+upload was processed, throughput and errors; plus how many calls reached each stub
+API and the peak RSS of the process.
+
+    python -m upload.benchmarks.load_test [--requests 32] [--concurrency 1,4,8]
+        [--mode inline|queued] [--workers 2] [--stub-latency-ms 50] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from upload.benchmarks import emit, peak_rss_mb, percentiles, run_info, setup_django
+
+
+class StubWeatherHandler(BaseHTTPRequestHandler):
+    """Answers Open-Meteo forecast/geocoding and Nominatim requests with synthetic data"""
+
+    latency = 0.0
+    calls = Counter()
+    calls_lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        with self.calls_lock:
+            self.calls[url.path] += 1
+        time.sleep(self.latency)
+
+        if url.path == '/v1/forecast':
+            body = forecast_response(int(params.get('forecast_days', 2)))
+        elif url.path == '/v1/search':
+            body = {"results": [{"name": "Ames", "admin1": "Iowa", "country": "United States"}]}
+        elif url.path == '/reverse':
+            body = {"address": {"city": "Ames", "state": "Iowa", "country": "United States"}}
+        else:
+            self.send_error(404)
+            return
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def forecast_response(days):
+    """An Open-Meteo daily forecast with hourly humidity and dew point"""
+    rng = random.Random(days)
+    dates = [(date.today() + timedelta(days=d)).isoformat() for d in range(days)]
+    times = [f"{d}T{h:02d}:00" for d in dates for h in range(24)]
+    return {
+        "daily": {
+            "time": dates,
+            "temperature_2m_max": [round(rng.uniform(70, 90), 1) for _ in dates],
+            "temperature_2m_min": [round(rng.uniform(50, 70), 1) for _ in dates],
+            "precipitation_sum": [round(rng.uniform(0, 1), 2) for _ in dates],
+            "precipitation_probability_max": [rng.randint(0, 100) for _ in dates],
+            "weathercode": [rng.choice([0, 1, 2, 3, 61]) for _ in dates],
+        },
+        "hourly": {
+            "time": times,
+            "relative_humidity_2m": [rng.randint(40, 100) for _ in times],
+            "dew_point_2m": [round(rng.uniform(45, 70), 1) for _ in times],
+        },
+    }
+
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_app():
+    """Serve the Django app on a local port, as runserver would"""
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler, allow_reuse_address=False)
+    server.set_app(get_wsgi_application())
+    return server, start_server(server)
+
+
+def login_cookies(username):
+    """Session and CSRF cookies of a new user, for the HTTP clients"""
+    from django.conf import settings
+    from django.middleware.csrf import CSRF_ALLOWED_CHARS, CSRF_SECRET_LENGTH
+    from django.test import Client
+    from django.utils.crypto import get_random_string
+
+    from upload.models import Farmer
+
+    user = Farmer.objects.create_user(username=username, password=get_random_string(20))
+    client = Client()
+    client.force_login(user)
+    return {
+        settings.SESSION_COOKIE_NAME: client.cookies[settings.SESSION_COOKIE_NAME].value,
+        settings.CSRF_COOKIE_NAME: get_random_string(CSRF_SECRET_LENGTH, CSRF_ALLOWED_CHARS),
+    }
+
+
+def upload(base_url, cookies, photo, location, days, poll_interval=0.05, timeout=300):
+    """
+    POST one photo to the home page, then poll its job until it has been processed
+
+    Returns:
+        dict with the response time, the time until processed, and an error if any
+    """
+    import requests
+    from django.conf import settings
+
+    from upload.models import ProcessingJob
+
+    session = requests.Session()
+    session.cookies.update(cookies)
+    start = time.perf_counter()
+    try:
+        with open(photo, 'rb') as f:
+            response = session.post(
+                base_url + '/',
+                files={'file': (os.path.basename(photo), f, 'image/jpeg')},
+                data={'latitude': location[0], 'longitude': location[1], 'days': days},
+                headers={'X-CSRFToken': cookies[settings.CSRF_COOKIE_NAME]},
+                timeout=timeout,
+            )
+        response_ms = (time.perf_counter() - start) * 1000
+        data = response.json()
+        if response.status_code != 200 or data.get('status') != 'success':
+            return {"response_ms": response_ms, "error": f"{response.status_code}: {data.get('message')}"}
+
+        job = data['job']
+        while job['status'] not in (ProcessingJob.STATUS_DONE, ProcessingJob.STATUS_FAILED):
+            if time.perf_counter() - start > timeout:
+                return {"response_ms": response_ms, "error": "Timed out waiting for the job"}
+            time.sleep(poll_interval)
+            job = session.get(base_url + job['status_url'], timeout=timeout).json()
+        if job['status'] == ProcessingJob.STATUS_FAILED:
+            return {"response_ms": response_ms, "error": job.get('error') or "Job failed"}
+        return {"response_ms": response_ms, "completed_ms": (time.perf_counter() - start) * 1000}
+    except (requests.RequestException, ValueError) as e:
+        return {"response_ms": (time.perf_counter() - start) * 1000, "error": str(e)}
+    finally:
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=32, help="Uploads per concurrency level")
+    parser.add_argument('--concurrency', default='1,4,8')
+    parser.add_argument('--mode', choices=['inline', 'queued'], default='inline')
+    parser.add_argument('--workers', type=int, default=2, help="Upload worker threads in queued mode")
+    parser.add_argument('--size', default='1600x1200', help="Photo size, WIDTHxHEIGHT")
+    parser.add_argument('--locations', type=int, default=4, help="Number of distinct fields the photos come from")
+    parser.add_argument('--days', type=int, default=2, help="Forecast days sent with each upload")
+    parser.add_argument('--stub-latency-ms', type=float, default=50, help="Response time of the stub weather APIs")
+    parser.add_argument('--output', help="Also write the JSON results to this file")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    StubWeatherHandler.latency = args.stub_latency_ms / 1000
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubWeatherHandler)
+    stub_url = start_server(stub)
+
+    workdir = tempfile.mkdtemp(prefix='upload-load-test-')
+    # Settings read from the environment have to be in place before Django starts
+    os.environ.update({
+        'OPEN_METEO_FORECAST_URL': f"{stub_url}/v1/forecast",
+        'OPEN_METEO_GEOCODING_URL': f"{stub_url}/v1/search",
+        'NOMINATIM_REVERSE_URL': f"{stub_url}/reverse",
+        'DEFAULT_CACHE_DIR': os.path.join(workdir, 'cache', 'default'),
+        'HTTP_CACHE_DIR': os.path.join(workdir, 'cache', 'http'),
+        'UPLOAD_ASYNC_PROCESSING': '1' if args.mode == 'queued' else '0',
+        'ML_WARMUP_ON_START': '0',
+    })
+    setup_django()
+    from django.db import connection
+    from django.test.utils import override_settings
+
+    from upload import ml_processor
+    from upload.benchmarks.preprocess import make_images
+    from upload.jobs import worker_loop
+
+    # A throwaway database, as the test runner creates one
+    connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(workdir, 'db.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    media = override_settings(MEDIA_ROOT=os.path.join(workdir, 'media'))
+    media.enable()
+
+    stop_workers = threading.Event()
+    server = None
+    try:
+        width, height = (int(value) for value in args.size.lower().split('x'))
+        photo_dir = os.path.join(workdir, 'photos')
+        os.makedirs(photo_dir)
+        photos = make_images(photo_dir, args.requests * len(levels), width, height)
+
+        rng = random.Random(0)
+        locations = [(round(rng.uniform(41, 43), 4), round(rng.uniform(-95, -91), 4)) for _ in range(args.locations)]
+
+        # The model load is measured by the inference benchmark, not here
+        ml_processor.warm_up()
+        model = ml_processor.registry.current()
+        if not model.is_loaded:
+            raise SystemExit(f"Model failed to load: {model.error}")
+
+        if args.mode == 'queued':
+            for i in range(args.workers):
+                threading.Thread(target=worker_loop, args=(f"load-test:{i}", stop_workers), daemon=True).start()
+
+        server, base_url = start_app()
+        cookies = login_cookies('load-test')
+
+        results = []
+        for index, concurrency in enumerate(levels):
+            batch = photos[index * args.requests:(index + 1) * args.requests]
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                start = time.perf_counter()
+                outcomes = list(pool.map(
+                    lambda i: upload(base_url, cookies, batch[i], locations[i % len(locations)], args.days),
+                    range(len(batch)),
+                ))
+                wall = time.perf_counter() - start
+
+            errors = [outcome["error"] for outcome in outcomes if "error" in outcome]
+            completed = [outcome["completed_ms"] for outcome in outcomes if "completed_ms" in outcome]
+            results.append({
+                "concurrency": concurrency,
+                "requests": len(outcomes),
+                "errors": len(errors),
+                "error_samples": sorted(set(errors))[:5],
+                "wall_seconds": round(wall, 3),
+                "uploads_per_second": round(len(completed) / wall, 2),
+                "response": percentiles([outcome["response_ms"] for outcome in outcomes]),
+                "completed": percentiles(completed),
+            })
+
+        emit({
+            "benchmark": "load_test",
+            "run": run_info(),
+            "mode": args.mode,
+            "workers": args.workers if args.mode == 'queued' else None,
+            "model_backend": ml_processor.registry.current().backend,
+            "photo_size": args.size,
+            "locations": args.locations,
+            "stub_latency_ms": args.stub_latency_ms,
+            "levels": results,
+            "stub_calls": dict(StubWeatherHandler.calls),
+            "peak_rss_mb": peak_rss_mb(),
+        }, args.output)
+    finally:
+        stop_workers.set()
+        if server is not None:
+            server.shutdown()
+        stub.shutdown()
+        media.disable()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark for model input preprocessing (decode, resize to 224x224, scale).
+
+Times the Pillow/NumPy path (full decode, the default, and the opt-in JPEG draft
+mode) against the original tf.io pipeline on phone-sized JPEGs, and reports how
+far each result is from the TensorFlow output. The TensorFlow columns are skipped if TensorFlow isn't installed.
+
+    python -m upload.benchmarks.preprocess [--images DIR] [--count 8] [--size 4032x3024] [--repeat 3]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from upload.preprocessing import preprocess_image
+
+
+def make_images(directory, count, width, height):
+    """Write `count` synthetic photos: smooth gradients plus noise, so JPEG sizes are realistic"""
+    rng = np.random.default_rng(42)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    paths = []
+    for i in range(count):
+        base = np.stack([
+            128 + 100 * np.sin(x / (150 + 30 * i)),
+            128 + 100 * np.cos(y / (200 + 20 * i)),
+            128 + 80 * np.sin((x + y) / 300),
+        ], axis=-1)
+        noise = rng.normal(0, 12, size=base.shape)
+        pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+        path = os.path.join(directory, f"photo_{i}.jpg")
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def time_per_image(function, paths, repeat):
+    """Best-of-`repeat` average time per image in milliseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            function(path)
+        elapsed = (time.perf_counter() - start) / len(paths)
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 2)
+
+
+def max_difference(function, reference, paths):
+    return float(max(np.max(np.abs(function(path) - reference(path))) for path in paths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', help="Directory of JPEG/PNG files to use instead of synthetic photos")
+    parser.add_argument('--count', type=int, default=8)
+    parser.add_argument('--size', default='4032x3024', help="Synthetic photo size, WIDTHxHEIGHT")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.images:
+            paths = sorted(
+                os.path.join(args.images, name) for name in os.listdir(args.images)
+                if name.lower().endswith(('.jpg', '.jpeg', '.png'))
+            )
+        else:
+            width, height = (int(value) for value in args.size.lower().split('x'))
+            paths = make_images(directory, args.count, width, height)
+
+        def pillow_full(path):
+            return preprocess_image(path, draft=False)
+
+        def pillow_draft(path):
+            return preprocess_image(path, draft=True)
+
+        results = {
+            "benchmark": "preprocess",
+            "images": len(paths),
+            "pillow_full_ms": time_per_image(pillow_full, paths, args.repeat),
+            "pillow_draft_ms": time_per_image(pillow_draft, paths, args.repeat),
+        }
+
+        try:
+            import tensorflow  # noqa: F401
+        except ImportError:
+            results["tensorflow"] = "not installed, comparison skipped"
+        else:
+            from upload.ml_processor import load_and_preprocess_image_tf
+
+            def tensorflow_path(path):
+                return np.asarray(load_and_preprocess_image_tf(path), dtype=np.float32)
+
+            results["tensorflow_ms"] = time_per_image(tensorflow_path, paths, args.repeat)
+            results["speedup_full"] = round(results["tensorflow_ms"] / results["pillow_full_ms"], 2)
+            results["speedup_draft"] = round(results["tensorflow_ms"] / results["pillow_draft_ms"], 2)
+            # Differences are in [0, 1] model input units. For JPEGs the full decode
+            # differs because Pillow uses libjpeg's accurate integer DCT and
+            # tf.io.decode_jpeg the fast one by default; PNGs match exactly
+            results["max_abs_diff_full"] = max_difference(pillow_full, tensorflow_path, paths)
+            results["max_abs_diff_draft"] = max_difference(pillow_draft, tensorflow_path, paths)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
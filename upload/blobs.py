@@ -0,0 +1,120 @@
+import hashlib
+import os
+
+from .derivatives import delete_derivatives, rename_derivatives
+from .metrics import timed
+from .upload_handlers import sniff_image_type
+
+'''
+    Content-addressed storage of uploaded images.
+
+    Uploads are stored under their SHA-256 (blobs/ab/cd/abcd....jpg), so when a
+    farmer uploads the same photo again the new UploadedFile points at the existing
+    file and its thumbnails instead of storing another copy. Files are reference
+    counted through the UploadedFile rows that point at them: a blob is deleted
+    with its last row.
+
+    Adding a reference saves the row before making sure the blob exists, and
+    removing one deletes the row before counting what is left. That way a blob is
+    never removed while a row that was saved before the count still needs it.
+'''
+
+EXTENSIONS = {'jpeg': 'jpg', 'png': 'png', 'gif': 'gif', 'bmp': 'bmp', 'webp': 'webp'}
+
+
+def blob_name(content_hash, image_type=None, original_name=''):
+    """Storage name of a blob; the extension comes from the sniffed image type when known"""
+    extension = EXTENSIONS.get(image_type) or os.path.splitext(original_name)[1].lstrip('.').lower()
+    name = f"blobs/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+    return f"{name}.{extension}" if extension else name
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """SHA-256 and image type of a file already on disk"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        header = f.read(chunk_size)
+        image_type = sniff_image_type(header)
+        while header:
+            hasher.update(header)
+            header = f.read(chunk_size)
+    return hasher.hexdigest(), image_type
+
+
+def store_upload(uploaded_file, upload):
+    """
+    Save an UploadedFile whose image is stored by content hash, reusing the blob
+    if the same image was uploaded before.
+
+    Args:
+        uploaded_file: Unsaved UploadedFile with content_hash set
+        upload: The HashedUploadedFile from the request
+    """
+    storage = uploaded_file.file.storage
+    name = blob_name(uploaded_file.content_hash, upload.image_type, upload.name)
+
+    if not uploaded_file.title:
+        uploaded_file.title = os.path.splitext(os.path.basename(upload.name))[0]
+    uploaded_file.file = name
+    uploaded_file.save()
+
+    save_blob(storage, name, upload)
+
+
+def save_blob(storage, name, content):
+    """Store content under its blob name unless that blob already exists"""
+    with timed('file_save'):
+        if not storage.exists(name):
+            saved_name = storage.save(name, content)
+            if saved_name != name:
+                # Someone stored the same content in the meantime, keep theirs
+                storage.delete(saved_name)
+
+
+def is_referenced(fieldfile, content_hash=''):
+    from .models import UploadedFile
+
+    files = UploadedFile.objects.filter(file=fieldfile.name)
+    if content_hash:
+        files = files.filter(content_hash=content_hash)
+    return files.exists()
+
+
+def delete_upload(uploaded_file):
+    """Delete an UploadedFile, and its image and thumbnails if no other upload uses them"""
+    fieldfile = uploaded_file.file
+    content_hash = uploaded_file.content_hash
+    uploaded_file.delete()
+
+    if fieldfile and not is_referenced(fieldfile, content_hash):
+        delete_derivatives(fieldfile)
+        if fieldfile.storage.exists(fieldfile.name):
+            fieldfile.storage.delete(fieldfile.name)
+
+
+def move_to_blob(uploaded_file):
+    """
+    Hash an existing upload and move its file (and thumbnails) into blob storage.
+    Returns the blob name. Used by the backfill_content_hashes command.
+    """
+    from .models import UploadedFile
+
+    fieldfile = uploaded_file.file
+    storage = fieldfile.storage
+    old_name = fieldfile.name
+    content_hash, image_type = hash_file(storage.path(old_name))
+    name = blob_name(content_hash, image_type, old_name)
+
+    if name != old_name:
+        if not storage.exists(name):
+            os.makedirs(os.path.dirname(storage.path(name)), exist_ok=True)
+            os.replace(storage.path(old_name), storage.path(name))
+        rename_derivatives(storage, old_name, name)
+
+    # Any other rows pointing at the same file move along with this one
+    UploadedFile.objects.filter(file=old_name).update(file=name, content_hash=content_hash)
+    if name != old_name and storage.exists(old_name):
+        storage.delete(old_name)
+    uploaded_file.file = name
+    uploaded_file.content_hash = content_hash
+    return name
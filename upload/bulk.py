@@ -0,0 +1,326 @@
+import os
+import zipfile
+import zlib
+from datetime import datetime
+
+from django.conf import settings
+from PIL import ExifTags, Image
+
+from . import geohash
+from .blobs import blob_name, save_blob
+from .derivatives import create_derivatives
+from .models import PredictionCache, ProcessingJob, UploadBatch, UploadedFile
+from .upload_handlers import HashedUploadedFile, ImageStream, InvalidImage
+
+'''
+    Bulk uploads: scouts walking a field send 50-200 photos at once, as several
+    files or ZIP archives in one request.
+
+    The request only streams the files to disk, hashes them, stores the blobs and
+    creates all UploadedFile rows with one bulk_create, so it returns long before
+    the gunicorn timeout no matter how many images there are. One ProcessingJob
+    then handles the whole batch in a worker:
+
+    - each distinct image is decoded once for its thumbnails and model input,
+    - inference runs ML_BATCH_MAX_SIZE images per forward pass, and images seen
+      before (same content hash) reuse their cached prediction,
+    - photos without coordinates get them from their EXIF GPS tags,
+    - the forecast is fetched once per geohash cell, not once per photo.
+
+    The job's result is a manifest with one entry per file.
+'''
+
+READ_SIZE = 64 * 1024
+
+STATUS_QUEUED = 'queued'
+STATUS_PROCESSED = 'processed'
+STATUS_FAILED = 'failed'
+STATUS_REJECTED = 'rejected'
+
+
+def rejection(name, message):
+    return {'name': name, 'status': STATUS_REJECTED, 'error': message}
+
+
+def is_hidden(path):
+    # Folders and metadata that archivers add, e.g. __MACOSX/._IMG_0001.jpg
+    return any(part.startswith(('.', '__MACOSX')) for part in path.split('/'))
+
+
+def iter_archive(archive, rejected, budget):
+    """
+    Extract the images of a ZIP upload one entry at a time. Each entry is streamed
+    through the same checks as a directly uploaded file.
+
+    Args:
+        archive: HashedUploadedFile of the ZIP archive
+        rejected: List that entries which aren't acceptable images are added to
+        budget: dict with 'files' and 'bytes' still allowed in this request
+
+    Yields:
+        HashedUploadedFile for every acceptable image
+    """
+    try:
+        zf = zipfile.ZipFile(archive.temporary_file_path())
+    except (zipfile.BadZipFile, OSError):
+        rejected.append(rejection(archive.name, "Not a readable ZIP archive."))
+        return
+
+    with zf:
+        for info in zf.infolist():
+            if info.is_dir() or is_hidden(info.filename):
+                continue
+            name = f"{archive.name}/{info.filename}"
+            if budget['files'] <= 0:
+                rejected.append(rejection(name, f"At most {settings.UPLOAD_MAX_BULK_FILES} files can be uploaded at once."))
+                continue
+
+            upload = HashedUploadedFile(os.path.basename(info.filename), 'application/octet-stream', 0, None)
+            stream = ImageStream(min(settings.UPLOAD_MAX_IMAGE_SIZE, budget['bytes']))
+            try:
+                # The sizes in the archive's directory can't be trusted, the stream
+                # enforces the limits on what is actually extracted
+                with zf.open(info) as entry:
+                    for chunk in iter(lambda: entry.read(READ_SIZE), b''):
+                        stream.feed(chunk)
+                        upload.write(chunk)
+                stream.finish(upload)
+            except InvalidImage as e:
+                upload.close()
+                rejected.append(rejection(name, str(e)))
+                continue
+            except (zipfile.BadZipFile, zlib.error, RuntimeError, NotImplementedError, OSError) as e:
+                # Corrupt, encrypted or unsupported compression
+                upload.close()
+                rejected.append(rejection(name, f"Could not extract: {str(e)}"))
+                continue
+
+            upload.size = stream.size
+            upload.seek(0)
+            budget['files'] -= 1
+            budget['bytes'] -= stream.size
+            yield upload
+
+
+def collect_uploads(files, rejected):
+    """
+    Flatten the files of a bulk upload, extracting ZIP archives
+
+    Returns:
+        list of HashedUploadedFile, one per image
+    """
+    budget = {'files': settings.UPLOAD_MAX_BULK_FILES, 'bytes': settings.UPLOAD_MAX_BULK_SIZE}
+    uploads = []
+    for upload in files:
+        if upload.image_type == 'zip':
+            uploads.extend(iter_archive(upload, rejected, budget))
+        elif budget['files'] <= 0:
+            rejected.append(rejection(upload.name, f"At most {settings.UPLOAD_MAX_BULK_FILES} files can be uploaded at once."))
+        else:
+            budget['files'] -= 1
+            uploads.append(upload)
+    return uploads
+
+
+def create_batch(farmer, uploads, rejected, latitude=None, longitude=None, days=None):
+    """
+    Store the images of a bulk upload and queue one job for all of them
+
+    Returns:
+        (UploadBatch, ProcessingJob, list of UploadedFile)
+    """
+    batch = UploadBatch.objects.create(farmer=farmer, rejected=rejected)
+    files = [
+        UploadedFile(
+            farmer=farmer,
+            batch=batch,
+            title=os.path.splitext(os.path.basename(upload.name))[0][:100],
+            file=blob_name(upload.sha256, upload.image_type, upload.name),
+            content_hash=upload.sha256,
+            latitude=latitude,
+            longitude=longitude,
+            forecast_days=days or 2,
+        )
+        for upload in uploads
+    ]
+    for file in files:
+        file.set_geohash()
+    # Rows before blobs, as in blobs.store_upload
+    UploadedFile.objects.bulk_create(files)
+
+    storage = UploadedFile._meta.get_field('file').storage
+    for upload, file in zip(uploads, files):
+        save_blob(storage, file.file.name, upload)
+        upload.close()
+
+    job = ProcessingJob.objects.create(batch=batch)
+    return batch, job, files
+
+
+def upload_manifest(batch, files):
+    """Manifest returned right after the upload, before anything is processed"""
+    return [{'id': file.id, 'name': file.title, 'status': STATUS_QUEUED} for file in files] + batch.rejected
+
+
+def exif_coordinates(path):
+    """(latitude, longitude) from a photo's EXIF GPS tags, or None"""
+    try:
+        with Image.open(path) as image:
+            gps = image.getexif().get_ifd(ExifTags.IFD.GPSInfo)
+    except Exception:
+        return None
+    if not gps:
+        return None
+
+    def degrees(values, ref):
+        d, m, s = (float(value) for value in values)
+        value = d + m / 60 + s / 3600
+        return -value if ref in ('S', 'W') else value
+
+    try:
+        latitude = degrees(gps[ExifTags.GPS.GPSLatitude], gps.get(ExifTags.GPS.GPSLatitudeRef))
+        longitude = degrees(gps[ExifTags.GPS.GPSLongitude], gps.get(ExifTags.GPS.GPSLongitudeRef))
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return None
+    # Cameras without a fix write zeros, and NaN fails both comparisons
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or (latitude == 0 and longitude == 0):
+        return None
+    return latitude, longitude
+
+
+def predict_files(files, progress=None):
+    """
+    Classify files in batches of ML_BATCH_MAX_SIZE. Each distinct image is run once;
+    images in the prediction cache aren't run at all.
+
+    Returns:
+        dict: content hash -> Prediction, or the exception that prevented it
+    """
+    from .ml_processor import Prediction, classify_batch, decode_for_model, load_and_preprocess_image, model_version
+    from .preprocessing import batch_buffer
+
+    version = model_version()
+    results = {
+        content_hash: Prediction(prediction, confidence, version)
+        for content_hash, prediction, confidence in PredictionCache.objects
+        .filter(content_hash__in={file.content_hash for file in files}, model_version=version)
+        .values_list('content_hash', 'prediction', 'confidence')
+    }
+
+    pending = list({file.content_hash: file for file in files if file.content_hash not in results}.values())
+    batch_size = settings.ML_BATCH_MAX_SIZE
+
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        inputs = batch_buffer(len(chunk))
+        decoded = []
+        for file in chunk:
+            # The model input is built like every other upload's (see jobs.classify_upload),
+            # from the same decode as the thumbnails
+            try:
+                image = decode_for_model(file.file.path)
+                create_derivatives(file.file, image=image)
+                load_and_preprocess_image(file.file.path, out=inputs[len(decoded)], image=image)
+                decoded.append(file)
+            except Exception as e:
+                print(f"Error preparing {file.file.name}: {str(e)}")
+                results[file.content_hash] = e
+
+        if decoded:
+            predictions = classify_batch(inputs[:len(decoded)])
+            for file, prediction in zip(decoded, predictions):
+                results[file.content_hash] = prediction
+            PredictionCache.objects.bulk_create([
+                PredictionCache(content_hash=file.content_hash, model_version=prediction.model_version,
+                                prediction=prediction.label, confidence=prediction.confidence)
+                for file, prediction in zip(decoded, predictions)
+            ], ignore_conflicts=True)
+
+        if progress:
+            progress(min(start + batch_size, len(pending)), len(pending))
+
+    return results
+
+
+def locate_files(files):
+    """
+    Fill in coordinates from EXIF where the upload didn't give any, then location
+    names and forecasts. The forecast is fetched once per geohash cell.
+    """
+    from .forecast import get_location_name, stored_forecast
+
+    forecasts = {}
+    for file in files:
+        if file.latitude is None or file.longitude is None:
+            coordinates = exif_coordinates(file.file.path)
+            if coordinates is None:
+                continue
+            file.latitude, file.longitude = coordinates
+
+        # Cached per geohash cell, so only the first photo of a plot is looked up
+        file.location_name = get_location_name(file.latitude, file.longitude)
+
+        cell = geohash.encode(file.latitude, file.longitude, settings.FORECAST_GEOHASH_PRECISION)
+        if cell not in forecasts:
+            try:
+                forecasts[cell] = stored_forecast(file.latitude, file.longitude, file.forecast_days,
+                                                  location_name=file.location_name)
+            except Exception as e:
+                print(f"Error fetching weather data: {str(e)}")
+                forecasts[cell] = None
+        forecast = forecasts[cell]
+        if forecast is not None and forecast.pk:
+            file.forecast = forecast
+
+
+def process_batch(batch, progress=None):
+    """
+    Run the model, geocoding and forecasts for every file of a batch and save the results
+
+    Args:
+        batch: The UploadBatch to process
+        progress: Optional callable(done, total) called after each inference batch
+
+    Returns:
+        dict: the manifest and counts stored as the job's result
+    """
+    from .public_feed import invalidate_public_history
+
+    files = list(batch.files.order_by('id'))
+    predictions = predict_files(files, progress=progress)
+
+    manifest = []
+    for file in files:
+        entry = {'id': file.id, 'name': file.title}
+        result = predictions.get(file.content_hash)
+        if isinstance(result, tuple):
+            file.prediction, file.confidence, file.model_version = result
+            entry.update(status=STATUS_PROCESSED, prediction=file.prediction, confidence=file.confidence,
+                         model_version=file.model_version)
+        else:
+            file.prediction = "Processing failed"
+            file.confidence = 0
+            entry.update(status=STATUS_FAILED, error=f"Error processing image: {str(result)}")
+        manifest.append(entry)
+
+    locate_files(files)
+    for file, entry in zip(files, manifest):
+        # EXIF may have given the file coordinates
+        file.set_geohash()
+        entry.update(latitude=file.latitude, longitude=file.longitude, location=file.location_name,
+                     forecast=file.forecast_id is not None)
+
+    UploadedFile.objects.bulk_update(
+        files, ['prediction', 'confidence', 'model_version', 'latitude', 'longitude', 'geohash', 'location_name', 'forecast'])
+    # bulk_update sends no post_save signals
+    invalidate_public_history()
+
+    processed = sum(entry['status'] == STATUS_PROCESSED for entry in manifest)
+    return {
+        'manifest': manifest + batch.rejected,
+        'processed': processed,
+        'failed': len(manifest) - processed,
+        'rejected': len(batch.rejected),
+        'processed_at': datetime.now().strftime('%Y-%m-%d %H:%M'),
+        'error': None,
+    }
@@ -1,69 +1,223 @@
 #!/usr/bin/env python
 """
-Script to check if the ML model exists, with a mock implementation 
-that doesn't depend on TensorFlow or Keras.
+Check that the ML model can actually serve predictions, before the app starts.
+
+The model is loaded in a separate process (a broken file can take TensorFlow down
+with it) and checked the way the app will use it:
+
+- the file is a real model, not a placeholder left behind by a failed download,
+- it takes 224x224 RGB images and outputs one score per class of its version,
+- warm-up batches of 1 and ML_BATCH_MAX_SIZE images run and give finite scores.
+
+The result is written to a readiness marker next to the model (ML_READY_MARKER)
+with the model's checksum, load time, warm-up latency and a fingerprint of its
+output on fixed inputs. The app reads it: a model that failed the check is
+reported as unavailable instead of being loaded on every request, and web and
+upload workers warm up the batch sizes the check ran. If the model hasn't changed
+since the last successful check, it isn't loaded again.
+
+    python -m upload.check_model [--force] [--timeout 300] [--version NAME]
+
+By default the active model version is checked; `manage.py models activate` checks
+a newly registered version this way before switching to it.
+
+Exits with status 1 if the model isn't ready.
 """
 
+import argparse
+import hashlib
+import json
 import os
+import subprocess
 import sys
+import time
+from datetime import datetime
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def inspect_model(backend, path, class_labels):
+    """
+    Load the model and run it on fixed inputs. Runs in the subprocess.
+
+    Args:
+        class_labels: dict of output index -> label the model is registered with
+
+    Returns:
+        dict: shapes, timings and output fingerprint, or an 'error'
+    """
+    import numpy as np
+    from django.conf import settings
+
+    from upload.backends import load_backend
+    from upload.preprocessing import INPUT_SIZE
+
+    start = time.perf_counter()
+    model = load_backend(backend, path)
+    result = {"load_seconds": round(time.perf_counter() - start, 3)}
+
+    expected_input = (INPUT_SIZE, INPUT_SIZE, 3)
+    input_shape = getattr(model, 'input_shape', None)
+    if input_shape is not None:
+        result["input_shape"] = list(input_shape)
+        if tuple(input_shape[1:]) != expected_input:
+            return dict(result, error=f"Model takes inputs of shape {tuple(input_shape)}, expected (None, {INPUT_SIZE}, {INPUT_SIZE}, 3)")
+
+    batch_sizes = sorted({1, settings.ML_BATCH_MAX_SIZE})
+    warmup = {}
+    for batch_size in batch_sizes:
+        batch = np.zeros((batch_size,) + expected_input, dtype=np.float32)
+        timings = []
+        for _ in range(5):
+            t = time.perf_counter()
+            output = np.asarray(model.predict_on_batch(batch))
+            timings.append((time.perf_counter() - t) * 1000)
+        if output.shape != (batch_size, len(class_labels)):
+            return dict(result, error=f"Model outputs shape {output.shape} for {batch_size} image(s), "
+                                      f"expected ({batch_size}, {len(class_labels)}) for classes {list(class_labels.values())}")
+        # The first call builds the graph for this batch shape
+        warmup[str(batch_size)] = {
+            "first_ms": round(timings[0], 2),
+            "warm_ms": round(float(np.median(timings[1:])), 2),
+        }
+    result["output_shape"] = [None, len(class_labels)]
+    result["warmup"] = warmup
+    result["warmup_batch_sizes"] = batch_sizes
+
+    # The same inputs always, so a changed model (or runtime) shows up as a changed fingerprint
+    inputs = np.random.default_rng(0).random((4,) + expected_input, dtype=np.float32)
+    output = np.asarray(model.predict_on_batch(inputs), dtype=np.float32)
+    if not np.isfinite(output).all():
+        return dict(result, error="Model outputs NaN or infinite scores")
+    result["fingerprint"] = hashlib.sha256(np.round(output, 3).tobytes()).hexdigest()[:16]
+    result["fingerprint_labels"] = [class_labels[int(i)] for i in output.argmax(axis=1)]
+    return result
+
+
+def run_worker(backend, path, version):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fileupload.settings')
+    import django
+    django.setup()
+
+    from upload.ml_processor import model_labels
+
+    try:
+        result = inspect_model(backend, path, model_labels(version))
+    except Exception as e:
+        result = {"error": f"Could not load the model: {str(e)}"}
+    print(json.dumps(result))
+
+
+def check_model(force=False, timeout=300, version=None):
+    """
+    Check a registered model version and write its readiness marker
+
+    Args:
+        force: Check again even if the model passed a check since it last changed
+        timeout: Seconds the model may take to load and warm up
+        version: Registered version to check, by default the active one
+
+    Returns:
+        dict: the readiness marker, with 'status' 'ready' or 'failed'
+    """
+    from upload.artifacts import file_sha256
+    from upload.backends import format_error
+    from upload.ml_processor import model_source, read_registry, readiness_marker_path
+
+    version = version or read_registry()["active"]
+    backend, path = model_source(version)
+    path = os.path.abspath(path)
+    print(f"Checking ML model {version}: {path} ({backend})...")
+    if not os.path.exists(path):
+        return {"status": "failed", "path": path, "backend": backend, "error": "Model file not found"}
+
+    stat = os.stat(path)
+    marker = {
+        "path": path,
+        "backend": backend,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(path),
+    }
+
+    marker_path = readiness_marker_path(path)
+    if not force:
+        try:
+            with open(marker_path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = {}
+        if previous.get("status") == "ready" and all(previous.get(key) == marker[key] for key in marker):
+            print(f"Model unchanged since it was checked at {previous.get('checked_at')}")
+            return previous
+
+    error = format_error(backend, path)
+    if error is None:
+        try:
+            completed = subprocess.run(
+                [sys.executable, '-m', 'upload.check_model', '--worker', backend, path, version],
+                capture_output=True, text=True, timeout=timeout, cwd=PROJECT_ROOT,
+            )
+            if completed.returncode != 0:
+                stderr = completed.stderr.strip().splitlines()
+                error = f"Model check exited with {completed.returncode}: {stderr[-1] if stderr else ''}"
+            else:
+                details = json.loads(completed.stdout.strip().splitlines()[-1])
+                error = details.pop("error", None)
+                marker.update(details)
+        except subprocess.TimeoutExpired:
+            error = f"Model did not load and warm up within {timeout} seconds"
+
+    marker.update(
+        status="failed" if error else "ready",
+        error=error,
+        checked_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    )
+
+    # Written in one step, web workers may be reading it
+    temp_path = f"{marker_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(marker, f, indent=2)
+    os.replace(temp_path, marker_path)
+    print(f"Readiness marker written to {marker_path}")
+    return marker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--force', action='store_true', help="Check even if the model hasn't changed")
+    parser.add_argument('--timeout', type=int, default=300)
+    parser.add_argument('--version', help="Registered model version to check (default: the active one)")
+    parser.add_argument('--worker', nargs=3, metavar=('BACKEND', 'MODEL', 'VERSION'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Also works as `python upload/check_model.py`
+    if PROJECT_ROOT not in sys.path:
+        sys.path.insert(0, PROJECT_ROOT)
+
+    if args.worker:
+        run_worker(*args.worker)
+        return
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fileupload.settings')
+    import django
+    django.setup()
+
+    try:
+        marker = check_model(force=args.force, timeout=args.timeout, version=args.version)
+    except (ValueError, KeyError) as e:
+        print(f"\n❌ Unknown model version: {str(e)}")
+        sys.exit(1)
+    if marker["status"] != "ready":
+        print(f"\n❌ Model check failed: {marker['error']}")
+        sys.exit(1)
+
+    print(f"Loaded in {marker['load_seconds']}s, warm-up (ms): "
+          + ", ".join(f"batch of {size}: {timing['first_ms']} first, {timing['warm_ms']} warm"
+                      for size, timing in marker['warmup'].items()))
+    print(f"SHA-256 {marker['sha256']}, output fingerprint {marker['fingerprint']}")
+    print("\n✅ Model check completed successfully")
 
-def check_model():
-    print("Checking ML model...")
-    
-    print("Using mock implementation for model checking")
-    
-    # Get current directory and project root
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    project_root = os.path.dirname(current_dir)
-    
-    # Define possible model paths to check
-    model_paths = [
-        os.path.join(current_dir, "Notebook", "corn_model_1.keras"),
-        os.path.join(project_root, "upload", "Notebook", "corn_model_1.keras"),
-        os.path.join(os.getcwd(), "upload", "Notebook", "corn_model_1.keras"),
-    ]
-    
-    # Check each path
-    found_path = None
-    for path in model_paths:
-        if os.path.exists(path):
-            print(f"Model file found at: {path}")
-            found_path = path
-            break
-    
-    if not found_path:
-        print("Error: Model file not found in any of these locations:")
-        for path in model_paths:
-            print(f"  - {path}")
-        return False
-    
-    # Pretend to load the model
-    print(f"Simulating model loading from {found_path}...")
-    print("✅ Mock model loaded successfully!")
-    
-    # Print fake model summary
-    print("\nMock Model Summary:")
-    print("_________________________________________________________________")
-    print("Layer (type)                 Output Shape              Param #   ")
-    print("=================================================================")
-    print("conv2d (Conv2D)              (None, 222, 222, 32)      896       ")
-    print("max_pooling2d (MaxPooling2D) (None, 111, 111, 32)      0         ")
-    print("conv2d_1 (Conv2D)            (None, 109, 109, 64)      18496     ")
-    print("flatten (Flatten)            (None, 762064)            0         ")
-    print("dense (Dense)                (None, 4)                 3048260   ")
-    print("=================================================================")
-    print("Total params: 3,067,652")
-    print("Trainable params: 3,067,652")
-    print("Non-trainable params: 0")
-    print("_________________________________________________________________")
-    
-    return True
 
 if __name__ == "__main__":
-    success = check_model()
-    if success:
-        print("\n✅ Model check completed successfully")
-        sys.exit(0)
-    else:
-        print("\n❌ Model check failed")
-        sys.exit(1) 
\ No newline at end of file
+    main()
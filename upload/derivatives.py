@@ -0,0 +1,148 @@
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+from PIL import Image, ImageOps, features
+
+from .preprocessing import resize_bilinear
+
+'''
+    Resized copies ("derivatives") of uploaded images.
+
+    Phone photos are 3-12 MB, so pages show small WebP (or JPEG) copies instead of
+    the originals. Derivatives are written next to the media files under
+    derivatives/<kind>/ at upload time, or on first request for older files.
+'''
+
+# kind: (size in pixels, how to fit the image into size x size)
+#   fit   - keep the aspect ratio, longest side = size
+#   crop  - fill a size x size square, cropping the overflow
+#   exact - stretch to size x size, like the model's preprocessing does
+DERIVATIVES = {
+    'thumb': (320, 'fit'),
+    'preview': (1280, 'fit'),
+    'avatar': (256, 'crop'),
+    # No longer created: the model reads the original (see jobs.classify_upload).
+    # Kept so the copies made for older uploads are renamed and deleted with them.
+    'model': (224, 'exact'),
+}
+
+UPLOAD_DERIVATIVES = ('thumb', 'preview')
+
+
+def derivative_format(kind):
+    # Lossless, as the 'model' copies of older uploads were read by inference
+    if kind == 'model':
+        return 'PNG'
+    return 'WEBP' if features.check('webp') else 'JPEG'
+
+
+def derivative_name(name, kind):
+    """Storage name of a derivative, e.g. uploads/leaf.jpg -> derivatives/thumb/uploads/leaf.webp"""
+    extension = {'PNG': 'png', 'WEBP': 'webp', 'JPEG': 'jpg'}[derivative_format(kind)]
+    return f"derivatives/{kind}/{os.path.splitext(name)[0]}.{extension}"
+
+
+def open_image(path, max_size):
+    """
+    Decode an image for resizing to at most max_size pixels. JPEGs are decoded at a
+    reduced scale (draft mode) when they are much larger than needed, and the EXIF
+    orientation is applied so phone photos aren't sideways.
+    """
+    image = Image.open(path)
+    image.draft('RGB', (max_size, max_size))
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGB')
+
+
+def render_derivative(image, kind):
+    size, mode = DERIVATIVES[kind]
+    if mode == 'exact':
+        # Same resize as the model's preprocessing, so the copy only differs by rounding
+        pixels = resize_bilinear(np.asarray(image), size)
+        return Image.fromarray(np.clip(np.rint(pixels), 0, 255).astype(np.uint8))
+    if mode == 'crop':
+        return ImageOps.fit(image, (size, size), Image.LANCZOS)
+    resized = image.copy()
+    resized.thumbnail((size, size), Image.LANCZOS)
+    return resized
+
+
+def write_derivative(storage, name, image, kind):
+    path = storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fmt = derivative_format(kind)
+    options = {} if fmt == 'PNG' else {'quality': settings.IMAGE_DERIVATIVE_QUALITY}
+
+    # Write under a temporary name first so readers never see a half-written file
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    render_derivative(image, kind).save(temp_path, format=fmt, **options)
+    os.replace(temp_path, path)
+
+
+def create_derivatives(fieldfile, kinds=UPLOAD_DERIVATIVES, image=None):
+    """
+    Write any of the given derivatives that don't exist yet. The source image is
+    decoded at most once for all of them.
+
+    Args:
+        fieldfile: The image's FieldFile (UploadedFile.file, Farmer.profile_picture)
+        kinds: Derivative kinds to create
+        image: Already decoded PIL image of the original, to skip decoding it again
+    """
+    storage = fieldfile.storage
+    missing = [kind for kind in kinds if not storage.exists(derivative_name(fieldfile.name, kind))]
+    if not missing:
+        return
+
+    max_size = max(DERIVATIVES[kind][0] for kind in missing)
+    if image is None:
+        image = open_image(fieldfile.path, max_size)
+    else:
+        # A full-size decode (the one kept for the model) is box-reduced first, as
+        # draft mode would, so resizing doesn't filter every pixel of a 12 MP photo
+        factor = min(8, min(image.size) // max_size)
+        if factor > 1:
+            image = image.reduce(factor)
+    for kind in missing:
+        write_derivative(storage, derivative_name(fieldfile.name, kind), image, kind)
+
+
+def derivative_url(fieldfile, kind):
+    """URL of a derivative, creating it on first use. Falls back to the original's URL."""
+    if not fieldfile:
+        return ''
+    try:
+        create_derivatives(fieldfile, (kind,))
+        return fieldfile.storage.url(derivative_name(fieldfile.name, kind))
+    except Exception as e:
+        print(f"Error creating {kind} derivative of {fieldfile.name}: {str(e)}")
+        return fieldfile.url
+
+
+def derivative_path(fieldfile, kind):
+    """Filesystem path of a derivative, or None if it doesn't exist"""
+    name = derivative_name(fieldfile.name, kind)
+    return fieldfile.storage.path(name) if fieldfile.storage.exists(name) else None
+
+
+def rename_derivatives(storage, old_name, new_name):
+    """Move the derivatives of a file that was renamed, dropping any the new name already has"""
+    for kind in DERIVATIVES:
+        old_path = storage.path(derivative_name(old_name, kind))
+        if not os.path.exists(old_path):
+            continue
+        new_path = storage.path(derivative_name(new_name, kind))
+        if os.path.exists(new_path):
+            os.remove(old_path)
+        else:
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.replace(old_path, new_path)
+
+
+def delete_derivatives(fieldfile):
+    for kind in DERIVATIVES:
+        name = derivative_name(fieldfile.name, kind)
+        if fieldfile.storage.exists(name):
+            fieldfile.storage.delete(name)
@@ -0,0 +1,143 @@
+import hashlib
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.db.models.functions import Substr
+
+from . import geohash
+from .metrics import cache_result
+from .models import UploadedFile
+
+'''
+    Disease counts on a map grid for /api/map/diseases/.
+
+    Uploads store the geohash of their coordinates. A bounding box becomes a short
+    list of geohash ranges (geohash.covering_ranges) and the uploads in those ranges
+    and the time window are counted per cell prefix and prediction in one GROUP BY.
+    Every column the query touches is in upload_file_map_idx, so it is answered
+    from the index without reading the table.
+
+    Cells are geohash cells and are returned whole: cells on the edge of the box
+    also count uploads just outside it.
+
+    Zoomed-out maps count every upload in the window whatever the index, so results
+    are cached for DISEASE_MAP_CACHE_TTL seconds; the default time window ends on
+    the current minute so the same map is requested by everyone within it.
+'''
+
+# Stored when the model failed on an upload, not a disease
+FAILED_PREDICTION = "Processing failed"
+
+
+def map_precision(south, west, north, east, max_cells=None):
+    """Finest geohash precision at which the box spans at most max_cells cells"""
+    max_cells = max_cells or settings.DISEASE_MAP_MAX_CELLS
+    # A box crossing the antimeridian has west > east
+    width = east - west if east >= west else east - west + 360
+    precision = 1
+    for candidate in range(1, settings.UPLOAD_GEOHASH_PRECISION + 1):
+        cell_height, cell_width = geohash.cell_size(candidate)
+        # A box can straddle one more cell than its size divided by the cell size
+        cells = (int((north - south) / cell_height) + 2) * (int(width / cell_width) + 2)
+        if cells > max_cells:
+            break
+        precision = candidate
+    return precision
+
+
+def bbox_ranges(south, west, north, east, precision):
+    """Geohash ranges of the box; a box crossing the antimeridian (west > east) is split in two"""
+    if west > east:
+        return (geohash.covering_ranges(south, west, north, 180.0, precision)
+                + geohash.covering_ranges(south, -180.0, north, east, precision))
+    return geohash.covering_ranges(south, west, north, east, precision)
+
+
+def ranges_filter(ranges):
+    """Q matching geohashes in any of the (start, stop) ranges"""
+    conditions = []
+    for start, stop in ranges:
+        condition = Q(geohash__gte=start) if start else Q(geohash__gt='')
+        if stop is not None:
+            condition &= Q(geohash__lt=stop)
+        conditions.append(condition)
+    return reduce(or_, conditions)
+
+
+def disease_map(south, west, north, east, since, until, precision=None, disease=None):
+    """
+    Predictions counted per geohash cell in a bounding box and time window
+
+    Args:
+        south, west, north, east: Bounding box in degrees
+        since, until: Upload time window, datetimes (until excluded)
+        precision: Geohash precision of the cells, by default the finest that keeps
+            the box within DISEASE_MAP_MAX_CELLS cells
+        disease: Only count this prediction
+
+    Returns:
+        dict: precision, cells (geohash, bounds, center, total, counts per
+        prediction) and totals per prediction
+
+    Raises:
+        ValueError: if precision gives more than DISEASE_MAP_MAX_CELLS cells
+    """
+    finest = map_precision(south, west, north, east)
+    if precision is None:
+        precision = finest
+    elif precision > finest:
+        raise ValueError(f"Precision {precision} gives too many cells for this box, use {finest} or less")
+
+    # Uploads without a prediction are dropped below rather than in SQL: with a
+    # "prediction IS NOT NULL" term SQLite may pick the public feed's partial index
+    # on uploaded_at and scan the whole window instead of the box
+    uploads = (UploadedFile.objects
+               .filter(ranges_filter(bbox_ranges(south, west, north, east, precision)),
+                       uploaded_at__gte=since, uploaded_at__lt=until))
+    if disease:
+        uploads = uploads.filter(prediction=disease)
+    rows = (uploads
+            .annotate(cell=Substr('geohash', 1, precision))
+            .values_list('cell', 'prediction')
+            .annotate(count=Count('*'))
+            .order_by())
+
+    cells = {}
+    totals = {}
+    for cell, prediction, count in rows:
+        if prediction is None or prediction == FAILED_PREDICTION:
+            continue
+        entry = cells.get(cell)
+        if entry is None:
+            min_lat, min_lon, max_lat, max_lon = geohash.bounds(cell)
+            entry = cells[cell] = {
+                'geohash': cell,
+                'bounds': [min_lat, min_lon, max_lat, max_lon],
+                'center': [(min_lat + max_lat) / 2, (min_lon + max_lon) / 2],
+                'total': 0,
+                'counts': {},
+            }
+        entry['counts'][prediction] = count
+        entry['total'] += count
+        totals[prediction] = totals.get(prediction, 0) + count
+
+    return {
+        'precision': precision,
+        'cells': sorted(cells.values(), key=lambda entry: entry['geohash']),
+        'totals': totals,
+    }
+
+
+def cached_disease_map(south, west, north, east, since, until, precision=None, disease=None):
+    """disease_map, served from the cache for DISEASE_MAP_CACHE_TTL seconds"""
+    params = f"{south}:{west}:{north}:{east}:{since.isoformat()}:{until.isoformat()}:{precision}:{disease}"
+    key = "disease-map:" + hashlib.sha1(params.encode()).hexdigest()
+    data = cache.get(key)
+    cache_result('disease_map', data is not None)
+    if data is None:
+        data = disease_map(south, west, north, east, since, until, precision=precision, disease=disease)
+        cache.set(key, data, settings.DISEASE_MAP_CACHE_TTL)
+    return data
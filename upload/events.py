@@ -0,0 +1,271 @@
+import asyncio
+import json
+import time
+import weakref
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .models import Farmer, Forecast, UploadedFile, UserEvent
+
+'''
+    Events pushed to the home page with server-sent events (/api/events/).
+
+    Upload workers and views write a UserEvent row when a job finishes or when a
+    forecast shown on a farmer's uploads changes; the table is the bus between
+    processes, as the job queue is. Event streams send a farmer the rows after the
+    last id their browser has seen, so a reconnecting page resumes where it was.
+
+    Under ASGI one task per process reads new rows and fans them out to every open
+    stream. Under WSGI a stream sends what is new and closes at once, so it never
+    holds a worker; the browser reconnects after EVENTS_WSGI_RECONNECT seconds and
+    the page polls its job's status_url meanwhile.
+
+    Forecasts are refreshed by the first upload worker process
+    (forecast_refresh_loop): each stale forecast cell that a connected farmer's
+    uploads use is fetched once, and the new forecast is pushed to everyone with
+    uploads in that cell.
+'''
+
+# Sent when the stream opens under ASGI: reconnect quickly after a network error
+ASGI_RECONNECT_MS = 5000
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def publish(farmer_id, kind, data):
+    return UserEvent.objects.create(farmer_id=farmer_id, kind=kind, data=data)
+
+
+def publish_job(job):
+    """Tell the job's farmer that it finished, with what job_status would return"""
+    from .jobs import job_info
+
+    farmer_id = job.batch.farmer_id if job.batch_id else job.uploaded_file.farmer_id
+    if farmer_id is None:
+        return None
+    return publish(farmer_id, UserEvent.KIND_JOB, dict(
+        job_info(job),
+        processed_info=job.result,
+        error=job.error or None,
+    ))
+
+
+def latest_event_id(farmer_id):
+    """Id of the farmer's newest event, where a new stream starts"""
+    return UserEvent.objects.filter(farmer_id=farmer_id).aggregate(Max('id'))['id__max'] or 0
+
+
+def format_event(event):
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {json.dumps(event.data)}\n\n"
+
+
+def format_position(event_id):
+    # An id without data moves the browser's Last-Event-ID without firing an event
+    return f"id: {event_id}\n\n"
+
+
+def stream_start(request):
+    """Event id a stream continues after: the browser's Last-Event-ID, ?since, or now"""
+    for value in (request.headers.get('Last-Event-ID'), request.GET.get('since')):
+        if value and value.isdigit():
+            return int(value)
+    return None
+
+
+def subscriber_threshold():
+    return timezone.now() - timedelta(seconds=settings.EVENTS_SUBSCRIBER_TTL / 2)
+
+
+def mark_subscribed(farmer_id):
+    """Record that the farmer has a stream open, at most one write per half TTL"""
+    Farmer.objects.filter(id=farmer_id).filter(
+        Q(events_seen_at__isnull=True) | Q(events_seen_at__lt=subscriber_threshold())
+    ).update(events_seen_at=timezone.now())
+
+
+def event_stream(farmer_id, after_id):
+    """
+    Server-sent events for WSGI. Sends what happened since after_id and closes: a
+    sync worker held by an open stream couldn't serve anyone else.
+    """
+    mark_subscribed(farmer_id)
+    if after_id is None:
+        after_id = latest_event_id(farmer_id)
+    yield f"retry: {settings.EVENTS_WSGI_RECONNECT * 1000}\n"
+    yield format_position(after_id)
+    for event in UserEvent.objects.filter(farmer_id=farmer_id, id__gt=after_id).order_by('id')[:100]:
+        yield format_event(event)
+
+
+class EventHub:
+    """
+    Reads new events for every farmer with an open stream in this process, in one
+    query per EVENTS_POLL_INTERVAL, and hands them to the streams' queues
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.last_id = None
+        self._task = None
+
+    async def subscribe(self, farmer_id):
+        if self.last_id is None:
+            self.last_id = (await UserEvent.objects.aaggregate(Max('id')))['id__max'] or 0
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(farmer_id, set()).add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return queue
+
+    def unsubscribe(self, farmer_id, queue):
+        queues = self.subscribers.get(farmer_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[farmer_id]
+
+    async def _run(self):
+        while self.subscribers:
+            await asyncio.sleep(settings.EVENTS_POLL_INTERVAL)
+            try:
+                # Read first and used as the upper bound, so the rows skipped below are
+                # only ones the filtered query has seen
+                newest = (await UserEvent.objects.aaggregate(Max('id')))['id__max'] or 0
+                events = [event async for event in UserEvent.objects
+                          .filter(id__gt=self.last_id, id__lte=newest, farmer_id__in=list(self.subscribers))
+                          .order_by('id')[:500]]
+            except Exception as e:
+                print(f"Error reading events: {str(e)}")
+                continue
+            for event in events:
+                for queue in self.subscribers.get(event.farmer_id, ()):
+                    queue.put_nowait(event)
+            if len(events) == 500:
+                self.last_id = events[-1].id
+            else:
+                # Everything up to newest was read; rows for farmers without a stream are never needed
+                self.last_id = max(self.last_id, newest)
+        # Start from the newest event again when the next stream opens
+        self.last_id = None
+
+
+def get_hub():
+    """The event hub of the running event loop"""
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = EventHub()
+    return hub
+
+
+async def aevent_stream(farmer_id, after_id):
+    """Server-sent events for ASGI, open until the browser disconnects"""
+    hub = get_hub()
+    queue = await hub.subscribe(farmer_id)
+    try:
+        await Farmer.objects.filter(id=farmer_id).aupdate(events_seen_at=timezone.now())
+        if after_id is None:
+            after_id = (await UserEvent.objects.filter(farmer_id=farmer_id).aaggregate(Max('id')))['id__max'] or 0
+        yield f"retry: {ASGI_RECONNECT_MS}\n"
+        yield format_position(after_id)
+
+        # Anything the browser missed while it was away, then what the hub delivers
+        async for event in UserEvent.objects.filter(farmer_id=farmer_id, id__gt=after_id).order_by('id'):
+            yield format_event(event)
+            after_id = event.id
+
+        seen_at = time.monotonic()
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), settings.EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                if time.monotonic() - seen_at > settings.EVENTS_SUBSCRIBER_TTL / 2:
+                    await Farmer.objects.filter(id=farmer_id).aupdate(events_seen_at=timezone.now())
+                    seen_at = time.monotonic()
+                continue
+            if event.id > after_id:
+                yield format_event(event)
+                after_id = event.id
+    finally:
+        hub.unsubscribe(farmer_id, queue)
+
+
+def forecast_payload(data):
+    # "updated" is when the forecast was formatted, not a change in the forecast
+    return {key: value for key, value in data.items() if key != 'updated'}
+
+
+def refresh_subscribed_forecasts():
+    """
+    Refetch the stale forecasts of connected farmers' uploads, once per cell, point
+    the uploads at the new forecast and push it to the farmers where it changed
+
+    Returns:
+        int: number of forecast cells fetched
+    """
+    from .forecast import stored_forecast
+
+    now = timezone.now()
+    files = (UploadedFile.objects
+             .filter(farmer__events_seen_at__gte=now - timedelta(seconds=settings.EVENTS_SUBSCRIBER_TTL),
+                     forecast__fetched_at__lt=now - timedelta(seconds=settings.FORECAST_CACHE_TTL))
+             .values_list('id', 'farmer_id', 'forecast_id'))
+    files_by_forecast = {}
+    for file_id, farmer_id, forecast_id in files:
+        files_by_forecast.setdefault(forecast_id, []).append((file_id, farmer_id))
+
+    fresh = {}
+    events = []
+    for old in Forecast.objects.filter(id__in=files_by_forecast):
+        cell = (old.geohash, old.days)
+        if cell not in fresh:
+            # The stored location name saves a reverse geocode per cell
+            fresh[cell] = stored_forecast(old.latitude, old.longitude, old.days,
+                                          location_name=old.data.get('location'))
+        new = fresh[cell]
+        if not new.pk:
+            # Fetching failed, try again next time
+            continue
+
+        file_farmers = files_by_forecast[old.id]
+        if new.pk != old.pk:
+            # A new day's forecast, today's was updated in place
+            UploadedFile.objects.filter(id__in=[file_id for file_id, _ in file_farmers]).update(forecast=new)
+        if forecast_payload(new.data) == forecast_payload(old.data):
+            continue
+
+        by_farmer = {}
+        for file_id, farmer_id in file_farmers:
+            by_farmer.setdefault(farmer_id, []).append(file_id)
+        events.extend(
+            UserEvent(farmer_id=farmer_id, kind=UserEvent.KIND_FORECAST, data={'files': file_ids, 'forecast': new.data})
+            for farmer_id, file_ids in by_farmer.items()
+        )
+
+    UserEvent.objects.bulk_create(events)
+    return len(fresh)
+
+
+def prune_events():
+    UserEvent.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=settings.EVENTS_RETENTION)).delete()
+
+
+def forecast_refresh_loop(stop_event=None):
+    """Refresh subscribed forecasts and drop old events, every EVENTS_FORECAST_REFRESH_INTERVAL"""
+    from django.db import close_old_connections
+
+    while stop_event is None or not stop_event.is_set():
+        close_old_connections()
+        try:
+            cells = refresh_subscribed_forecasts()
+            if cells:
+                print(f"Refreshed {cells} forecast(s) for connected farmers")
+            prune_events()
+        except Exception as e:
+            print(f"Error refreshing forecasts: {str(e)}")
+        time.sleep(settings.EVENTS_FORECAST_REFRESH_INTERVAL)
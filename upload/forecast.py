@@ -1,149 +1,367 @@
-import requests
-import json
-import os
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+
+from . import geohash
+from .models import Forecast
+from .geocode_cache import acached_location_name, cached_location_name
+from .http_client import aget_json, get_json
+from .metrics import cache_result, timed
 
 '''
-    Here all we do is get the weather forecast for the days mentioned in the request
+    Weather forecasts for upload locations.
+
+    This is the single place forecasts are fetched and formatted: the upload
+    pipeline (weather_forecast) and the /api/forecast/ endpoint (get_forecast)
+    both go through fetch_forecast, so they share the pooled HTTP client and its
+    response cache.
+
+    The functions starting with `a` are the async versions used by the async views.
+    They fetch the forecast and reverse geocode the location at the same time, so a
+    lookup takes as long as the slower of the two requests instead of their sum.
 '''
 
-def weather_forecast(longitude, latitude, days):
+UNITS = ("fahrenheit", "celsius")
+
+def forecast_params(latitude, longitude, days, units="fahrenheit"):
+    """Open-Meteo query parameters for a daily forecast in the given units"""
+    precip_unit = "inch" if units == "fahrenheit" else "mm"
+    windspeed_unit = "mph" if units == "fahrenheit" else "kmh"
+
+    return {
+        "latitude": latitude,
+        "longitude": longitude,
+        "temperature_unit": units,
+        "precipitation_unit": precip_unit,
+        "windspeed_unit": windspeed_unit,
+        "timezone": "auto",
+        "forecast_days": days,
+        "daily": [
+            "temperature_2m_max",
+            "temperature_2m_min",
+            "precipitation_sum",
+            "precipitation_probability_max",
+            "weathercode",
+            "sunrise",
+            "sunset"
+        ],
+        "hourly": [
+            "relative_humidity_2m",
+            "dew_point_2m"
+        ]
+    }
+
+def fetch_forecast(latitude, longitude, days, units="fahrenheit"):
+    """Raw Open-Meteo forecast response, served from the HTTP cache when fresh"""
+    if units not in UNITS:
+        raise ValueError(f"Unsupported units: {units}")
+    params = forecast_params(latitude, longitude, days, units)
+    with timed('forecast_fetch'):
+        return get_json(settings.OPEN_METEO_FORECAST_URL, params=params, ttl=settings.FORECAST_CACHE_TTL)
+
+def get_forecast(latitude, longitude, days, units="fahrenheit", location_name=None):
+    """
+    Daily forecast for a location, formatted for the UI and the API
+
+    Args:
+        latitude, longitude: Location
+        days: Number of forecast days (1-16)
+        units: "fahrenheit" or "celsius"
+        location_name: Already resolved place name, looked up if not given
+
+    Returns:
+        dict: location, units, days and updated timestamp
+
+    Raises:
+        requests.RequestException: if the forecast can't be fetched
+    """
+    data = fetch_forecast(latitude, longitude, days, units)
+    if location_name is None:
+        location_name = get_location_name(latitude, longitude)
+    return format_forecast_data(data, location_name, units)
+
+def weather_forecast(longitude, latitude, days, location_name=None):
+    """
+    Forecast stored with an upload. Always covers at least 14 days, and returns an
+    empty forecast with an error message instead of raising.
+    """
     try:
-        # Ensure the days parameter is valid
         # We need at least 14 days for showing day 7 and day 14
-        days = max(int(days), 14)  # Always fetch at least 14 days
-        
-        # Direct call to Open-Meteo API instead of going through backend
-        url = "https://api.open-meteo.com/v1/forecast"
-        
-        # Set units
-        units = "fahrenheit"
-        precip_unit = "inch" if units == "fahrenheit" else "mm"
-        windspeed_unit = "mph" if units == "fahrenheit" else "kmh"
-        
-        # Parameters for the API request
-        params = {
-            "latitude": latitude,
-            "longitude": longitude,
-            "temperature_unit": units,
-            "precipitation_unit": precip_unit,
-            "windspeed_unit": windspeed_unit,
-            "timezone": "auto",
-            "forecast_days": days,
-            "daily": [
-                "temperature_2m_max",
-                "temperature_2m_min",
-                "precipitation_sum",
-                "precipitation_probability_max",
-                "weathercode",
-                "sunrise",
-                "sunset"
-            ],
-            "hourly": [
-                "relative_humidity_2m"
-            ]
-        }
-        
-        print(f"Requesting forecast from Open-Meteo API directly")
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        # Format the response to match our expected structure
-        location_name = get_location_name(latitude, longitude)
-        formatted_data = format_forecast_data(data, location_name, units)
-        return formatted_data
+        days = max(int(days), 14)
+        return get_forecast(latitude, longitude, days, "fahrenheit", location_name)
         
     except Exception as e:
         import traceback
         print(f"Error in weather_forecast: {str(e)}")
         print(traceback.format_exc())
-        
-        # Return a minimal data structure that won't break the UI
-        return {
-            "location": f"Location at {latitude:.4f}, {longitude:.4f}",
-            "units": {
-                "temperature": "fahrenheit",
-                "precipitation": "inches"
-            },
-            "days": [],
-            "updated": "Error fetching forecast",
-            "error": str(e)
-        }
+        return forecast_error(latitude, longitude, location_name, e)
+
+def forecast_error(latitude, longitude, location_name, error):
+    """A minimal forecast that won't break the UI, for when fetching failed"""
+    return {
+        "location": location_name or f"Location at {latitude:.4f}, {longitude:.4f}",
+        "units": {
+            "temperature": "fahrenheit",
+            "precipitation": "inches"
+        },
+        "days": [],
+        "updated": "Error fetching forecast",
+        "error": str(error)
+    }
+
+def stored_forecast(latitude, longitude, days, location_name=None):
+    """
+    Forecast row for an upload. Reuses today's forecast for the same geohash cell
+    while it is fresher than FORECAST_CACHE_TTL, otherwise fetches and stores a new one.
+
+    Returns:
+        Forecast: saved row, or an unsaved one holding the error data if fetching failed
+    """
+    days = max(int(days), 14)
+    now = timezone.now()
+    lookup = forecast_lookup(latitude, longitude, days, now)
+
+    forecast = fresh_forecasts(lookup, now).first()
+    cache_result('forecast', forecast is not None)
+    if forecast is not None:
+        return forecast
+
+    data = weather_forecast(longitude, latitude, days, location_name)
+    if data.get('error'):
+        return Forecast(latitude=latitude, longitude=longitude, data=data, fetched_at=now, **lookup)
+
+    values = {'latitude': latitude, 'longitude': longitude, 'data': data, 'fetched_at': now}
+    try:
+        forecast, _ = Forecast.objects.update_or_create(defaults=values, **lookup)
+    except IntegrityError:
+        # Another worker stored the same forecast at the same moment
+        forecast = Forecast.objects.get(**lookup)
+    return forecast
+
+def forecast_lookup(latitude, longitude, days, now):
+    """Fields identifying the shared Forecast row for an upload's cell and day"""
+    key = geohash.encode(float(latitude), float(longitude), settings.FORECAST_GEOHASH_PRECISION)
+    return {'geohash': key, 'units': 'fahrenheit', 'days': days, 'issued_on': timezone.localdate(now)}
+
+def fresh_forecasts(lookup, now):
+    return Forecast.objects.filter(fetched_at__gte=now - timedelta(seconds=settings.FORECAST_CACHE_TTL), **lookup)
 
 def get_location_name(latitude, longitude):
-    """Get location name using a free reverse geocoding service"""
+    """Get location name for a point, using the geocode cache before the geocoding services"""
+    try:
+        with timed('geocode'):
+            name = cached_location_name(latitude, longitude, reverse_geocode)
+    except Exception as e:
+        print(f"Error in get_location_name: {str(e)}")
+        name = None
+
+    # Fallback to coordinates if the location couldn't be resolved
+    return name or f"Location at {latitude:.4f}, {longitude:.4f}"
+
+def reverse_geocode(latitude, longitude):
+    """Get location name using a free reverse geocoding service, or None if it can't be resolved"""
     try:
         # Try the Open-Meteo Geocoding API first (more detailed)
-        url = f"https://geocoding-api.open-meteo.com/v1/search?latitude={latitude}&longitude={longitude}&count=1"
-        response = requests.get(url, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if 'results' in data and len(data['results']) > 0:
-                result = data['results'][0]
-                name = result.get('name', 'Unknown')
-                admin1 = result.get('admin1', '')  # State/Province
-                admin2 = result.get('admin2', '')  # County/Region
-                country = result.get('country', '')
+        try:
+            data = get_json(
+                settings.OPEN_METEO_GEOCODING_URL,
+                params=open_meteo_geocoding_params(latitude, longitude),
+                ttl=settings.GEOCODE_CACHE_TTL,
+            )
+        except Exception as open_meteo_error:
+            print(f"Open-Meteo geocoding failed: {str(open_meteo_error)}")
+            data = {}
+
+        name = open_meteo_place_name(data)
+        if name:
+            return name
                 
-                # Format the location name based on available data
-                if country:
-                    if admin1:
-                        # City, State/Province, Country (e.g., San Francisco, California, USA)
-                        return f"{name}, {admin1}, {country}"
-                    else:
-                        # City, Country (e.g., Paris, France)
-                        return f"{name}, {country}"
-                elif admin1:
-                    # City, State/Province (if country is missing for some reason)
-                    return f"{name}, {admin1}"
-                else:
-                    # Just city name
-                    return name
-                    
         # Fallback to Nominatim if Open-Meteo doesn't return good results
         try:
-            nominatim_url = f"https://nominatim.openstreetmap.org/reverse?lat={latitude}&lon={longitude}&format=json"
-            headers = {
-                'User-Agent': 'Weather Forecast App/1.0'  # Required by Nominatim API
-            }
-            nominatim_response = requests.get(nominatim_url, headers=headers, timeout=10)
-            
-            if nominatim_response.status_code == 200:
-                nominatim_data = nominatim_response.json()
-                if 'address' in nominatim_data:
-                    address = nominatim_data['address']
-                    
-                    # Extract city name (try multiple fields)
-                    city = (address.get('city') or address.get('town') or 
-                           address.get('village') or address.get('hamlet') or 
-                           address.get('municipality') or address.get('county'))
-                    
-                    state = address.get('state')
-                    country = address.get('country')
-                    
-                    if city and country:
-                        if state:
-                            return f"{city}, {state}, {country}"
-                        else:
-                            return f"{city}, {country}"
-                    elif city:
-                        return city
-                    elif 'display_name' in nominatim_data:
-                        # Use display_name as a last resort
-                        return nominatim_data['display_name']
+            nominatim_data = get_json(
+                settings.NOMINATIM_REVERSE_URL,
+                params=nominatim_params(latitude, longitude),
+                headers=NOMINATIM_HEADERS,
+                ttl=settings.GEOCODE_CACHE_TTL,
+            )
+            return nominatim_place_name(nominatim_data)
         except Exception as nominatim_error:
             print(f"Nominatim fallback failed: {str(nominatim_error)}")
-            # Continue to the final fallback
         
-        # Final fallback to coordinates if both geocoding attempts fail
-        return f"Location at {latitude:.4f}, {longitude:.4f}"
+        # Both geocoding attempts failed
+        return None
     
     except Exception as e:
-        print(f"Error in get_location_name: {str(e)}")
-        # If any error occurs, return a fallback location name
-        return f"Location at {latitude:.4f}, {longitude:.4f}"
+        print(f"Error in reverse_geocode: {str(e)}")
+        return None
+
+# Required by Nominatim API
+NOMINATIM_HEADERS = {'User-Agent': 'Weather Forecast App/1.0'}
+
+def open_meteo_geocoding_params(latitude, longitude):
+    return {"latitude": latitude, "longitude": longitude, "count": 1}
+
+def nominatim_params(latitude, longitude):
+    return {"lat": latitude, "lon": longitude, "format": "json"}
+
+def open_meteo_place_name(data):
+    """Place name from an Open-Meteo geocoding response, or None if it has no results"""
+    if 'results' in data and len(data['results']) > 0:
+        result = data['results'][0]
+        name = result.get('name', 'Unknown')
+        admin1 = result.get('admin1', '')  # State/Province
+        admin2 = result.get('admin2', '')  # County/Region
+        country = result.get('country', '')
+        
+        # Format the location name based on available data
+        if country:
+            if admin1:
+                # City, State/Province, Country (e.g., San Francisco, California, USA)
+                return f"{name}, {admin1}, {country}"
+            else:
+                # City, Country (e.g., Paris, France)
+                return f"{name}, {country}"
+        elif admin1:
+            # City, State/Province (if country is missing for some reason)
+            return f"{name}, {admin1}"
+        else:
+            # Just city name
+            return name
+    return None
+
+def nominatim_place_name(nominatim_data):
+    """Place name from a Nominatim reverse geocoding response, or None"""
+    if 'address' in nominatim_data:
+        address = nominatim_data['address']
+        
+        # Extract city name (try multiple fields)
+        city = (address.get('city') or address.get('town') or 
+               address.get('village') or address.get('hamlet') or 
+               address.get('municipality') or address.get('county'))
+        
+        state = address.get('state')
+        country = address.get('country')
+        
+        if city and country:
+            if state:
+                return f"{city}, {state}, {country}"
+            else:
+                return f"{city}, {country}"
+        elif city:
+            return city
+        elif 'display_name' in nominatim_data:
+            # Use display_name as a last resort
+            return nominatim_data['display_name']
+    return None
+
+async def afetch_forecast(latitude, longitude, days, units="fahrenheit"):
+    """Async fetch_forecast, sharing its HTTP cache entries"""
+    if units not in UNITS:
+        raise ValueError(f"Unsupported units: {units}")
+    params = forecast_params(latitude, longitude, days, units)
+    with timed('forecast_fetch'):
+        return await asyncio.wait_for(
+            aget_json(settings.OPEN_METEO_FORECAST_URL, params=params, ttl=settings.FORECAST_CACHE_TTL),
+            settings.HTTP_CLIENT_TOTAL_TIMEOUT,
+        )
+
+async def aget_forecast(latitude, longitude, days, units="fahrenheit", location_name=None):
+    """
+    Async get_forecast. The location name is looked up while the forecast is fetched.
+
+    Args:
+        location_name: Place name, or an asyncio Task resolving to it when the
+            caller already started the lookup (see alocate_upload in jobs.py)
+
+    Raises:
+        httpx.HTTPError, asyncio.TimeoutError: if the forecast can't be fetched
+    """
+    if location_name is None:
+        location_name = asyncio.ensure_future(aget_location_name(latitude, longitude))
+    if isinstance(location_name, str):
+        data = await afetch_forecast(latitude, longitude, days, units)
+    else:
+        data, location_name = await asyncio.gather(afetch_forecast(latitude, longitude, days, units), location_name)
+    return format_forecast_data(data, location_name, units)
+
+async def aweather_forecast(longitude, latitude, days, location_name=None):
+    """Async weather_forecast, also returns the error forecast instead of raising"""
+    try:
+        return await aget_forecast(latitude, longitude, max(int(days), 14), "fahrenheit", location_name)
+    except Exception as e:
+        print(f"Error in weather_forecast: {str(e)}")
+        if isinstance(location_name, asyncio.Future):
+            # Never raises, see aget_location_name
+            location_name = await location_name
+        return forecast_error(latitude, longitude, location_name, e)
+
+async def astored_forecast(latitude, longitude, days, location_name=None):
+    """Async stored_forecast, see aget_forecast for location_name"""
+    days = max(int(days), 14)
+    now = timezone.now()
+    lookup = forecast_lookup(latitude, longitude, days, now)
+
+    forecast = await fresh_forecasts(lookup, now).afirst()
+    cache_result('forecast', forecast is not None)
+    if forecast is not None:
+        return forecast
+
+    data = await aweather_forecast(longitude, latitude, days, location_name)
+    if data.get('error'):
+        return Forecast(latitude=latitude, longitude=longitude, data=data, fetched_at=now, **lookup)
+
+    values = {'latitude': latitude, 'longitude': longitude, 'data': data, 'fetched_at': now}
+    try:
+        forecast, _ = await Forecast.objects.aupdate_or_create(defaults=values, **lookup)
+    except IntegrityError:
+        # Another worker stored the same forecast at the same moment
+        forecast = await Forecast.objects.aget(**lookup)
+    return forecast
+
+async def aget_location_name(latitude, longitude):
+    """Async get_location_name. Never raises, falls back to the coordinates."""
+    try:
+        with timed('geocode'):
+            name = await asyncio.wait_for(
+                acached_location_name(latitude, longitude, areverse_geocode),
+                settings.HTTP_CLIENT_TOTAL_TIMEOUT,
+            )
+    except Exception as e:
+        print(f"Error in get_location_name: {str(e) or type(e).__name__}")
+        name = None
+    return name or f"Location at {latitude:.4f}, {longitude:.4f}"
+
+async def areverse_geocode(latitude, longitude):
+    """Async reverse_geocode: Open-Meteo, then Nominatim if it has no result"""
+    try:
+        data = await aget_json(
+            settings.OPEN_METEO_GEOCODING_URL,
+            params=open_meteo_geocoding_params(latitude, longitude),
+            ttl=settings.GEOCODE_CACHE_TTL,
+        )
+    except Exception as open_meteo_error:
+        print(f"Open-Meteo geocoding failed: {str(open_meteo_error)}")
+        data = {}
+
+    name = open_meteo_place_name(data)
+    if name:
+        return name
+
+    try:
+        nominatim_data = await aget_json(
+            settings.NOMINATIM_REVERSE_URL,
+            params=nominatim_params(latitude, longitude),
+            headers=NOMINATIM_HEADERS,
+            ttl=settings.GEOCODE_CACHE_TTL,
+        )
+        return nominatim_place_name(nominatim_data)
+    except Exception as nominatim_error:
+        print(f"Nominatim fallback failed: {str(nominatim_error)}")
+        return None
 
 def format_forecast_data(api_data, location_name, units="fahrenheit"):
     """Format the Open-Meteo API data into our application's format"""
@@ -159,22 +377,10 @@ def format_forecast_data(api_data, location_name, units="fahrenheit"):
     daily_forecasts = []
     if 'daily' in api_data and 'time' in api_data['daily']:
         daily = api_data['daily']
+        # Humidity statistics for every day, computed in one pass over the hourly data
+        day_stats = summarize_hourly_by_day(api_data.get('hourly', {}), daily['time'])
         for i, date_str in enumerate(daily['time']):
-            # Calculate average humidity for the day
-            avg_humidity = None
-            if 'hourly' in api_data and 'time' in api_data['hourly'] and 'relative_humidity_2m' in api_data['hourly']:
-                # Filter hourly data for this day
-                hourly_times = api_data['hourly']['time']
-                hourly_humidity = api_data['hourly']['relative_humidity_2m']
-                
-                day_humidity = []
-                for j, hourly_time in enumerate(hourly_times):
-                    if hourly_time.startswith(date_str) and j < len(hourly_humidity):
-                        if hourly_humidity[j] is not None:
-                            day_humidity.append(hourly_humidity[j])
-                
-                if day_humidity:
-                    avg_humidity = round(sum(day_humidity) / len(day_humidity))
+            stats = day_stats[i]
             
             # Get weather description
             weather_code = daily['weathercode'][i] if 'weathercode' in daily and i < len(daily['weathercode']) else None
@@ -186,7 +392,11 @@ def format_forecast_data(api_data, location_name, units="fahrenheit"):
                 "date": formatted_date,
                 "temp_high": daily['temperature_2m_max'][i] if 'temperature_2m_max' in daily and i < len(daily['temperature_2m_max']) else None,
                 "temp_low": daily['temperature_2m_min'][i] if 'temperature_2m_min' in daily and i < len(daily['temperature_2m_min']) else None,
-                "humidity": avg_humidity,
+                "humidity": stats['humidity'],
+                "humidity_min": stats['humidity_min'],
+                "humidity_max": stats['humidity_max'],
+                "leaf_wetness_hours": stats['leaf_wetness_hours'],
+                "dew_point": stats['dew_point'],
                 "precipitation": {
                     "amount": daily['precipitation_sum'][i] if 'precipitation_sum' in daily and i < len(daily['precipitation_sum']) else 0,
                     "chance": daily['precipitation_probability_max'][i] if 'precipitation_probability_max' in daily and i < len(daily['precipitation_probability_max']) else 0
@@ -207,6 +417,75 @@ def format_forecast_data(api_data, location_name, units="fahrenheit"):
         "updated": datetime.now().strftime('%Y-%m-%d %H:%M')
     }
 
+# Relative humidity (%) at or above which leaves are assumed to stay wet. Hours of
+# leaf wetness drive infection risk for gray leaf spot and common rust.
+LEAF_WETNESS_HUMIDITY = 90
+
+def summarize_hourly_by_day(hourly, dates):
+    """
+    Aggregate hourly Open-Meteo series into per-day statistics.
+
+    Each hourly timestamp is mapped to its day once and the statistics for all days
+    are computed together with NumPy, instead of scanning every hour for every day.
+
+    Args:
+        hourly: The "hourly" block of an Open-Meteo response (time + series)
+        dates: Daily dates ("YYYY-MM-DD") to report, in order
+
+    Returns:
+        list of dict: one dict per date with humidity (mean), humidity_min,
+        humidity_max, leaf_wetness_hours and dew_point (mean). Values are None
+        when there is no hourly data for that day.
+    """
+    empty = {'humidity': None, 'humidity_min': None, 'humidity_max': None,
+             'leaf_wetness_hours': None, 'dew_point': None}
+    summaries = [dict(empty) for _ in dates]
+
+    times = hourly.get('time') or []
+    humidity = hourly.get('relative_humidity_2m')
+    if not dates or not times or humidity is None:
+        return summaries
+
+    day_count = len(dates)
+    day_index = {date_str: i for i, date_str in enumerate(dates)}
+    # Hourly timestamps look like "2025-04-04T13:00", the first 10 characters are the day
+    hour_days = np.fromiter((day_index.get(t[:10], -1) for t in times), dtype=np.int64, count=len(times))
+
+    def by_day(series):
+        # None entries become NaN and are dropped along with hours outside `dates`
+        n = min(len(series), len(hour_days))
+        values = np.array(series[:n], dtype=np.float64)
+        days = hour_days[:n]
+        keep = (days >= 0) & ~np.isnan(values)
+        return days[keep], values[keep]
+
+    days, values = by_day(humidity)
+    counts = np.bincount(days, minlength=day_count)
+    sums = np.bincount(days, weights=values, minlength=day_count)
+    mins = np.full(day_count, np.inf)
+    np.minimum.at(mins, days, values)
+    maxs = np.full(day_count, -np.inf)
+    np.maximum.at(maxs, days, values)
+    wet_hours = np.bincount(days, weights=values >= LEAF_WETNESS_HUMIDITY, minlength=day_count)
+
+    dew_counts = dew_sums = None
+    if hourly.get('dew_point_2m') is not None:
+        dew_days, dew_values = by_day(hourly['dew_point_2m'])
+        dew_counts = np.bincount(dew_days, minlength=day_count)
+        dew_sums = np.bincount(dew_days, weights=dew_values, minlength=day_count)
+
+    for i in range(day_count):
+        summary = summaries[i]
+        if counts[i]:
+            summary['humidity'] = round(float(sums[i]) / int(counts[i]))
+            summary['humidity_min'] = round(float(mins[i]))
+            summary['humidity_max'] = round(float(maxs[i]))
+            summary['leaf_wetness_hours'] = int(wet_hours[i])
+        if dew_counts is not None and dew_counts[i]:
+            summary['dew_point'] = round(float(dew_sums[i]) / int(dew_counts[i]), 1)
+
+    return summaries
+
 def get_weather_description(code):
     """Convert weather code to description"""
     weather_codes = {
@@ -31,4 +31,10 @@ class UploadFileForm(forms.ModelForm):
                 'step': 'any',
                 'placeholder': 'Enter longitude'
             })
-        } 
\ No newline at end of file
+        }
+
+class BulkUploadForm(forms.Form):
+    """Fields sent with a bulk upload; the images themselves are read by the upload handler"""
+    latitude = forms.FloatField(required=False, min_value=-90, max_value=90)
+    longitude = forms.FloatField(required=False, min_value=-180, max_value=180)
+    days = forms.IntegerField(required=False, min_value=1, max_value=16)
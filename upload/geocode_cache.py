@@ -0,0 +1,119 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from . import geohash
+from .metrics import cache_result
+from .models import GeocodeCache
+
+'''
+    Two-tier cache for reverse geocoding results.
+
+    Lookups are bucketed by geohash, so every photo taken on the same plot maps to
+    the same key. A per-process LRU answers repeat lookups from memory; behind it
+    the GeocodeCache table keeps names across restarts and shares them between
+    processes. Only misses in both tiers go out to the geocoding APIs.
+'''
+
+
+class LRUCache:
+    """Small thread-safe least-recently-used mapping"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+memory_cache = LRUCache(settings.GEOCODE_MEMORY_CACHE_SIZE)
+
+
+def cell_key(latitude, longitude):
+    return geohash.encode(float(latitude), float(longitude), settings.GEOCODE_GEOHASH_PRECISION)
+
+
+def cached_location_name(latitude, longitude, resolve):
+    """
+    Location name for a point, served from the cache when its geohash cell is known
+
+    Args:
+        latitude, longitude: Point to look up
+        resolve: Called as resolve(latitude, longitude) on a cache miss. Returns the
+            place name, or None if it could not be resolved (None is not cached).
+
+    Returns:
+        str or None: the place name
+    """
+    key = cell_key(latitude, longitude)
+
+    name = memory_cache.get(key)
+    cache_result('geocode_memory', name is not None)
+    if name is not None:
+        return name
+
+    name = GeocodeCache.objects.filter(geohash=key).values_list('location_name', flat=True).first()
+    cache_result('geocode_db', name is not None)
+    if name is not None:
+        memory_cache.set(key, name)
+        return name
+
+    name = resolve(latitude, longitude)
+    if name:
+        name = name[:200]
+        try:
+            GeocodeCache.objects.get_or_create(geohash=key, defaults={'location_name': name})
+        except IntegrityError:
+            # Another process stored the same cell at the same time
+            pass
+        memory_cache.set(key, name)
+    return name
+
+
+async def acached_location_name(latitude, longitude, resolve):
+    """Async version of cached_location_name, `resolve` is a coroutine function"""
+    key = cell_key(latitude, longitude)
+
+    name = memory_cache.get(key)
+    cache_result('geocode_memory', name is not None)
+    if name is not None:
+        return name
+
+    name = await GeocodeCache.objects.filter(geohash=key).values_list('location_name', flat=True).afirst()
+    cache_result('geocode_db', name is not None)
+    if name is not None:
+        memory_cache.set(key, name)
+        return name
+
+    name = await resolve(latitude, longitude)
+    if name:
+        name = name[:200]
+        try:
+            await GeocodeCache.objects.aget_or_create(geohash=key, defaults={'location_name': name})
+        except IntegrityError:
+            # Another process stored the same cell at the same time
+            pass
+        memory_cache.set(key, name)
+    return name
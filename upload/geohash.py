@@ -0,0 +1,123 @@
+'''
+    Geohash encoding. A geohash names a rectangular cell on the map; each extra
+    character splits the cell into 32 smaller ones (precision 5 is about 4.9 km,
+    6 about 1.2 km, 7 about 150 m). Nearby points share a prefix, which makes
+    geohashes usable as cache keys and index columns for locations.
+'''
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+DECODE_MAP = {char: i for i, char in enumerate(BASE32)}
+
+
+def encode(latitude, longitude, precision=7):
+    """Geohash of the cell containing (latitude, longitude)"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # Bits alternate between longitude (even) and latitude (odd)
+
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits = bits << 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits = bits << 1
+                lat_range[1] = mid
+        even = not even
+
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(chars)
+
+
+def bounds(geohash):
+    """Bounding box of a geohash cell as (min_lat, min_lon, max_lat, max_lon)"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+
+    for char in geohash:
+        value = DECODE_MAP[char]
+        for shift in range(4, -1, -1):
+            bit = (value >> shift) & 1
+            target = lon_range if even else lat_range
+            mid = (target[0] + target[1]) / 2
+            if bit:
+                target[0] = mid
+            else:
+                target[1] = mid
+            even = not even
+
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def decode(geohash):
+    """Center point of a geohash cell as (latitude, longitude)"""
+    min_lat, min_lon, max_lat, max_lon = bounds(geohash)
+    return (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+
+
+def cell_size(precision):
+    """Height and width in degrees of the cells of a precision, as (lat, lon)"""
+    bits = 5 * precision
+    # Longitude gets the extra bit when the count is odd
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def next_prefix(geohash):
+    """First geohash after every cell starting with `geohash`, or None past the last one"""
+    for i in range(len(geohash) - 1, -1, -1):
+        value = DECODE_MAP[geohash[i]]
+        if value < 31:
+            return geohash[:i] + BASE32[value + 1]
+    return None
+
+
+def covering_ranges(south, west, north, east, precision):
+    """
+    Geohash ranges covering a bounding box with cells of the given precision
+
+    Cells entirely inside the box are taken whole at the coarsest level possible, so
+    a box needs about as many ranges as cells along its edge rather than inside it.
+    Edge cells are included whole. BASE32 is in ASCII order, so the ranges work as
+    string comparisons on a geohash column.
+
+    Returns:
+        list of (start, stop): geohashes in [start, stop); stop is None for no upper bound
+    """
+    ranges = []
+
+    def visit(prefix):
+        min_lat, min_lon, max_lat, max_lon = bounds(prefix)
+        if min_lat > north or max_lat <= south or min_lon > east or max_lon <= west:
+            return
+        inside = min_lat >= south and max_lat <= north and min_lon >= west and max_lon <= east
+        if inside or len(prefix) == precision:
+            stop = next_prefix(prefix) if prefix else None
+            if ranges and ranges[-1][1] == prefix:
+                # Continues the previous range
+                ranges[-1] = (ranges[-1][0], stop)
+            else:
+                ranges.append((prefix, stop))
+            return
+        for char in BASE32:
+            visit(prefix + char)
+
+    visit('')
+    return ranges
@@ -0,0 +1,241 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .metrics import cache_result, metrics
+
+'''
+    Shared HTTP client for the weather and geocoding APIs.
+
+    One keep-alive session per process with connection pooling, retries with
+    exponential backoff, a cap on concurrent requests per host, and a response
+    cache shared by all worker processes. Coordinates are rounded before they are
+    sent so that uploads from the same field hit the same cache entry.
+
+    aget_json is the same client for async views: an httpx AsyncClient per event
+    loop with the same pool size, retries, per-host limits, timeout and cache. The
+    client is closed with its loop: asyncio.run (used by uvicorn and asgiref's
+    async_to_sync) closes the loop's suspended async generators first, and one of
+    them owns the client.
+'''
+
+COORDINATE_PARAMS = ('latitude', 'longitude', 'lat', 'lon')
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+# Clients and semaphores belong to the event loop they were created on
+_async_state = weakref.WeakKeyDictionary()
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def get_session():
+    """The process-wide requests session, recreated after a fork"""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                retry = Retry(
+                    total=settings.HTTP_CLIENT_RETRIES,
+                    backoff_factor=settings.HTTP_CLIENT_BACKOFF,
+                    status_forcelist=RETRY_STATUSES,
+                    allowed_methods=('GET',),
+                    respect_retry_after_header=True,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=10,
+                    pool_maxsize=settings.HTTP_CLIENT_POOL_SIZE,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['User-Agent'] = settings.HTTP_CLIENT_USER_AGENT
+                _session = session
+                _session_pid = pid
+    return _session
+
+
+@contextmanager
+def host_slot(host):
+    """Limit how many requests this process has in flight to one host"""
+    limiter = _host_limits.get(host)
+    if limiter is None:
+        with _host_limits_lock:
+            limiter = _host_limits.get(host)
+            if limiter is None:
+                limit = settings.HTTP_CLIENT_HOST_CONCURRENCY.get(host, settings.HTTP_CLIENT_DEFAULT_CONCURRENCY)
+                limiter = threading.BoundedSemaphore(limit)
+                _host_limits[host] = limiter
+    with limiter:
+        yield
+
+
+def round_coordinates(params):
+    """Round coordinate parameters to HTTP_CACHE_COORD_PRECISION decimals"""
+    precision = settings.HTTP_CACHE_COORD_PRECISION
+    rounded = dict(params)
+    for name in COORDINATE_PARAMS:
+        if rounded.get(name) is not None:
+            rounded[name] = round(float(rounded[name]), precision)
+    return rounded
+
+
+def cache_key(url, params):
+    payload = json.dumps([url, sorted(params.items())], default=str)
+    return "http:" + hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get_json(url, params=None, headers=None, ttl=None, timeout=None):
+    """
+    GET a JSON document through the pooled session and the shared response cache
+
+    Args:
+        url: Endpoint URL
+        params: Query parameters; latitude/longitude style values are rounded
+        headers: Extra request headers
+        ttl: Seconds to cache the response for, None to keep it until evicted
+        timeout: Connect/read timeout in seconds, HTTP_CLIENT_TIMEOUT by default
+
+    Returns:
+        The decoded JSON body
+
+    Raises:
+        requests.RequestException: if the request still fails after retries
+    """
+    timeout = timeout or settings.HTTP_CLIENT_TIMEOUT
+    params = round_coordinates(params or {})
+    key = cache_key(url, params)
+    cache = caches[settings.HTTP_CACHE_ALIAS]
+
+    data = cache.get(key)
+    cache_result('http', data is not None)
+    if data is not None:
+        return data
+
+    host = urlsplit(url).hostname
+    metrics.inc('external_api_requests_total', host=host)
+    try:
+        with host_slot(host):
+            response = get_session().get(url, params=params, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+    except Exception:
+        metrics.inc('external_api_failures_total', host=host)
+        raise
+
+    cache.set(key, data, ttl)
+    return data
+
+
+class AsyncClientState:
+    """The httpx client and per-host semaphores of one event loop"""
+
+    def __init__(self):
+        self.client = httpx.AsyncClient(
+            headers={'User-Agent': settings.HTTP_CLIENT_USER_AGENT},
+            limits=httpx.Limits(max_connections=settings.HTTP_CLIENT_POOL_SIZE),
+            timeout=settings.HTTP_CLIENT_TIMEOUT,
+        )
+        self.host_limits = {}
+        self.lifetime = None
+
+    async def open(self):
+        # Suspended at its yield until the loop shuts its async generators down
+        self.lifetime = self._lifetime()
+        await self.lifetime.__anext__()
+
+    async def _lifetime(self):
+        try:
+            yield
+        finally:
+            await self.client.aclose()
+
+    @asynccontextmanager
+    async def host_slot(self, host):
+        """Async counterpart of host_slot. No lock needed, the loop runs one task at a time."""
+        limiter = self.host_limits.get(host)
+        if limiter is None:
+            limit = settings.HTTP_CLIENT_HOST_CONCURRENCY.get(host, settings.HTTP_CLIENT_DEFAULT_CONCURRENCY)
+            limiter = self.host_limits[host] = asyncio.Semaphore(limit)
+        async with limiter:
+            yield
+
+
+async def get_async_state():
+    """The async client of the running event loop, created on first use"""
+    loop = asyncio.get_running_loop()
+    state = _async_state.get(loop)
+    if state is None:
+        state = _async_state[loop] = AsyncClientState()
+        await state.open()
+    return state
+
+
+def retry_delay(response, attempt):
+    """Seconds before the next attempt: Retry-After when the server sent one, else backoff"""
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return settings.HTTP_CLIENT_BACKOFF * (2 ** attempt)
+
+
+async def aget_json(url, params=None, headers=None, ttl=None, timeout=None):
+    """
+    Async version of get_json, for async views. Same arguments and cache entries.
+
+    Raises:
+        httpx.HTTPError: if the request still fails after retries
+    """
+    timeout = timeout or settings.HTTP_CLIENT_TIMEOUT
+    params = round_coordinates(params or {})
+    key = cache_key(url, params)
+    cache = caches[settings.HTTP_CACHE_ALIAS]
+
+    data = await cache.aget(key)
+    cache_result('http', data is not None)
+    if data is not None:
+        return data
+
+    state = await get_async_state()
+    host = urlsplit(url).hostname
+    metrics.inc('external_api_requests_total', host=host)
+    try:
+        async with state.host_slot(host):
+            # Same policy as the requests session's Retry: connection errors and RETRY_STATUSES
+            for attempt in range(settings.HTTP_CLIENT_RETRIES + 1):
+                response = None
+                try:
+                    response = await state.client.get(url, params=params, headers=headers, timeout=timeout)
+                    if response.status_code not in RETRY_STATUSES:
+                        break
+                except httpx.TransportError:
+                    if attempt == settings.HTTP_CLIENT_RETRIES:
+                        raise
+                if attempt < settings.HTTP_CLIENT_RETRIES:
+                    await asyncio.sleep(retry_delay(response, attempt))
+        response.raise_for_status()
+        data = response.json()
+    except BaseException:
+        # Including a cancellation by the caller's deadline (afetch_forecast)
+        metrics.inc('external_api_failures_total', host=host)
+        raise
+
+    await cache.aset(key, data, ttl)
+    return data
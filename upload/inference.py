@@ -0,0 +1,106 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from .preprocessing import batch_buffer
+
+'''
+    Micro-batching for model inference.
+
+    Requests arriving within a few milliseconds of each other are stacked into one
+    batch and sent through the model in a single forward pass, instead of paying
+    Keras' per-call overhead once per upload.
+'''
+
+
+class BatchInferenceEngine:
+    """
+    Collects single-image requests and runs them through `predict_batch` in batches.
+
+    Args:
+        predict_batch: Callable taking a float32 array of shape (N, 224, 224, 3) and
+            returning a list of N results.
+        max_batch_size: Largest batch handed to predict_batch.
+        max_wait_ms: How long the first request of a batch waits for others to join.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=16, max_wait_ms=5):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, image):
+        """Queue one preprocessed image (224, 224, 3) and return a Future for its result"""
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((image, future))
+        return future
+
+    def pending(self):
+        """Images waiting to be batched"""
+        return self._queue.qsize()
+
+    def predict(self, image, timeout=None):
+        """Queue one image and wait for its result"""
+        return self.submit(image).result(timeout=timeout)
+
+    def _ensure_worker(self):
+        # Gunicorn forks workers after the app is imported, and threads don't survive
+        # a fork, so (re)start the batching thread in whichever process is using it.
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                self._queue = queue.Queue()
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+            self._thread.start()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Take anything else that is already waiting without extending the deadline
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            futures = [future for _, future in batch]
+            try:
+                # The batch buffer belongs to this thread and is reused for every batch
+                images = np.stack([image for image, _ in batch], out=batch_buffer(len(batch)))
+                results = list(self.predict_batch(images))
+                if len(results) != len(futures):
+                    raise RuntimeError(f"Model returned {len(results)} result(s) for {len(futures)} image(s)")
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+            except Exception as e:
+                print(f"Error in batched prediction: {str(e)}")
+                # Every request still waiting gets the error instead of blocking forever
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
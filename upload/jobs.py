@@ -0,0 +1,348 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import ProcessingJob
+
+'''
+    Background processing of uploads.
+
+    The home view saves the file and enqueues a ProcessingJob row; worker processes
+    started with `manage.py run_upload_workers` claim queued rows and run the model,
+    reverse geocoding and the weather forecast. The database table is the queue, so
+    no external broker is needed.
+'''
+
+
+def enqueue(uploaded_file):
+    """Create a queued job for an UploadedFile and return it"""
+    return ProcessingJob.objects.create(uploaded_file=uploaded_file)
+
+
+def process_upload(file, image=None):
+    """
+    Run the ML model on an uploaded file, then look up its location name and weather
+    forecast if coordinates were given. Saves the results on the file.
+
+    Args:
+        file: The UploadedFile to process
+        image: The file decoded with ml_processor.decode_for_model, when it is still
+            in memory from the upload
+
+    Returns:
+        dict: the processed info returned to the browser once the job finishes
+    """
+    forecast_data = None
+    error_message = None
+
+    try:
+        classify_upload(file, image)
+        forecast_data = locate_upload(file)
+
+        # Save the file again with prediction and location name
+        file.save()
+    except Exception as e:
+        error_message = f"Error processing image: {str(e)}"
+        print(error_message)
+        print(traceback.format_exc())
+        # Still save the file but without prediction
+        file.prediction = "Processing failed"
+        file.confidence = 0
+        file.save()
+
+    return upload_result(file, forecast_data, error_message)
+
+
+async def aprocess_upload(file, image=None):
+    """
+    Async process_upload for the async views. The model runs in a thread while the
+    location name and forecast are fetched, so the upload takes as long as the
+    slowest of the three instead of their sum.
+    """
+    forecast_data = None
+    error_message = None
+
+    try:
+        _, forecast_data = await asyncio.gather(
+            # Not thread-sensitive: it would hold up this request's database queries
+            sync_to_async(classify_upload_in_thread, thread_sensitive=False)(file, image),
+            alocate_upload(file),
+        )
+        await file.asave()
+    except Exception as e:
+        error_message = f"Error processing image: {str(e)}"
+        print(error_message)
+        print(traceback.format_exc())
+        file.prediction = "Processing failed"
+        file.confidence = 0
+        await file.asave()
+
+    return upload_result(file, forecast_data, error_message)
+
+
+def upload_result(file, forecast_data, error_message):
+    failed = error_message is not None
+    return {
+        'prediction': None if failed else file.prediction,
+        'confidence': None if failed else file.confidence,
+        'model_version': None if failed else file.model_version,
+        'location': file.location_name,
+        'forecast': forecast_data,
+        'processed_at': datetime.now().strftime('%Y-%m-%d %H:%M'),
+        'error': error_message
+    }
+
+
+def classify_upload(file, image=None):
+    """Set the file's prediction, without saving it"""
+    from .ml_processor import predict_image_versioned
+    from .prediction_cache import cached_prediction
+
+    # Every path (upload request, worker, bulk) builds the model input with
+    # load_and_preprocess_image, from the stored file or from the same decode of it
+    # kept since the upload, so an image always gets the same input and the cached
+    # prediction doesn't depend on which path classified it first.
+    # Photos uploaded before skip the model.
+    file.prediction, file.confidence, file.model_version = cached_prediction(
+        file.content_hash, lambda: predict_image_versioned(file.file.path, image=image))
+
+
+def classify_upload_in_thread(file, image=None):
+    try:
+        classify_upload(file, image)
+    finally:
+        # The executor thread isn't a request thread, nothing else closes its connection
+        connection.close()
+
+
+def locate_upload(file):
+    """
+    Set the file's location name and forecast if coordinates are provided, without saving it
+
+    Returns:
+        dict: the forecast data, or None
+    """
+    if not (file.latitude and file.longitude and file.forecast_days):
+        return None
+    try:
+        from .forecast import stored_forecast, get_location_name
+
+        # Get a proper location name first
+        file.location_name = get_location_name(file.latitude, file.longitude)
+
+        # Get weather forecast, shared with other uploads from the same area today
+        forecast = stored_forecast(
+            file.latitude,
+            file.longitude,
+            file.forecast_days,
+            location_name=file.location_name
+        )
+        if forecast.pk:
+            file.forecast = forecast
+        return forecast.data
+    except Exception as e:
+        print(f"Error fetching weather data: {str(e)}")
+        print(traceback.format_exc())
+        return None
+
+
+async def alocate_upload(file):
+    """Async locate_upload: the location name is looked up while the forecast is fetched"""
+    if not (file.latitude and file.longitude and file.forecast_days):
+        return None
+    try:
+        from .forecast import aget_location_name, astored_forecast
+
+        # Started now and shared with the forecast, which needs the name too
+        location_name = asyncio.ensure_future(aget_location_name(file.latitude, file.longitude))
+        forecast = await astored_forecast(
+            file.latitude,
+            file.longitude,
+            file.forecast_days,
+            location_name=location_name
+        )
+        file.location_name = await location_name
+        if forecast.pk:
+            file.forecast = forecast
+        return forecast.data
+    except Exception as e:
+        print(f"Error fetching weather data: {str(e)}")
+        print(traceback.format_exc())
+        return None
+
+
+def run_job(job, image=None):
+    """Process a claimed job and record the outcome on it"""
+    if job.batch_id:
+        result = run_batch(job)
+    else:
+        result = process_upload(job.uploaded_file, image=image)
+    return finish_job(job, result)
+
+
+async def arun_job(job, image=None):
+    """Async run_job for a single upload, see aprocess_upload"""
+    result = await aprocess_upload(job.uploaded_file, image=image)
+    return await sync_to_async(finish_job)(job, result)
+
+
+def finish_job(job, result):
+    from .events import publish_job
+
+    job.result = result
+    job.status = ProcessingJob.STATUS_FAILED if result['error'] else ProcessingJob.STATUS_DONE
+    job.error = result['error'] or ''
+    job.finished_at = timezone.now()
+    job.save(update_fields=['result', 'status', 'error', 'finished_at'])
+    # Pushed to the farmer's open pages instead of them polling job_status
+    publish_job(job)
+    return job
+
+
+def job_info(job):
+    return {
+        'id': job.id,
+        'status': job.status,
+        'status_url': reverse('job_status', args=[job.id]),
+    }
+
+
+def run_batch(job):
+    """Process a bulk upload, reporting progress on the job as inference goes"""
+    from .bulk import process_batch
+
+    def progress(done, total):
+        # Also refreshes started_at, so a long batch isn't mistaken for a dead worker's job
+        ProcessingJob.objects.filter(id=job.id).update(
+            result={'progress': {'done': done, 'total': total}},
+            started_at=timezone.now(),
+        )
+
+    try:
+        return process_batch(job.batch, progress=progress)
+    except Exception as e:
+        error_message = f"Error processing batch: {str(e)}"
+        print(error_message)
+        print(traceback.format_exc())
+        return {'manifest': job.batch.rejected, 'error': error_message}
+
+
+def claim_next_job(worker_name):
+    """
+    Atomically move the oldest queued job to running and return it, or None if the
+    queue is empty. The conditional UPDATE makes sure two workers never get the same job.
+    """
+    while True:
+        job_id = (ProcessingJob.objects
+                  .filter(status=ProcessingJob.STATUS_QUEUED)
+                  .order_by('created_at', 'id')
+                  .values_list('id', flat=True)
+                  .first())
+        if job_id is None:
+            return None
+
+        claimed = ProcessingJob.objects.filter(id=job_id, status=ProcessingJob.STATUS_QUEUED).update(
+            status=ProcessingJob.STATUS_RUNNING,
+            started_at=timezone.now(),
+            worker=worker_name,
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return ProcessingJob.objects.select_related('uploaded_file', 'batch').get(id=job_id)
+        # Another worker got there first, try the next one
+
+
+def fail_job(job, error_message):
+    """
+    Finish a job that could not be processed, marking its uploads that have no
+    prediction yet as failed, as process_upload does
+    """
+    from .public_feed import invalidate_public_history
+
+    if job.batch_id:
+        job.batch.files.filter(prediction__isnull=True).update(prediction="Processing failed", confidence=0)
+        # update() sends no post_save signals
+        invalidate_public_history()
+        result = {'manifest': job.batch.rejected, 'error': error_message}
+    else:
+        file = job.uploaded_file
+        if file.prediction is None:
+            file.prediction = "Processing failed"
+            file.confidence = 0
+            file.save(update_fields=['prediction', 'confidence'])
+        result = upload_result(file, None, error_message)
+    return finish_job(job, result)
+
+
+def requeue_stale_jobs():
+    """Put back jobs whose worker died mid-run, or fail them after too many attempts"""
+    cutoff = timezone.now() - timedelta(seconds=settings.UPLOAD_JOB_TIMEOUT)
+    stale = ProcessingJob.objects.filter(status=ProcessingJob.STATUS_RUNNING, started_at__lt=cutoff)
+    for job in stale.filter(attempts__gte=settings.UPLOAD_JOB_MAX_ATTEMPTS).select_related('uploaded_file', 'batch'):
+        # As in claim_next_job, only one worker gets to fail the job
+        if stale.filter(id=job.id).update(status=ProcessingJob.STATUS_FAILED):
+            fail_job(job, 'Processing timed out')
+    stale.filter(attempts__lt=settings.UPLOAD_JOB_MAX_ATTEMPTS).update(status=ProcessingJob.STATUS_QUEUED)
+
+
+def worker_loop(worker_name, stop_event=None):
+    """Claim and run jobs until stop_event is set, sleeping while the queue is empty"""
+    poll_interval = settings.UPLOAD_JOB_POLL_INTERVAL
+    last_stale_check = 0
+
+    while stop_event is None or not stop_event.is_set():
+        close_old_connections()
+        try:
+            if time.monotonic() - last_stale_check > poll_interval * 20:
+                requeue_stale_jobs()
+                last_stale_check = time.monotonic()
+
+            job = claim_next_job(worker_name)
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            run_job(job)
+        except Exception as e:
+            print(f"Error in upload worker {worker_name}: {str(e)}")
+            print(traceback.format_exc())
+            time.sleep(poll_interval)
+
+
+def run_worker_process(threads, refresh_forecasts=True):
+    """
+    Entry point of one worker process. Several threads claim jobs at the same time so
+    their predictions can share a forward pass through the batching engine.
+
+    Args:
+        threads: Jobs processed concurrently
+        refresh_forecasts: Also run the forecast refresh loop; only one process of
+            the pool should, or every forecast would be fetched and pushed once per process
+    """
+    from .events import forecast_refresh_loop
+    from .ml_processor import warm_up
+
+    # Load the model while the first jobs are claimed, not when the first one needs it
+    threading.Thread(target=warm_up, name="model-warmup", daemon=True).start()
+    if refresh_forecasts:
+        threading.Thread(target=forecast_refresh_loop, name="forecast-refresh", daemon=True).start()
+
+    base_name = f"{socket.gethostname()}:{os.getpid()}"
+    workers = [
+        threading.Thread(target=worker_loop, args=(f"{base_name}:{i}",), daemon=True)
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
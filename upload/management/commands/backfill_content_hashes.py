@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError
+
+from upload.blobs import move_to_blob
+from upload.models import PredictionCache, UploadedFile
+
+
+class Command(BaseCommand):
+    help = "Hash uploads stored before content addressing and move them into blob storage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Rows loaded per query')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the uploads that would be moved')
+        parser.add_argument('--seed-predictions', action='store_true',
+                            help='Store existing predictions in the prediction cache under the '
+                                 'model version that made them, or the current one for uploads from before '
+                                 'versions were recorded (only if they came from the current model)')
+
+    def handle(self, *args, **options):
+        from upload.ml_processor import model_version
+
+        pending = UploadedFile.objects.filter(content_hash='').exclude(file='')
+        if options['dry_run']:
+            self.stdout.write(f"{pending.count()} upload(s) without a content hash")
+            return
+
+        version = model_version()
+        moved = missing = seeded = 0
+        last_id = 0
+        while True:
+            # Keyset over ids, rows leave the filter as they are processed
+            batch = list(pending.filter(id__gt=last_id).order_by('id')[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            for uploaded_file in batch:
+                if not uploaded_file.file.storage.exists(uploaded_file.file.name):
+                    missing += 1
+                    self.stderr.write(f"Upload {uploaded_file.id}: {uploaded_file.file.name} is missing")
+                    continue
+                try:
+                    move_to_blob(uploaded_file)
+                except OSError as e:
+                    self.stderr.write(f"Upload {uploaded_file.id}: {str(e)}")
+                    continue
+                moved += 1
+
+                if (options['seed_predictions'] and uploaded_file.confidence is not None
+                        and uploaded_file.prediction and uploaded_file.prediction != "Processing failed"):
+                    try:
+                        _, created = PredictionCache.objects.get_or_create(
+                            content_hash=uploaded_file.content_hash,
+                            model_version=uploaded_file.model_version or version,
+                            defaults={'prediction': uploaded_file.prediction, 'confidence': uploaded_file.confidence},
+                        )
+                        seeded += created
+                    except IntegrityError:
+                        pass
+
+        self.stdout.write(f"Moved {moved} upload(s) into blob storage, {missing} missing file(s)"
+                          + (f", seeded {seeded} cached prediction(s)" if options['seed_predictions'] else ""))
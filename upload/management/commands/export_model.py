@@ -0,0 +1,90 @@
+import os
+import random
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from upload.ml_processor import MODEL_PATH, TFLITE_MODEL_PATH, load_and_preprocess_image
+from upload.models import UploadedFile
+from upload.preprocessing import list_images
+
+
+class Command(BaseCommand):
+    help = "Convert the Keras model to TensorFlow Lite for the 'tflite' backend, optionally quantized"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=TFLITE_MODEL_PATH,
+                            help='Where to write the .tflite file')
+        parser.add_argument('--quantize', choices=['none', 'dynamic', 'float16', 'int8'], default='none',
+                            help='Post-training quantization: dynamic range, float16 weights, '
+                                 'or int8 weights and activations (needs calibration images)')
+        parser.add_argument('--calibration-dir',
+                            help='Images for int8 calibration; default is the most recent uploads')
+        parser.add_argument('--samples', type=int, default=200,
+                            help='Number of calibration images')
+
+    def handle(self, *args, **options):
+        try:
+            import tensorflow as tf
+            from upload.backends import load_keras
+        except ImportError:
+            raise CommandError("Exporting needs TensorFlow and Keras installed")
+
+        quantize = options['quantize']
+        calibration = self.calibration_images(options) if quantize == 'int8' else []
+
+        model = load_keras(MODEL_PATH)
+        with tempfile.TemporaryDirectory() as saved_model_dir:
+            # Keras 3 models convert most reliably through a SavedModel export
+            model.export(saved_model_dir, format='tf_saved_model')
+            converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+
+            if quantize != 'none':
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if quantize == 'float16':
+                converter.target_spec.supported_types = [tf.float16]
+            elif quantize == 'int8':
+                # Activation ranges come from real photos run through the app's preprocessing.
+                # Inputs and outputs stay float32, so the backend works the same either way.
+                def representative_dataset():
+                    for path in calibration:
+                        yield [load_and_preprocess_image(path)[None]]
+
+                converter.representative_dataset = representative_dataset
+                converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+            data = converter.convert()
+
+        # A running app may be reading the old file, replace it in one step
+        output = options['output']
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        temp_path = f"{output}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, output)
+
+        self.stdout.write(
+            f"Wrote {output} ({len(data) / (1024 * 1024):.1f} MB, quantization: {quantize}"
+            + (f", calibrated on {len(calibration)} images" if calibration else "") + ")"
+        )
+        self.stdout.write(
+            "Compare it with the Keras model before switching ML_BACKEND to 'tflite':\n"
+            f"    python -m upload.benchmarks.backends --tflite {output} --images <labelled photos>"
+        )
+
+    def calibration_images(self, options):
+        if options['calibration_dir']:
+            paths = list_images(options['calibration_dir'])
+        else:
+            storage = UploadedFile._meta.get_field('file').storage
+            names = (UploadedFile.objects.exclude(file='')
+                     .order_by('-uploaded_at')
+                     .values_list('file', flat=True)[:options['samples'] * 2])
+            # Duplicate uploads share one file
+            paths = [storage.path(name) for name in dict.fromkeys(names) if storage.exists(name)]
+
+        if not paths:
+            raise CommandError("int8 quantization needs calibration images, pass --calibration-dir")
+        # A fixed seed keeps repeated exports identical
+        random.Random(0).shuffle(paths)
+        return paths[:options['samples']]
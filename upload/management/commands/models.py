@@ -0,0 +1,143 @@
+import os
+from collections import Counter
+from datetime import timedelta
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from upload.ml_processor import activate_version, class_labels, read_registry, write_registry
+from upload.models import ShadowPrediction
+
+
+class Command(BaseCommand):
+    help = "Register model versions, switch the active model and run candidates in shadow mode"
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest='action', required=True)
+
+        actions.add_parser('list', help='Registered versions, the active one and the shadow one')
+
+        register = actions.add_parser('register', help='Add or update a model version')
+        register.add_argument('version')
+        register.add_argument('path', help='Model file (.keras or .tflite)')
+        register.add_argument('--backend', choices=['keras', 'tflite'],
+                              help='Default: from the file extension')
+        register.add_argument('--labels',
+                              help='Comma-separated class labels in output order (default: the current classes)')
+
+        activate = actions.add_parser('activate', help='Serve a registered version; running processes switch to it')
+        activate.add_argument('version')
+        activate.add_argument('--skip-check', action='store_true',
+                              help="Don't run check_model on the version first")
+
+        shadow = actions.add_parser('shadow', help='Score a sample of traffic with a candidate version')
+        shadow.add_argument('version', nargs='?')
+        shadow.add_argument('--sample-rate', type=float, default=0.1,
+                            help='Fraction of inference batches the candidate also runs')
+        shadow.add_argument('--off', action='store_true', help='Stop shadow mode')
+
+        report = actions.add_parser('report', help='Agreement and latency of shadow candidates')
+        report.add_argument('--hours', type=float, help='Only the last HOURS of shadow predictions')
+
+    def handle(self, *args, **options):
+        try:
+            getattr(self, f"handle_{options['action']}")(options)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+    def handle_list(self, options):
+        config = read_registry()
+        shadow = config['shadow'] or {}
+        for version, entry in config['versions'].items():
+            if version == config['active']:
+                role = 'active'
+            elif version == shadow.get('version'):
+                role = f"shadow ({shadow.get('sample_rate', 0.1):.0%} of batches)"
+            else:
+                role = ''
+            self.stdout.write(f"{version:<24} {entry.get('backend', 'keras'):<7} {role:<26} {entry['path']}")
+
+    def handle_register(self, options):
+        path = os.path.abspath(options['path'])
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+
+        config = read_registry()
+        labels = options['labels'].split(',') if options['labels'] else list(class_labels.values())
+        config['versions'][options['version']] = {
+            'path': path,
+            'backend': options['backend'] or ('tflite' if path.endswith('.tflite') else 'keras'),
+            'labels': [label.strip() for label in labels],
+        }
+        write_registry(config)
+        self.stdout.write(f"Registered model {options['version']} ({path})")
+
+    def handle_activate(self, options):
+        version = options['version']
+        if version not in read_registry()['versions']:
+            raise CommandError(f"Model version {version!r} is not registered")
+
+        if not options['skip_check']:
+            from upload.check_model import check_model
+
+            marker = check_model(version=version)
+            if marker['status'] != 'ready':
+                raise CommandError(f"Model {version} failed its check, still serving the previous one: {marker['error']}")
+
+        activate_version(version)
+        self.stdout.write(f"Model {version} is active. Running processes load it in the background "
+                          f"and switch once it is ready.")
+
+    def handle_shadow(self, options):
+        config = read_registry()
+        if options['off']:
+            config['shadow'] = None
+            write_registry(config)
+            self.stdout.write("Shadow mode stopped")
+            return
+
+        version = options['version']
+        if version is None:
+            raise CommandError("Give the version to run in shadow mode, or --off")
+        if version not in config['versions']:
+            raise CommandError(f"Model version {version!r} is not registered")
+        if version == config['active']:
+            raise CommandError(f"Model {version} is already the active one")
+        if not 0 < options['sample_rate'] <= 1:
+            raise CommandError("--sample-rate must be between 0 and 1")
+
+        config['shadow'] = {'version': version, 'sample_rate': options['sample_rate']}
+        write_registry(config)
+        self.stdout.write(f"Model {version} now scores {options['sample_rate']:.0%} of inference batches in shadow mode")
+
+    def handle_report(self, options):
+        predictions = ShadowPrediction.objects.all()
+        if options['hours']:
+            predictions = predictions.filter(created_at__gte=timezone.now() - timedelta(hours=options['hours']))
+
+        pairs = (predictions.values_list('candidate_version', 'active_version')
+                 .distinct().order_by('candidate_version', 'active_version'))
+        if not pairs:
+            self.stdout.write("No shadow predictions recorded")
+            return
+
+        for candidate, active in pairs:
+            rows = list(predictions
+                        .filter(candidate_version=candidate, active_version=active)
+                        .values_list('agrees', 'active_prediction', 'candidate_prediction',
+                                     'active_latency_ms', 'candidate_latency_ms', 'batch_size'))
+            agrees, active_labels, candidate_labels, active_ms, candidate_ms, batch_sizes = zip(*rows)
+            self.stdout.write(f"\n{candidate} against {active}: {len(rows)} image(s), "
+                              f"{np.mean(agrees):.1%} same label")
+
+            # Latency is per forward pass, shared by the images of its batch
+            batch_sizes = np.array(batch_sizes, dtype=np.float64)
+            for name, timings in (('active', active_ms), ('candidate', candidate_ms)):
+                timings = np.array(timings) / batch_sizes
+                self.stdout.write(f"  {name:<9} ms/image  p50 {np.percentile(timings, 50):.2f}  "
+                                  f"p95 {np.percentile(timings, 95):.2f}")
+
+            changes = Counter((a, c) for a, c in zip(active_labels, candidate_labels) if a != c)
+            for (a, c), count in changes.most_common(5):
+                self.stdout.write(f"  {a} -> {c}: {count}")
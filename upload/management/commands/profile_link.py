@@ -0,0 +1,25 @@
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from upload.profiling import PROFILE_PARAM, signed_profile_token
+
+
+class Command(BaseCommand):
+    help = "Print a link that runs a page under the request profiler, for anyone who opens it"
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='Page to profile, e.g. /api/forecast/?lat=42&lon=-93 or a full URL')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if not url.path.startswith('/'):
+            raise CommandError("Give an absolute path or URL")
+        # The token only profiles this path, and expires after PROFILER_LINK_MAX_AGE
+        query = parse_qsl(url.query, keep_blank_values=True) + [(PROFILE_PARAM, signed_profile_token(url.path))]
+        self.stdout.write(urlunsplit(url._replace(query=urlencode(query))))
+        if not settings.PROFILER_ENABLED:
+            self.stderr.write("PROFILER_ENABLED is off here, the link only works on a server that has it on")
+        self.stdout.write(f"Valid for {settings.PROFILER_LINK_MAX_AGE // 3600} hour(s). "
+                          f"Profiles are listed under Profile records in the admin.")
@@ -0,0 +1,57 @@
+import multiprocessing
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from upload.jobs import run_worker_process
+
+
+class Command(BaseCommand):
+    help = "Start a pool of worker processes that process queued uploads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Number of worker processes (each loads its own copy of the model)')
+        parser.add_argument('--threads', type=int, default=4,
+                            help='Jobs processed concurrently per process; their predictions are batched')
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'])
+        threads = max(1, options['threads'])
+
+        # Children must not share the parent's database connection
+        connections.close_all()
+
+        def start(index):
+            # The first process also refreshes the forecasts of connected farmers
+            process = multiprocessing.Process(target=run_worker_process, args=(threads, index == 0), daemon=True)
+            process.start()
+            return process
+
+        pool = [start(i) for i in range(processes)]
+        self.stdout.write(f"Started {processes} upload worker process(es) with {threads} thread(s) each")
+
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        # Restart any worker that dies so the queue keeps draining
+        while not stopping:
+            for i, process in enumerate(pool):
+                if not process.is_alive():
+                    self.stderr.write(f"Upload worker {process.pid} exited with {process.exitcode}, restarting")
+                    pool[i] = start(i)
+            time.sleep(1)
+
+        for process in pool:
+            process.terminate()
+        for process in pool:
+            process.join(timeout=10)
+        self.stdout.write("Upload workers stopped")
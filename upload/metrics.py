@@ -0,0 +1,252 @@
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+'''
+    Hot-path metrics, served in Prometheus text format at /metrics/.
+
+    Recording is a dict lookup and an addition under a lock, in the process that
+    did the work. A background thread writes the process's totals to
+    METRICS_DIR/<pid>.json every METRICS_FLUSH_INTERVAL seconds (and at exit); the
+    endpoint adds up the files of every gunicorn and upload worker process. Files
+    of processes that exited are kept for METRICS_RETENTION seconds so totals
+    don't go backwards when a worker is recycled.
+
+    Stage timings (file save, preprocessing, inference, geocoding, forecast fetch,
+    database writes, template render) go into the upload_stage_seconds histogram,
+    see `timed`. Queue depths are read when the endpoint is scraped.
+'''
+
+# Seconds; most stages are milliseconds, a cold forecast fetch with retries can take ~20 s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+HISTOGRAM_BUCKETS = {
+    'inference_batch_size': (1, 2, 4, 8, 16, 32, 64),
+}
+
+METRIC_HELP = {
+    'upload_stage_seconds': ('histogram', 'Time spent in each stage of handling an upload'),
+    'inference_batch_size': ('histogram', 'Images per forward pass through the model'),
+    'cache_requests_total': ('counter', 'Cache lookups by cache and result (hit or miss)'),
+    'external_api_requests_total': ('counter', 'Requests to the weather and geocoding APIs, by host'),
+    'external_api_failures_total': ('counter', 'Requests to the weather and geocoding APIs that failed after retries'),
+    'inference_queue_depth': ('gauge', 'Images waiting for the batching engine, per process'),
+    'shadow_batches_dropped_total': ('counter', 'Sampled batches the shadow evaluator dropped because it fell behind'),
+    'upload_jobs': ('gauge', 'Processing jobs queued or running'),
+}
+
+
+def enabled():
+    # Also imported by code that runs without Django settings (python -m upload.ml_processor)
+    return settings.configured and settings.METRICS_ENABLED
+
+
+class Metrics:
+    """Counters, histograms and gauges of this process, flushed to METRICS_DIR"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._thread = None
+        self._pid = None
+
+    def inc(self, name, amount=1, **labels):
+        if not enabled():
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self._ensure_flusher()
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not enabled():
+            return
+        key = (name, tuple(sorted(labels.items())))
+        buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+        index = bisect.bisect_left(buckets, value)
+        self._ensure_flusher()
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One count per bucket plus +Inf, then the sum
+                histogram = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def gauge(self, name, read):
+        """Report read() as a gauge of this process whenever it flushes"""
+        self._gauges[name] = read
+
+    def _ensure_flusher(self):
+        # Threads don't survive gunicorn's fork, and a forked worker must not report
+        # the totals it inherited from the parent as its own
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == pid and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                self._counters = {}
+                self._histograms = {}
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name="metrics-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[name, dict(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, dict(labels), list(values)] for (name, labels), values in self._histograms.items()]
+        gauges = []
+        for name, read in list(self._gauges.items()):
+            try:
+                gauges.append([name, {}, read()])
+            except Exception as e:
+                print(f"Error reading gauge {name}: {str(e)}")
+        return {'pid': self._pid, 'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def flush(self):
+        """Write this process's totals to its file in METRICS_DIR"""
+        if self._pid != os.getpid():
+            return
+        try:
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            path = os.path.join(settings.METRICS_DIR, f"{self._pid}.json")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Error writing metrics: {str(e)}")
+
+
+metrics = Metrics()
+atexit.register(metrics.flush)
+
+
+@contextmanager
+def timed(stage):
+    """Time the block as one observation of upload_stage_seconds{stage=...}"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('upload_stage_seconds', time.perf_counter() - start, stage=stage)
+
+
+def cache_result(cache, hit):
+    metrics.inc('cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+
+def time_db_writes(execute, sql, params, many, context):
+    """Database execute wrapper timing INSERT, UPDATE and DELETE statements"""
+    if sql.lstrip()[:6].upper() not in ('INSERT', 'UPDATE', 'DELETE'):
+        return execute(sql, params, many, context)
+    with timed('db_write'):
+        return execute(sql, params, many, context)
+
+
+def read_process_files():
+    """
+    Snapshots written by every process, dropping files of processes that exited
+    more than METRICS_RETENTION seconds ago
+
+    Returns:
+        list of (age in seconds, snapshot dict)
+    """
+    snapshots = []
+    now = time.time()
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+        try:
+            age = now - os.path.getmtime(path)
+            if age > settings.METRICS_RETENTION:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                snapshots.append((age, json.load(f)))
+        except (OSError, ValueError):
+            # Removed by another scrape, or never completely written
+            continue
+    return snapshots
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def render_prometheus(extra_gauges=()):
+    """
+    All processes' metrics in the Prometheus text exposition format
+
+    Args:
+        extra_gauges: (name, labels, value) gauges read by the caller, e.g. from the database
+
+    Returns:
+        str: the exposition text
+    """
+    # This process's latest numbers rather than its last flush
+    if metrics._pid == os.getpid():
+        metrics.flush()
+
+    counters = {}
+    histograms = {}
+    gauges = {}
+    for age, snapshot in read_process_files():
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            total = histograms.get(key)
+            histograms[key] = values if total is None else [a + b for a, b in zip(total, values)]
+        if age <= settings.METRICS_FLUSH_INTERVAL * 3:
+            # Gauges are current values, only live processes have one
+            for name, labels, value in snapshot['gauges']:
+                labels = dict(labels, pid=str(snapshot['pid']))
+                gauges[(name, tuple(sorted(labels.items())))] = value
+    for name, labels, value in extra_gauges:
+        gauges[(name, tuple(sorted(labels.items())))] = value
+
+    lines = []
+    described = set()
+
+    def describe(name):
+        if name not in described:
+            described.add(name)
+            kind, text = METRIC_HELP.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name)
+        lines.append(f"{name}{format_labels(dict(labels))} {value}")
+    for (name, labels), value in sorted(gauges.items()):
+        describe(name)
+        lines.append(f"{name}{format_labels(dict(labels))} {value}")
+    for (name, labels), values in sorted(histograms.items()):
+        describe(name)
+        labels = dict(labels)
+        buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+        cumulative = 0
+        for bound, count in zip(list(buckets) + ['+Inf'], values[:-1]):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(dict(labels, le=str(bound)))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {values[-1]}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
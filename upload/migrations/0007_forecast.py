@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-18 10:25
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0006_geocodecache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Forecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geohash', models.CharField(max_length=12)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('units', models.CharField(default='fahrenheit', max_length=12)),
+                ('days', models.IntegerField()),
+                ('issued_on', models.DateField()),
+                ('fetched_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('data', models.JSONField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('geohash', 'units', 'days', 'issued_on'), name='upload_forecast_unique_per_day')],
+            },
+        ),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='forecast',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='uploads', to='upload.forecast'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0007_forecast'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['farmer', '-uploaded_at', '-id'], name='upload_file_history_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0008_uploadedfile_history_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(condition=models.Q(('prediction__isnull', False)), fields=['-uploaded_at'], name='upload_public_feed_idx'),
+        ),
+    ]
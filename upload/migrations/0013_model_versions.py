@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-18 13:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0012_upload_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='model_version',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=100),
+        ),
+        migrations.CreateModel(
+            name='ShadowPrediction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('active_version', models.CharField(max_length=100)),
+                ('candidate_version', models.CharField(db_index=True, max_length=100)),
+                ('active_prediction', models.CharField(max_length=50)),
+                ('active_confidence', models.FloatField()),
+                ('candidate_prediction', models.CharField(max_length=50)),
+                ('candidate_confidence', models.FloatField()),
+                ('agrees', models.BooleanField()),
+                ('batch_size', models.IntegerField(default=1)),
+                ('active_latency_ms', models.FloatField()),
+                ('candidate_latency_ms', models.FloatField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2 on 2026-10-18 14:25
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0013_model_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='farmer',
+            name='events_seen_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='UserEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('job', 'Job finished'), ('forecast', 'Forecast changed')], max_length=20)),
+                ('data', models.JSONField()),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('farmer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['farmer', 'id'], name='upload_event_stream_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2 on 2026-10-18 15:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0014_user_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=500)),
+                ('status_code', models.IntegerField(blank=True, null=True)),
+                ('duration_ms', models.FloatField()),
+                ('collapsed_stacks', models.TextField(blank=True)),
+                ('sample_count', models.IntegerField(default=0)),
+                ('interval_ms', models.FloatField()),
+                ('queries', models.JSONField(default=list)),
+                ('query_count', models.IntegerField(default=0)),
+                ('query_ms', models.FloatField(default=0)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2 on 2026-10-18 16:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+from upload.geohash import encode
+
+
+def backfill_geohash(apps, schema_editor):
+    UploadedFile = apps.get_model('upload', 'UploadedFile')
+    files = (UploadedFile.objects
+             .filter(latitude__isnull=False, longitude__isnull=False)
+             .only('id', 'latitude', 'longitude'))
+    batch = []
+    for file in files.iterator(chunk_size=2000):
+        file.geohash = encode(file.latitude, file.longitude, settings.UPLOAD_GEOHASH_PRECISION)
+        batch.append(file)
+        if len(batch) == 2000:
+            UploadedFile.objects.bulk_update(batch, ['geohash'])
+            batch = []
+    UploadedFile.objects.bulk_update(batch, ['geohash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0015_profile_records'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='geohash',
+            field=models.CharField(blank=True, default='', max_length=12),
+        ),
+        # Before the index, so it is built once instead of updated row by row
+        migrations.RunPython(backfill_geohash, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['geohash', 'uploaded_at', 'prediction'], name='upload_file_map_idx'),
+        ),
+    ]
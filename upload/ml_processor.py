@@ -1,52 +1,554 @@
-import tensorflow as tf
+import json
 import numpy as np
-from keras.models import load_model
 import os
+import random
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
 
-# Load model from the Notebook directory
-model = load_model(os.path.join(os.path.dirname(__file__), "Notebook", "corn_model_1.keras"))
+from .backends import load_backend
+from .inference import BatchInferenceEngine
+from .metrics import metrics, timed
+from .preprocessing import batch_buffer, decode_image, image_to_input, preprocess_image
+
+# TensorFlow/Keras are imported lazily inside the functions below so that importing
+# this module (views.py does so at the top) never pays for the TensorFlow import.
+# Management commands, login/profile/admin pages and the test runner stay fast.
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "Notebook", "corn_model_1.keras")
+# Written by `manage.py export_model`
+TFLITE_MODEL_PATH = os.path.join(os.path.dirname(__file__), "Notebook", "corn_model_1.tflite")
+
+# Labels of the original model; registered versions can list their own
+class_labels = {0: "blight", 1: "common_rust", 2: "gray_leaf_spot", 3: "healthy"}
+
+# What classify_batch and the *_versioned predict functions return. The version is
+# the model that actually ran, which may differ from model_version() if a new model
+# was activated meanwhile. predict_image and predict_input keep returning
+# (label, confidence).
+Prediction = namedtuple('Prediction', ['label', 'confidence', 'model_version'])
+
+
+def _setting(name, default):
+    # This module also runs standalone (see __main__ below), without Django settings
+    try:
+        from django.conf import settings
+        if settings.configured:
+            return getattr(settings, name, default)
+    except ImportError:
+        pass
+    return default
+
+
+class LoadedModel:
+    """
+    One version of the corn disease model, held for the lifetime of the process.
+
+    The model is loaded on the first call to get() (or by warm_up()). Concurrent first
+    requests block on a lock and share a single load instead of each deserializing the
+    model. Load status and timing are kept so they can be reported by model_status().
+    The model is loaded with one of the backends in backends.py.
+    """
+
+    def __init__(self, version, path, backend="keras", labels=None):
+        self.version = version
+        self.path = path
+        self.backend = backend
+        self.labels = dict(enumerate(labels)) if labels else class_labels
+        self._model = None
+        self._lock = threading.Lock()
+        self.status = "not_loaded"
+        self.load_time = None
+        self.loaded_at = None
+        self.error = None
+
+    def get(self):
+        # Fast path without the lock once the model is in place
+        model = self._model
+        if model is not None:
+            return model
+
+        with self._lock:
+            if self._model is None:
+                self._load()
+            return self._model
+
+    def _load(self):
+        self.status = "loading"
+        self.error = None
+        start = time.perf_counter()
+        try:
+            readiness = read_readiness(self.path, self.backend)
+            if readiness is not None and readiness.get("status") != "ready":
+                # Don't import TensorFlow on every request for a file known to be broken
+                raise RuntimeError(f"Model failed check_model at {readiness.get('checked_at')}: {readiness.get('error')}")
+            self._model = load_backend(self.backend, self.path)
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+            print(f"Error loading model {self.version} from {self.path}: {str(e)}")
+            raise
+        self.load_time = time.perf_counter() - start
+        self.loaded_at = datetime.now()
+        self.status = "ready"
+        print(f"Model {self.version} loaded from {self.path} ({self.backend}) in {self.load_time:.2f}s")
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    def warm_up(self):
+        """Load the model and run the batch shapes check_model ran, each builds its own graph"""
+        model = self.get()
+        readiness = read_readiness(self.path, self.backend)
+        for batch_size in (readiness or {}).get("warmup_batch_sizes") or [1]:
+            model.predict_on_batch(np.zeros((batch_size, 224, 224, 3), dtype=np.float32))
+
+    def classify(self, images):
+        """
+        Run a batch of preprocessed images through this model in one forward pass
+
+        Returns:
+            list of Prediction, one per image
+        """
+        model = self.get()
+        # predict_on_batch skips the dataset/callback setup that predict() does per call
+        preds = np.asarray(model.predict_on_batch(images))
+
+        predicted_classes = np.argmax(preds, axis=1)
+        return [
+            Prediction(self.labels.get(int(predicted_class), "Unknown"), float(preds[i][predicted_class]), self.version)
+            for i, predicted_class in enumerate(predicted_classes)
+        ]
+
+    def info(self):
+        return {
+            "version": self.version,
+            "status": self.status,
+            "backend": self.backend,
+            "path": self.path,
+            "load_time_seconds": round(self.load_time, 3) if self.load_time is not None else None,
+            "loaded_at": self.loaded_at.strftime('%Y-%m-%d %H:%M:%S') if self.loaded_at else None,
+            "error": self.error,
+        }
+
+
+def readiness_marker_path(model_path):
+    """Where check_model records whether the model at model_path is ready"""
+    return _setting('ML_READY_MARKER', None) or f"{model_path}.ready.json"
+
+
+def read_readiness(model_path, backend):
+    """
+    The check_model result for a model file, or None if it hasn't been checked
+    since the file last changed
+    """
+    try:
+        with open(readiness_marker_path(model_path)) as f:
+            marker = json.load(f)
+        stat = os.stat(model_path)
+    except (OSError, ValueError):
+        return None
+    if (marker.get("path") != os.path.abspath(model_path) or marker.get("backend") != backend
+            or marker.get("size") != stat.st_size or marker.get("mtime_ns") != stat.st_mtime_ns):
+        return None
+    return marker
+
+
+def default_registry():
+    """The registry when there is no ML_MODEL_REGISTRY file: the one model from ML_BACKEND"""
+    backend = _setting('ML_BACKEND', 'keras')
+    if backend == 'tflite':
+        path = _setting('ML_TFLITE_MODEL_PATH', None) or TFLITE_MODEL_PATH
+    else:
+        path = MODEL_PATH
+    # Defaults to the file name, so a quantized export gets its own cached predictions
+    version = _setting('ML_MODEL_VERSION', None) or os.path.splitext(os.path.basename(path))[0]
+    return {
+        "active": version,
+        "shadow": None,
+        "versions": {version: {"path": path, "backend": backend, "labels": list(class_labels.values())}},
+    }
+
+
+def read_registry():
+    """
+    The model registry: every known version (path, backend, labels), which one is
+    active, and the shadow version with its sample rate, if any
+
+    Raises:
+        ValueError: if the registry file is malformed
+    """
+    path = _setting('ML_MODEL_REGISTRY', None)
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (TypeError, FileNotFoundError):
+        return default_registry()
+    except OSError as e:
+        raise ValueError(f"Can't read the model registry {path}: {str(e)}")
+
+    versions = config.get("versions") or {}
+    if config.get("active") not in versions:
+        raise ValueError(f"Active model {config.get('active')!r} is not registered in {path}")
+    shadow = config.get("shadow") or None
+    if shadow and shadow.get("version") not in versions:
+        raise ValueError(f"Shadow model {shadow.get('version')!r} is not registered in {path}")
+    return dict(config, shadow=shadow)
+
+
+def write_registry(config):
+    """
+    Replace the registry file. Running processes pick up the change within
+    ML_MODEL_REGISTRY_POLL seconds.
+    """
+    path = _setting('ML_MODEL_REGISTRY', None)
+    if not path:
+        raise ValueError("ML_MODEL_REGISTRY is not set")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Written in one step, other processes may be reading it
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def activate_version(version):
+    """Make a registered version the active model, ending its shadow run if it had one"""
+    config = read_registry()
+    if version not in config["versions"]:
+        raise ValueError(f"Model version {version!r} is not registered")
+    config["active"] = version
+    if config["shadow"] and config["shadow"]["version"] == version:
+        config["shadow"] = None
+    write_registry(config)
+
+
+class ModelRegistry:
+    """
+    The model versions this process serves: the active one, which classifies every
+    upload, and optionally a shadow candidate that scores a sample of the same
+    batches in the background (see shadow.py).
+
+    The versions come from the ML_MODEL_REGISTRY file, which is checked for changes
+    at most every ML_MODEL_REGISTRY_POLL seconds. A newly activated version is loaded
+    and warmed up on a background thread while the previous one keeps serving, then
+    becomes active with a single assignment. Batches already running hold their own
+    reference to the previous model and finish on it; it is freed after that.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked_at = 0
+        self._mtime = self._registry_mtime()
+        self.active = None
+        self.shadow = None
+        self.shadow_rate = 0.0
+        self.switching_to = None
+        self.error = None
+        try:
+            config = read_registry()
+        except (ValueError, KeyError) as e:
+            # Still serve the configured model rather than fail every import
+            self.error = f"Ignoring the model registry: {str(e)}"
+            print(self.error)
+            config = default_registry()
+        self._apply(config)
+
+    @staticmethod
+    def _registry_mtime():
+        try:
+            return os.stat(_setting('ML_MODEL_REGISTRY', None)).st_mtime_ns
+        except (TypeError, OSError):
+            return None
+
+    def _model(self, config, version):
+        entry = config["versions"][version]
+        current = [model for model in (self.active, self.shadow) if model is not None and model.version == version]
+        if current and current[0].path == entry["path"] and current[0].backend == entry.get("backend", "keras"):
+            return current[0]
+        return LoadedModel(version, entry["path"], entry.get("backend", "keras"), entry.get("labels"))
+
+    def _apply(self, config):
+        active = self._model(config, config["active"])
+        shadow = config["shadow"]
+        self.shadow = self._model(config, shadow["version"]) if shadow else None
+        self.shadow_rate = float(shadow.get("sample_rate", 0.1)) if shadow else 0.0
+
+        if active is self.active:
+            return
+        if self.active is None or not self.active.is_loaded:
+            # Nothing is being served yet, the new version is loaded on first use
+            self.active = active
+            return
+        self.switching_to = active.version
+        threading.Thread(target=self._switch, args=(active,), name="model-switch", daemon=True).start()
+
+    def _switch(self, model):
+        try:
+            model.warm_up()
+        except Exception as e:
+            self.error = f"Could not switch to model {model.version}, still serving {self.active.version}: {str(e)}"
+            print(self.error)
+        else:
+            previous, self.active = self.active, model
+            self.error = None
+            print(f"Switched from model {previous.version} to {model.version}")
+        finally:
+            self.switching_to = None
+
+    def refresh(self):
+        """Apply changes to the registry file, at most once per ML_MODEL_REGISTRY_POLL seconds"""
+        now = time.monotonic()
+        if now - self._checked_at < _setting('ML_MODEL_REGISTRY_POLL', 5):
+            return
+        self._checked_at = now
+        mtime = self._registry_mtime()
+        if mtime == self._mtime:
+            return
+
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            self._mtime = mtime
+            try:
+                self._apply(read_registry())
+            except (ValueError, KeyError) as e:
+                self.error = f"Ignoring the changed model registry: {str(e)}"
+                print(self.error)
+
+    def current(self):
+        """The LoadedModel that serves predictions right now"""
+        self.refresh()
+        return self.active
+
+    def info(self):
+        return {
+            "active": self.active.info(),
+            "shadow": dict(self.shadow.info(), sample_rate=self.shadow_rate) if self.shadow else None,
+            "switching_to": self.switching_to,
+            "error": self.error,
+        }
+
+
+def model_source(version=None):
+    """(backend, path) of a registered model version, by default the active one"""
+    config = read_registry()
+    entry = config["versions"][version or config["active"]]
+    return entry.get("backend", "keras"), entry["path"]
+
+
+def model_labels(version=None):
+    """Class labels of a registered model version, by default the active one"""
+    config = read_registry()
+    labels = config["versions"][version or config["active"]].get("labels")
+    return dict(enumerate(labels)) if labels else class_labels
+
+
+registry = ModelRegistry()
+
+
+def get_model():
+    """Return the loaded active model, loading it on first use"""
+    return registry.current().get()
+
+
+def warm_up():
+    """
+    Load the model and run dummy forward passes so the first real request
+    doesn't pay for graph construction. Safe to call from several threads.
+    """
+    try:
+        registry.current().warm_up()
+    except Exception as e:
+        print(f"Model warm-up failed: {str(e)}")
+
+
+def model_status():
+    """Status and load timing of the models, without triggering a load"""
+    active = registry.current()
+    readiness = read_readiness(active.path, active.backend)
+    check = None
+    if readiness is not None:
+        check = {key: readiness.get(key) for key in ("status", "checked_at", "sha256", "fingerprint", "error")}
+    # The active model's fields stay at the top level for existing clients
+    return dict(active.info(), check=check, registry=registry.info())
+
+
+def model_version():
+    """
+    Name of the active model version. It is stored on every prediction and keys the
+    prediction cache, so a new model doesn't reuse the old one's results.
+    """
+    return registry.current().version
+
+
+def classify_batch(images):
+    """
+    Run a batch of preprocessed images through the active model in one forward pass
+
+    Args:
+        images: float32 array of shape (N, 224, 224, 3)
+
+    Returns:
+        list of Prediction: label, confidence and model version for each image
+    """
+    model = registry.current()
+    start = time.perf_counter()
+    predictions = model.classify(images)
+    latency = time.perf_counter() - start
+    metrics.observe('upload_stage_seconds', latency, stage='inference')
+    metrics.observe('inference_batch_size', len(images))
+
+    shadow = registry.shadow
+    if shadow is not None and random.random() < registry.shadow_rate:
+        from .shadow import get_evaluator
+        get_evaluator().submit(shadow, images, predictions, latency)
+    return predictions
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """The process-wide micro-batching engine, created on first use"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = BatchInferenceEngine(
+                    classify_batch,
+                    max_batch_size=_setting('ML_BATCH_MAX_SIZE', 16),
+                    max_wait_ms=_setting('ML_BATCH_MAX_WAIT_MS', 5),
+                )
+                metrics.gauge('inference_queue_depth', _engine.pending)
+    return _engine
+
+
+def load_and_preprocess_image_tf(image_path):
+    """The original TensorFlow preprocessing, kept for ML_PREPROCESS_BACKEND = 'tensorflow'"""
+    import tensorflow as tf
 
-def load_and_preprocess_image(image_path):
     img = tf.io.read_file(image_path)
-    img = tf.image.decode_jpeg(img, channels=3)
+    # decode_image handles JPEG, PNG (e.g. the model-input derivative), GIF and BMP
+    img = tf.io.decode_image(img, channels=3, expand_animations=False)
     img = tf.image.resize(img, (224, 224))
     img = img / 255.0
     return img
 
+
+def decode_for_model(image_path):
+    """
+    Decode an image the way load_and_preprocess_image does, for when the decoded
+    image is also needed for something else (thumbnails). Pass it back as `image`.
+    """
+    return decode_image(image_path, draft=_setting('ML_PREPROCESS_DRAFT', False))
+
+
+def load_and_preprocess_image(image_path, out=None, image=None):
+    """
+    Decode, resize to 224x224 and scale an image to [0, 1] for the model
+
+    Args:
+        image_path: Path to the image file
+        out: Optional preallocated float32 array of shape (224, 224, 3) to write into
+        image: The file already decoded with decode_for_model, so it isn't read
+            again. The tensorflow backend always decodes the file itself.
+
+    Returns:
+        float32 array of shape (224, 224, 3)
+    """
+    with timed('preprocess'):
+        if _setting('ML_PREPROCESS_BACKEND', 'pillow') == 'tensorflow':
+            tf_input = np.asarray(load_and_preprocess_image_tf(image_path), dtype=np.float32)
+            if out is None:
+                return tf_input
+            out[...] = tf_input
+            return out
+        if image is not None:
+            return image_to_input(image, out=out)
+        return preprocess_image(image_path, out=out, draft=_setting('ML_PREPROCESS_DRAFT', False))
+
 def predict_image(image_path):
     """
     Process an uploaded image through the corn disease classification model
-    
+
     Args:
         image_path: Path to the uploaded image file
-        
+
     Returns:
         (str, float): A tuple containing predicted class label and confidence score
     """
+    label, confidence, _ = predict_image_versioned(image_path)
+    return label, confidence
+
+def predict_image_versioned(image_path, image=None):
+    """
+    Same as predict_image, also telling which model version ran
+
+    Args:
+        image_path: Path to the uploaded image file
+        image: The file already decoded with decode_for_model, see load_and_preprocess_image
+
+    Returns:
+        Prediction: predicted class label, confidence score and model version
+    """
     try:
-        # Preprocess the image
-        image = load_and_preprocess_image(image_path)
-        image = tf.expand_dims(image, axis=0)
-        
-        # Make prediction
-        preds = model.predict(image)
-        
-        # Get class with highest probability
-        predicted_class = np.argmax(preds, axis=1)[0]
-        confidence = float(preds[0][predicted_class])
-        
-        # Map to class labels
-        class_labels = {0: "blight", 1: "common_rust", 2: "gray_leaf_spot", 3: "healthy"}
-        prediction = class_labels.get(predicted_class, "Unknown")
-        
-        return prediction, confidence
-        
+        # Preprocess on the calling thread so concurrent requests decode in parallel
+        return predict_input_versioned(load_and_preprocess_image(image_path, image=image))
     except Exception as e:
         print(f"Error in prediction: {str(e)}")
         raise e
 
-# Testing code (runs when this module is executed directly)
+def predict_input(image):
+    """
+    Same as predict_image for an image that is already preprocessed
+
+    Args:
+        image: float32 array of shape (224, 224, 3), see load_and_preprocess_image
+
+    Returns:
+        (str, float): A tuple containing predicted class label and confidence score
+    """
+    label, confidence, _ = predict_input_versioned(image)
+    return label, confidence
+
+def predict_input_versioned(image):
+    """
+    Same as predict_input, also telling which model version ran
+
+    Returns:
+        Prediction: predicted class label, confidence score and model version
+    """
+    if not _setting('ML_BATCHING_ENABLED', True):
+        return classify_batch(np.expand_dims(image, axis=0))[0]
+
+    # Concurrent requests are batched into one forward pass by the engine
+    return get_engine().predict(image)
+
+def predict_images(image_paths):
+    """
+    Same as predict_image for several files at once. The images are sent through
+    the model in batches of up to ML_BATCH_MAX_SIZE.
+
+    Returns:
+        list of (str, float): one (label, confidence) tuple per path, in order
+    """
+    batch_size = _setting('ML_BATCH_MAX_SIZE', 16)
+    results = []
+    for start in range(0, len(image_paths), batch_size):
+        chunk = image_paths[start:start + batch_size]
+        # Decoded straight into a reused buffer instead of stacking per-image arrays
+        images = batch_buffer(len(chunk))
+        for i, path in enumerate(chunk):
+            load_and_preprocess_image(path, out=images[i])
+        results.extend((label, confidence) for label, confidence, _ in classify_batch(images))
+    return results
+
+# Testing code (run with: python -m upload.ml_processor)
 if __name__ == "__main__":
     image_path = os.path.join(os.path.dirname(__file__), "Notebook", "gray.png")
-    prediction, confidence = predict_image(image_path)
-    print(f"Predicted: {prediction} with confidence: {confidence:.2%}")
\ No newline at end of file
+    prediction, confidence, version = predict_image_versioned(image_path)
+    print(f"Predicted: {prediction} with confidence: {confidence:.2%} (model {version})")
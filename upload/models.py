@@ -1,18 +1,61 @@
+from django.conf import settings
 from django.db import models
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
+import json
 import os
 from django.core.validators import MinValueValidator, MaxValueValidator
+from .geohash import encode as encode_geohash
 
 class Farmer(AbstractUser):
     phone_number = models.CharField(max_length=15, blank=True)
     farm_location = models.CharField(max_length=200, blank=True)
     profile_picture = models.ImageField(upload_to='profile_pics/', null=True, blank=True)
     days = models.IntegerField(default=7, validators=[MinValueValidator(1), MaxValueValidator(14)])
+    # Last time the farmer had the home page's event stream open; their uploads'
+    # forecasts are kept up to date while it is recent (see events.py)
+    events_seen_at = models.DateTimeField(null=True, blank=True)
+    
+    @property
+    def profile_thumbnail_url(self):
+        from .derivatives import derivative_url
+        return derivative_url(self.profile_picture, 'avatar')
     
     def __str__(self):
         return self.username
 
+class Forecast(models.Model):
+    """
+    A formatted weather forecast for a geohash cell. Uploads from the same area on the
+    same day share one row instead of each storing (and fetching) their own copy.
+    """
+    geohash = models.CharField(max_length=12)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    units = models.CharField(max_length=12, default='fahrenheit')
+    days = models.IntegerField()
+    issued_on = models.DateField()
+    fetched_at = models.DateTimeField(default=timezone.now)
+    data = models.JSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['geohash', 'units', 'days', 'issued_on'], name='upload_forecast_unique_per_day'),
+        ]
+
+    def __str__(self):
+        return f"Forecast for {self.geohash} ({self.days} days, fetched {self.fetched_at.strftime('%Y-%m-%d %H:%M')})"
+
+class UploadBatch(models.Model):
+    """Images uploaded together (several files or a ZIP archive), processed by one job"""
+    farmer = models.ForeignKey(Farmer, on_delete=models.CASCADE, related_name='upload_batches')
+    created_at = models.DateTimeField(default=timezone.now)
+    # Files that were refused while uploading, as {'name', 'status', 'error'} entries
+    rejected = models.JSONField(default=list, blank=True)
+
+    def __str__(self):
+        return f"Batch {self.id} by {self.farmer}"
+
 class UploadedFile(models.Model):
     farmer = models.ForeignKey(Farmer, on_delete=models.CASCADE, related_name='uploads', null=True, blank=True)
     title = models.CharField(max_length=100, blank=True)
@@ -24,11 +67,197 @@ class UploadedFile(models.Model):
     prediction = models.CharField(max_length=50, null=True, blank=True)
     confidence = models.FloatField(null=True, blank=True)
     forecast_days = models.IntegerField(default=2, null=True, blank=True)
+    forecast = models.ForeignKey(Forecast, on_delete=models.SET_NULL, related_name='uploads', null=True, blank=True)
+    # SHA-256 of the file, computed while it was uploaded. Uploads of the same image
+    # share one stored file (see blobs.py).
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    batch = models.ForeignKey(UploadBatch, on_delete=models.SET_NULL, related_name='files', null=True, blank=True)
+    # Model version that made the prediction, blank for uploads from before versions were recorded
+    model_version = models.CharField(max_length=100, blank=True, default='', db_index=True)
+    # Geohash of the coordinates at UPLOAD_GEOHASH_PRECISION, blank without them. Kept
+    # in sync by save() and set_geohash(); the disease map reads it (see disease_map.py).
+    geohash = models.CharField(max_length=12, blank=True, default='')
+    
+    class Meta:
+        indexes = [
+            # Serves the per-farmer history, newest first, and its keyset pagination
+            models.Index(fields=['farmer', '-uploaded_at', '-id'], name='upload_file_history_idx'),
+            # Latest predictions for the public feed on the login page
+            models.Index(fields=['-uploaded_at'], condition=models.Q(prediction__isnull=False), name='upload_public_feed_idx'),
+            # Disease map: geohash ranges of a bounding box, counted per cell and
+            # prediction within a time window, all read from the index
+            models.Index(fields=['geohash', 'uploaded_at', 'prediction'], name='upload_file_map_idx'),
+        ]
+    
+    @property
+    def thumbnail_url(self):
+        from .derivatives import derivative_url
+        return derivative_url(self.file, 'thumb')
+    
+    @property
+    def preview_url(self):
+        """Screen-sized copy of the image for the image modal"""
+        from .derivatives import derivative_url
+        return derivative_url(self.file, 'preview')
+    
+    @property
+    def weather_data(self):
+        return self.forecast.data if self.forecast_id else None
+    
+    @property
+    def weather_json(self):
+        """The forecast as JSON for the page's image modal"""
+        return json.dumps(self.weather_data)
+    
+    def set_geohash(self):
+        """Update geohash from latitude and longitude, for saves that skip save() (bulk_create, bulk_update)"""
+        if self.latitude is None or self.longitude is None:
+            self.geohash = ''
+        else:
+            self.geohash = encode_geohash(self.latitude, self.longitude, settings.UPLOAD_GEOHASH_PRECISION)
     
     def save(self, *args, **kwargs):
         if not self.title:
             self.title = os.path.splitext(os.path.basename(self.file.name))[0]
+        self.set_geohash()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'geohash'}
         super().save(*args, **kwargs)
     
     def __str__(self):
         return f"File uploaded by {self.farmer.username if self.farmer else 'Unknown'} at {self.uploaded_at.strftime('%Y-%m-%d %H:%M:%S')}"
+
+class ProcessingJob(models.Model):
+    """
+    An uploaded file (or a batch of them) waiting for, or done with, inference,
+    geocoding and forecast
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    uploaded_file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, related_name='jobs', null=True, blank=True)
+    batch = models.ForeignKey(UploadBatch, on_delete=models.CASCADE, related_name='jobs', null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.IntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='upload_job_status_idx'),
+        ]
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    def __str__(self):
+        if self.batch_id:
+            return f"Job {self.id} for batch {self.batch_id} ({self.status})"
+        return f"Job {self.id} for file {self.uploaded_file_id} ({self.status})"
+
+class GeocodeCache(models.Model):
+    """Resolved place name for a geohash cell, so farms are reverse geocoded only once"""
+    geohash = models.CharField(max_length=12, unique=True)
+    location_name = models.CharField(max_length=200)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.geohash}: {self.location_name}"
+
+class PredictionCache(models.Model):
+    """Prediction for an image's content hash, reused when the same photo is uploaded again"""
+    content_hash = models.CharField(max_length=64)
+    model_version = models.CharField(max_length=100)
+    prediction = models.CharField(max_length=50)
+    confidence = models.FloatField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_hash', 'model_version'], name='upload_prediction_cache_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} ({self.model_version}): {self.prediction}"
+
+class ShadowPrediction(models.Model):
+    """
+    A candidate model's prediction for an image, next to the active model's prediction
+    for the same image. Recorded for a sample of traffic while the candidate is in
+    shadow mode, to compare the two before switching.
+    """
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    active_version = models.CharField(max_length=100)
+    candidate_version = models.CharField(max_length=100, db_index=True)
+    active_prediction = models.CharField(max_length=50)
+    active_confidence = models.FloatField()
+    candidate_prediction = models.CharField(max_length=50)
+    candidate_confidence = models.FloatField()
+    agrees = models.BooleanField()
+    # Size of the batch both models ran, and the time each forward pass took for it
+    batch_size = models.IntegerField(default=1)
+    active_latency_ms = models.FloatField()
+    candidate_latency_ms = models.FloatField()
+
+    def __str__(self):
+        return f"{self.candidate_version} vs {self.active_version}: {self.candidate_prediction} / {self.active_prediction}"
+
+class UserEvent(models.Model):
+    """Something to push to a farmer's open pages: a finished job or a changed forecast"""
+    KIND_JOB = 'job'
+    KIND_FORECAST = 'forecast'
+    KIND_CHOICES = [
+        (KIND_JOB, 'Job finished'),
+        (KIND_FORECAST, 'Forecast changed'),
+    ]
+
+    farmer = models.ForeignKey(Farmer, on_delete=models.CASCADE, related_name='events')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    data = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Event streams read a farmer's events after the last id they sent
+            models.Index(fields=['farmer', 'id'], name='upload_event_stream_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} event {self.id} for {self.farmer_id}"
+
+class ProfileRecord(models.Model):
+    """
+    A request run under the sampling profiler (upload/profiling.py): where its time
+    went as collapsed stacks, and the SQL queries it made
+    """
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    user = models.ForeignKey(Farmer, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    status_code = models.IntegerField(null=True, blank=True)
+    duration_ms = models.FloatField()
+    # "frame;frame;frame count" lines, the input format of flamegraph.pl and speedscope
+    collapsed_stacks = models.TextField(blank=True)
+    sample_count = models.IntegerField(default=0)
+    interval_ms = models.FloatField()
+    # [{"sql": ..., "ms": ...}] in execution order, at most PROFILER_MAX_QUERIES of them
+    queries = models.JSONField(default=list)
+    query_count = models.IntegerField(default=0)
+    query_ms = models.FloatField(default=0)
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
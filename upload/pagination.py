@@ -0,0 +1,56 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+'''
+    Keyset ("seek") pagination for upload history.
+
+    Pages are addressed by the (uploaded_at, id) of the last row shown rather than an
+    OFFSET, so fetching page 100 costs the same index range scan as page 1.
+'''
+
+
+def encode_cursor(uploaded_file):
+    """Opaque cursor pointing just after this row"""
+    raw = f"{uploaded_file.uploaded_at.isoformat()}|{uploaded_file.pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns:
+        (datetime, int): uploaded_at and id of the last row of the previous page
+
+    Raises:
+        ValueError: if the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        uploaded_at, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(uploaded_at), int(pk)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def keyset_page(queryset, cursor=None, page_size=20):
+    """
+    One page of uploads, newest first
+
+    Args:
+        queryset: UploadedFile queryset, already filtered (e.g. by farmer)
+        cursor: next_cursor from the previous page, or None for the first page
+        page_size: Number of rows per page
+
+    Returns:
+        (list, str or None): the rows and the cursor for the next page (None on the last page)
+    """
+    queryset = queryset.order_by('-uploaded_at', '-id')
+    if cursor:
+        uploaded_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, id__lt=pk))
+
+    # One extra row tells us whether there is another page
+    rows = list(queryset[:page_size + 1])
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
@@ -0,0 +1,53 @@
+from django.db import IntegrityError
+
+from .metrics import cache_result
+from .models import PredictionCache
+
+'''
+    Predictions keyed by (content hash, model version).
+
+    Farmers often upload the same photo more than once. A repeat upload with a
+    known hash gets the stored prediction and confidence without a forward pass
+    through the model. Results are keyed by model version as well, so replacing the
+    model (ML_MODEL_VERSION) makes every image get classified again.
+'''
+
+
+def cached_prediction(content_hash, predict):
+    """
+    Prediction for an image, from the cache when the same content was classified before
+
+    Args:
+        content_hash: SHA-256 of the image, or '' if unknown (never cached)
+        predict: Called with no arguments on a cache miss, returns a Prediction
+
+    Returns:
+        Prediction: predicted class label, confidence and model version
+    """
+    from .ml_processor import Prediction, model_version
+
+    if not content_hash:
+        return predict()
+
+    version = model_version()
+    cached = (PredictionCache.objects
+              .filter(content_hash=content_hash, model_version=version)
+              .values_list('prediction', 'confidence')
+              .first())
+    cache_result('prediction', cached is not None)
+    if cached is not None:
+        return Prediction(*cached, version)
+
+    prediction = predict()
+    try:
+        # Cached under the version that actually ran, which differs from `version`
+        # if a new model was activated while this image was being classified
+        PredictionCache.objects.get_or_create(
+            content_hash=content_hash,
+            model_version=prediction.model_version,
+            defaults={'prediction': prediction.label, 'confidence': prediction.confidence},
+        )
+    except IntegrityError:
+        # The same image was classified by another worker at the same time
+        pass
+    return prediction
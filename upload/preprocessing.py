@@ -0,0 +1,137 @@
+import os
+import threading
+
+import numpy as np
+from PIL import Image, ImageOps
+
+'''
+    Model input preprocessing with Pillow and NumPy.
+
+    Builds the 224x224 float32 input of the original TensorFlow pipeline
+    (tf.io.read_file -> decode -> tf.image.resize -> / 255), apart from JPEG
+    decoding, without running TensorFlow ops per image:
+
+    - PNG, WebP, GIF and BMP inputs are identical to the TensorFlow pipeline's.
+    - JPEGs are not quite: Pillow decodes them with libjpeg's accurate integer
+      DCT, while tf.io.decode_jpeg defaults to the fast one. Values differ by up
+      to about 0.02 from the original pipeline, and match it exactly when that
+      decodes with dct_method='INTEGER_ACCURATE'.
+    - resize_bilinear reproduces tf.image.resize's bilinear kernel (half-pixel
+      centers, no antialiasing) with the same float32 arithmetic.
+    - JPEGs can optionally be decoded in draft mode, where libjpeg downscales by
+      1/2, 1/4 or 1/8 while decoding, so a 12 MP photo is never fully decoded. The
+      result is close to, but not bit-identical with, the full decode, so it is
+      off unless asked for (draft=True, ML_PREPROCESS_DRAFT).
+    - EXIF orientation is applied, so rotated phone photos reach the model upright.
+    - Any format Pillow reads (JPEG, PNG, WebP, ...) is accepted.
+'''
+
+INPUT_SIZE = 224
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif')
+
+_buffers = threading.local()
+
+
+def _interpolation(in_size, out_size):
+    # Same as TensorFlow's compute_interpolation_weights with HalfPixelScaler
+    scale = np.float32(in_size) / np.float32(out_size)
+    centers = (np.arange(out_size, dtype=np.float32) + np.float32(0.5)) * scale - np.float32(0.5)
+    floors = np.floor(centers)
+    lower = np.maximum(floors, 0).astype(np.intp)
+    upper = np.minimum(np.ceil(centers), in_size - 1).astype(np.intp)
+    lerp = (centers - floors).astype(np.float32)
+    return lower, upper, lerp
+
+
+def resize_bilinear(pixels, size=INPUT_SIZE):
+    """
+    Resize an (H, W, C) image to (size, size, C) float32 like tf.image.resize(method='bilinear')
+    """
+    height, width = pixels.shape[:2]
+    y_lower, y_upper, y_lerp = _interpolation(height, size)
+    x_lower, x_upper, x_lerp = _interpolation(width, size)
+
+    # Only the rows that are sampled get converted to float
+    top_rows = pixels[y_lower].astype(np.float32)
+    bottom_rows = pixels[y_upper].astype(np.float32)
+
+    # Interpolate along x first, then y, in the same order as TensorFlow's kernel
+    x_lerp = x_lerp[None, :, None]
+    top_left = top_rows[:, x_lower]
+    bottom_left = bottom_rows[:, x_lower]
+    top = top_left + (top_rows[:, x_upper] - top_left) * x_lerp
+    bottom = bottom_left + (bottom_rows[:, x_upper] - bottom_left) * x_lerp
+    return top + (bottom - top) * y_lerp[:, None, None]
+
+
+def decode_image(image_path, draft=False, size=INPUT_SIZE):
+    """Decode an image to an upright RGB PIL image, optionally at reduced scale"""
+    with Image.open(image_path) as image:
+        if draft:
+            # No-op for formats other than JPEG
+            image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        return image.convert('RGB')
+
+
+def load_pixels(image_path, draft=False, size=INPUT_SIZE):
+    """Decode an image to an upright (H, W, 3) uint8 array, optionally at reduced scale"""
+    return np.asarray(decode_image(image_path, draft=draft, size=size))
+
+
+def preprocess_image(image_path, out=None, draft=False):
+    """
+    Model input for one image
+
+    Args:
+        image_path: Image file to read
+        out: Optional preallocated float32 array of shape (224, 224, 3) to write into
+        draft: Decode JPEGs at reduced scale (faster, not bit-identical to a full decode)
+
+    Returns:
+        float32 array of shape (224, 224, 3) with values in [0, 1]
+    """
+    return pixels_to_input(load_pixels(image_path, draft=draft), out=out)
+
+
+def image_to_input(image, out=None):
+    """Model input from an image decoded with decode_image, e.g. one kept from the upload"""
+    return pixels_to_input(np.asarray(image), out=out)
+
+
+def pixels_to_input(pixels, out=None):
+    if out is None:
+        out = np.empty((INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32)
+    np.divide(resize_bilinear(pixels), np.float32(255.0), out=out)
+    return out
+
+
+def batch_buffer(size):
+    """
+    A reusable float32 (size, 224, 224, 3) buffer owned by the calling thread. It is
+    overwritten by the next call on the same thread, so use it before asking again.
+    """
+    buffer = getattr(_buffers, 'batch', None)
+    if buffer is None or buffer.shape[0] < size:
+        buffer = np.empty((size, INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32)
+        _buffers.batch = buffer
+    return buffer[:size]
+
+
+def preprocess_batch(image_paths, draft=False):
+    """Model inputs for several images, written into this thread's reusable buffer"""
+    batch = batch_buffer(len(image_paths))
+    for i, image_path in enumerate(image_paths):
+        preprocess_image(image_path, out=batch[i], draft=draft)
+    return batch
+
+
+def list_images(directory):
+    """Image files under a directory (recursively), sorted by path"""
+    return sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names
+        if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('.')
+    )
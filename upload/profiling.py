@@ -0,0 +1,281 @@
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
+
+'''
+    On-demand request profiler.
+
+    With PROFILER_ENABLED, a request carrying ?_profile=1 from a staff user, or a
+    signed ?_profile=<token> link from `manage.py profile_link`, is run while a
+    background thread samples the request thread's stack every
+    PROFILER_INTERVAL_MS. The samples are stored as collapsed stacks (one
+    "frame;frame;frame count" line per distinct stack) with every SQL query the
+    request made and its duration, in a ProfileRecord the admin renders as a flame
+    graph. The response's X-Profile header links to it.
+
+    Without PROFILER_ENABLED the middleware raises MiddlewareNotUsed and Django
+    drops it at startup, and no query wrapper is installed.
+
+    Under ASGI the event loop thread is sampled: code run with sync_to_async shows
+    up as the coroutine waiting for it, its queries are still recorded.
+'''
+
+PROFILE_PARAM = '_profile'
+SIGNING_SALT = 'upload.profiling'
+
+# The profile the current request (or the sync_to_async threads it calls) is recording
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+def signed_profile_token(path):
+    """Token for ?_profile= that profiles requests to `path` for anyone, until it expires"""
+    return signing.dumps({'path': path}, salt=SIGNING_SALT)
+
+
+def valid_token(token, path):
+    try:
+        payload = signing.loads(token, salt=SIGNING_SALT, max_age=settings.PROFILER_LINK_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return payload.get('path') == path
+
+
+class StackSampler:
+    """
+    Samples one thread's stack from a background thread
+
+    Args:
+        thread_id: threading.get_ident() of the thread to sample
+        interval: Seconds between samples
+        root_codes: Code objects where stacks are cut, so they start at the middleware
+    """
+
+    def __init__(self, thread_id, interval, root_codes=()):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root_codes = set(root_codes)
+        self.stacks = Counter()
+        self.samples = 0
+        self._labels = {}
+        # Longest first, so frames are labelled relative to the innermost sys.path entry
+        self._prefixes = sorted((p + os.sep for p in sys.path if p), key=len, reverse=True)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(self._label(code))
+                if code in self.root_codes:
+                    break
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[';'.join(stack)] += 1
+            self.samples += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            path = code.co_filename
+            for prefix in self._prefixes:
+                if path.startswith(prefix):
+                    path = path[len(prefix):]
+                    break
+            # ';' separates frames in the collapsed format
+            label = self._labels[code] = f"{code.co_name} ({path}:{code.co_firstlineno})".replace(';', ':')
+        return label
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class RequestProfile:
+    """Stack samples and SQL queries of one request"""
+
+    def __init__(self, thread_id, root_codes):
+        self.sampler = StackSampler(thread_id, settings.PROFILER_INTERVAL_MS / 1000, root_codes)
+        self.queries = []
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.started = None
+        self.duration = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.sampler.start()
+
+    def stop(self):
+        self.sampler.stop()
+        self.duration = time.perf_counter() - self.started
+
+    def add_query(self, sql, seconds):
+        self.query_count += 1
+        self.query_seconds += seconds
+        if len(self.queries) < settings.PROFILER_MAX_QUERIES:
+            self.queries.append({'sql': sql, 'ms': round(seconds * 1000, 3)})
+
+    def save(self, request, user, response):
+        """Store the profile as a ProfileRecord, dropping the oldest beyond PROFILER_KEEP"""
+        from .models import ProfileRecord
+
+        record = ProfileRecord.objects.create(
+            user=user if user is not None and user.is_authenticated else None,
+            method=request.method,
+            path=request.get_full_path()[:500],
+            status_code=getattr(response, 'status_code', None),
+            duration_ms=round(self.duration * 1000, 2),
+            collapsed_stacks=self.sampler.collapsed(),
+            sample_count=self.sampler.samples,
+            interval_ms=settings.PROFILER_INTERVAL_MS,
+            queries=self.queries,
+            query_count=self.query_count,
+            query_ms=round(self.query_seconds * 1000, 2),
+        )
+        ProfileRecord.objects.filter(id__lte=record.id - settings.PROFILER_KEEP).delete()
+        return record
+
+
+def record_queries(execute, sql, params, many, context):
+    """Database execute wrapper adding queries to the profile being recorded, if any"""
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add_query(sql, time.perf_counter() - start)
+
+
+class ProfilerMiddleware:
+    """Profiles the requests that ask for it, see the module note"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PROFILER_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = request.GET.get(PROFILE_PARAM)
+        if not token or not (valid_token(token, request.path) or request.user.is_staff):
+            return self.get_response(request)
+
+        profile = RequestProfile(threading.get_ident(), [ProfilerMiddleware.__call__.__code__])
+        reset = current_profile.set(profile)
+        profile.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.stop()
+            current_profile.reset(reset)
+        return self.profiled_response(response, profile.save(request, request.user, response))
+
+    async def __acall__(self, request):
+        token = request.GET.get(PROFILE_PARAM)
+        if not token:
+            return await self.get_response(request)
+        user = await request.auser()
+        if not (valid_token(token, request.path) or user.is_staff):
+            return await self.get_response(request)
+
+        profile = RequestProfile(threading.get_ident(), [ProfilerMiddleware.__acall__.__code__])
+        reset = current_profile.set(profile)
+        profile.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profile.stop()
+            current_profile.reset(reset)
+        record = await sync_to_async(profile.save)(request, user, response)
+        return self.profiled_response(response, record)
+
+    def profiled_response(self, response, record):
+        from django.urls import reverse
+
+        response['X-Profile'] = reverse('admin:upload_profilerecord_change', args=[record.id])
+        return response
+
+
+def stack_tree(collapsed):
+    """Collapsed stacks as a tree of {'name', 'count', 'children'} frames under an 'all' root"""
+    root = {'name': 'all', 'count': 0, 'children': {}}
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if not count.isdigit():
+            continue
+        root['count'] += int(count)
+        node = root
+        for frame in stack.split(';'):
+            node = node['children'].setdefault(frame, {'name': frame, 'count': 0, 'children': {}})
+            node['count'] += int(count)
+    return root
+
+
+FLAME_GRAPH_STYLE = (
+    '.flame{font:11px monospace;overflow-x:auto}'
+    '.flame-node{display:inline-block;vertical-align:top;box-sizing:border-box}'
+    '.flame-frame{background:#f4b26b;border:1px solid #fff;padding:1px 3px;'
+    'white-space:nowrap;overflow:hidden;text-overflow:ellipsis}'
+    '.flame-children{display:flex}'
+)
+
+
+def flame_graph_html(collapsed, min_share=0.005):
+    """
+    Icicle-style flame graph of collapsed stacks for the admin, callers above
+    callees. Frames under min_share of the samples are left out.
+    """
+    root = stack_tree(collapsed)
+    total = root['count']
+    if not total:
+        return 'No samples (the request finished within one sampling interval)'
+
+    def render(node, parent_count):
+        children = sorted(node['children'].values(), key=lambda child: -child['count'])
+        return format_html(
+            '<div class="flame-node" style="width:{}%"><div class="flame-frame" title="{} ({} samples, {}%)">{}</div>'
+            '<div class="flame-children">{}</div></div>',
+            round(100 * node['count'] / parent_count, 3),
+            node['name'], node['count'], round(100 * node['count'] / total, 1), node['name'],
+            mark_safe(''.join(render(child, node['count']) for child in children if child['count'] / total >= min_share)),
+        )
+
+    return format_html('<style>{}</style><div class="flame">{}</div>', mark_safe(FLAME_GRAPH_STYLE), render(root, total))
+
+
+def query_table_html(queries):
+    """The SQL queries of a profile, in order, for the admin"""
+    return format_html(
+        '<table><tr><th>ms</th><th>SQL</th></tr>{}</table>',
+        format_html_join('', '<tr><td>{}</td><td><code>{}</code></td></tr>',
+                         ((query['ms'], query['sql']) for query in queries)),
+    )
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+
+from .models import UploadedFile
+
+'''
+    The "Community Reports" feed on the login page.
+
+    /login/ is the most requested anonymous URL, so the feed is kept in the shared
+    cache (both the rows and the rendered template fragment) and only rebuilt after
+    an upload gets a prediction or a reported upload is deleted (see signals.py).
+'''
+
+PUBLIC_FEED_CACHE_KEY = 'public_feed'
+PUBLIC_FEED_FRAGMENT = 'public_history'
+PUBLIC_FEED_SIZE = 10
+# Fields of an upload the feed shows or is ordered by
+PUBLIC_FEED_FIELDS = ('file', 'uploaded_at', 'location_name', 'prediction', 'confidence')
+
+
+def load_public_history():
+    return list(
+        UploadedFile.objects
+        .filter(prediction__isnull=False)
+        .only('id', *PUBLIC_FEED_FIELDS)
+        .order_by('-uploaded_at')[:PUBLIC_FEED_SIZE]
+    )
+
+
+def public_feed_state(instance):
+    """The upload's values of PUBLIC_FEED_FIELDS, to tell whether a save changed what the feed shows"""
+    # From __dict__: getattr would load deferred fields with a query each
+    values = (instance.__dict__.get(name) for name in PUBLIC_FEED_FIELDS)
+    return tuple(getattr(value, 'name', value) for value in values)
+
+
+def get_public_history():
+    """The latest uploads with predictions, from the cache when possible"""
+    return cache.get_or_set(PUBLIC_FEED_CACHE_KEY, load_public_history, settings.PUBLIC_FEED_CACHE_TTL)
+
+
+def invalidate_public_history():
+    cache.delete(PUBLIC_FEED_CACHE_KEY)
+    cache.delete(make_template_fragment_key(PUBLIC_FEED_FRAGMENT))
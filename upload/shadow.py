@@ -0,0 +1,118 @@
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .metrics import metrics
+
+'''
+    Shadow-mode evaluation of a candidate model.
+
+    While a version is registered as the shadow model (`manage.py models shadow`),
+    a sample of the batches the active model classifies is handed to a background
+    thread, which runs the same images through the candidate and stores both
+    predictions as ShadowPrediction rows. Uploads never wait for the candidate: when
+    the thread falls behind, sampled batches are dropped rather than queued without
+    bound. `manage.py models report` summarizes agreement and latency.
+'''
+
+
+class ShadowEvaluator:
+    """
+    Runs sampled batches through the shadow model on a background thread
+
+    Args:
+        max_pending: Batches that may wait for the thread before new ones are dropped
+    """
+
+    def __init__(self, max_pending=8):
+        self.max_pending = max(1, int(max_pending))
+        self._queue = queue.Queue(maxsize=self.max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+
+    def submit(self, model, images, predictions, latency):
+        """
+        Queue a batch the active model classified, without waiting for the candidate
+
+        Args:
+            model: The shadow LoadedModel
+            images: The batch the active model ran, copied since the caller reuses its buffer
+            predictions: The active model's Predictions for the batch
+            latency: Seconds the active model's forward pass took
+        """
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait((model, images.copy(), predictions, latency))
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc('shadow_batches_dropped_total')
+
+    def _ensure_worker(self):
+        # Same as the batching engine: threads don't survive gunicorn's fork
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                self._queue = queue.Queue(maxsize=self.max_pending)
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name="shadow-evaluator", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            model, images, predictions, latency = self._queue.get()
+            if model.status == "failed":
+                # Already reported when it failed to load, don't retry for every batch
+                continue
+            close_old_connections()
+            try:
+                self.evaluate(model, images, predictions, latency)
+            except Exception as e:
+                print(f"Error in shadow evaluation of model {model.version}: {str(e)}")
+
+    def evaluate(self, model, images, predictions, latency):
+        """Classify a batch with the candidate and store it next to the active predictions"""
+        from .models import ShadowPrediction
+
+        start = time.perf_counter()
+        candidates = model.classify(images)
+        candidate_latency = time.perf_counter() - start
+
+        ShadowPrediction.objects.bulk_create([
+            ShadowPrediction(
+                active_version=active.model_version,
+                candidate_version=candidate.model_version,
+                active_prediction=active.label,
+                active_confidence=active.confidence,
+                candidate_prediction=candidate.label,
+                candidate_confidence=candidate.confidence,
+                agrees=active.label == candidate.label,
+                batch_size=len(images),
+                active_latency_ms=round(latency * 1000, 2),
+                candidate_latency_ms=round(candidate_latency * 1000, 2),
+            )
+            for active, candidate in zip(predictions, candidates)
+        ])
+
+
+_evaluator = None
+_evaluator_lock = threading.Lock()
+
+
+def get_evaluator():
+    """The process-wide shadow evaluator, created on first use"""
+    global _evaluator
+    if _evaluator is None:
+        with _evaluator_lock:
+            if _evaluator is None:
+                _evaluator = ShadowEvaluator(max_pending=getattr(settings, 'ML_SHADOW_QUEUE_SIZE', 8))
+    return _evaluator
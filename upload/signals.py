@@ -0,0 +1,30 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .models import UploadedFile
+from .public_feed import PUBLIC_FEED_FIELDS, invalidate_public_history, public_feed_state
+
+
+@receiver(post_init, sender=UploadedFile)
+def uploaded_file_loaded(sender, instance, **kwargs):
+    instance._public_feed_state = public_feed_state(instance)
+
+
+@receiver(post_save, sender=UploadedFile)
+def uploaded_file_saved(sender, instance, created, update_fields=None, **kwargs):
+    previous = instance._public_feed_state
+    instance._public_feed_state = public_feed_state(instance)
+    # Saves that only touch other fields (e.g. the forecast) leave the feed as it is
+    if update_fields is not None and not set(update_fields) & set(PUBLIC_FEED_FIELDS):
+        return
+    # Uploads without a prediction never show up in the public feed
+    if not instance.prediction and not previous[PUBLIC_FEED_FIELDS.index('prediction')]:
+        return
+    if created or instance._public_feed_state != previous:
+        invalidate_public_history()
+
+
+@receiver(post_delete, sender=UploadedFile)
+def uploaded_file_deleted(sender, instance, **kwargs):
+    if instance.prediction:
+        invalidate_public_history()
@@ -1,3 +1,1231 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib.util import find_spec
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+import requests
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import artifacts, events, geocode_cache, geohash, http_client, ml_processor, shadow
+from .blobs import delete_upload, store_upload
+from .derivatives import create_derivatives, derivative_name
+from .disease_map import bbox_ranges, disease_map
+from .forecast import LEAF_WETNESS_HUMIDITY, format_forecast_data, stored_forecast, summarize_hourly_by_day
+from .inference import BatchInferenceEngine
+from .jobs import claim_next_job, enqueue, requeue_stale_jobs
+from .metrics import LATENCY_BUCKETS, Metrics, render_prometheus
+from .ml_processor import load_and_preprocess_image_tf
+from .models import Farmer, Forecast, GeocodeCache, ProcessingJob, ProfileRecord, ShadowPrediction, UploadedFile, UserEvent
+from .pagination import decode_cursor, encode_cursor, keyset_page
+from .preprocessing import preprocess_image
+from .profiling import PROFILE_PARAM, signed_profile_token
+from .public_feed import PUBLIC_FEED_CACHE_KEY
+
+'''
+    Tests run against throwaway caches and media, and never load the model.
+'''
+
+TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-default'},
+    'http': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-http'},
+}
+
+
+def image_bytes(width=32, height=32, fmt='PNG', noise=False):
+    if noise:
+        image = Image.frombytes('RGB', (width, height), random.Random(width).randbytes(width * height * 3))
+    else:
+        image = Image.new('RGB', (width, height), (40, 140, 60))
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+@override_settings(CACHES=TEST_CACHES, METRICS_ENABLED=False)
+class AppTestCase(TestCase):
+    """Gives each test its own MEDIA_ROOT and empty caches"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        cache.clear()
+        self.farmer = Farmer.objects.create_user('farmer', password='secret')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers with the server's next queued status, 200 and a JSON body once they run out"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            status = server.statuses.pop(0) if server.statuses else 200
+        time.sleep(server.delay)
+        body = json.dumps({'path': self.path}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with server.lock:
+            server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(HTTP_CLIENT_BACKOFF=0, HTTP_CLIENT_RETRIES=2)
+class HttpClientTests(AppTestCase):
+    """get_json and aget_json against a local stub server"""
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.statuses = []
+        self.server.active = 0
+        self.server.max_active = 0
+        self.server.delay = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/forecast"
+
+        # The session, its retry policy and the host limits are built from settings once per process
+        http_client._session = None
+        self.addCleanup(setattr, http_client, '_session', None)
+        patcher = mock.patch.object(http_client, '_host_limits', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_server_errors(self):
+        self.server.statuses = [503, 502]
+        data = http_client.get_json(self.url, {'q': 'a'})
+        self.assertEqual(data['path'], '/forecast?q=a')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        self.server.statuses = [503] * 5
+        with self.assertRaises(requests.RequestException):
+            http_client.get_json(self.url, {'q': 'a'})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_caches_responses_by_rounded_coordinates(self):
+        first = http_client.get_json(self.url, {'latitude': 42.03451, 'longitude': -93.62012})
+        # Within HTTP_CACHE_COORD_PRECISION of the first point
+        second = http_client.get_json(self.url, {'latitude': 42.03468, 'longitude': -93.62009})
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertIn('latitude=42.035', self.server.requests[0])
+
+        http_client.get_json(self.url, {'latitude': 42.1, 'longitude': -93.62})
+        self.assertEqual(len(self.server.requests), 2)
+
+    @override_settings(HTTP_CLIENT_HOST_CONCURRENCY={'127.0.0.1': 1})
+    def test_limits_concurrent_requests_per_host(self):
+        self.server.delay = 0.1
+        threads = [
+            threading.Thread(target=http_client.get_json, args=(self.url, {'q': i}))
+            for i in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.max_active, 1)
+
+    def test_async_client_retries_and_shares_the_cache(self):
+        self.server.statuses = [503]
+        data = async_to_sync(http_client.aget_json)(self.url, {'q': 'b'})
+        self.assertEqual(data['path'], '/forecast?q=b')
+        self.assertEqual(len(self.server.requests), 2)
+
+        # Cached by the async call, so the sync client doesn't ask again
+        self.assertEqual(http_client.get_json(self.url, {'q': 'b'}), data)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class BatchInferenceEngineTests(SimpleTestCase):
+
+    def images(self, count):
+        return [np.full((224, 224, 3), i, dtype=np.float32) for i in range(count)]
+
+    def test_batches_concurrent_requests_in_order(self):
+        batch_sizes = []
+
+        def predict_batch(images):
+            batch_sizes.append(len(images))
+            return [float(image[0, 0, 0]) for image in images]
+
+        # A long wait, so all five are queued before the first batch closes
+        engine = BatchInferenceEngine(predict_batch, max_batch_size=4, max_wait_ms=200)
+        futures = [engine.submit(image) for image in self.images(5)]
+        self.assertEqual([future.result(timeout=5) for future in futures], [0, 1, 2, 3, 4])
+        self.assertEqual(batch_sizes, [4, 1])
+
+    def assertAllFail(self, predict_batch, exception):
+        engine = BatchInferenceEngine(predict_batch, max_batch_size=8, max_wait_ms=200)
+        futures = [engine.submit(image) for image in self.images(3)]
+        for future in futures:
+            with self.assertRaises(exception):
+                future.result(timeout=5)
+        # The batching thread survives and serves the next request
+        engine.predict_batch = lambda images: ['ok'] * len(images)
+        self.assertEqual(engine.predict(self.images(1)[0], timeout=5), 'ok')
+
+    def test_model_error_fails_every_request(self):
+        def predict_batch(images):
+            raise ValueError("model failed")
+
+        self.assertAllFail(predict_batch, ValueError)
+
+    def test_wrong_result_count_fails_every_request(self):
+        self.assertAllFail(lambda images: ['only one'], RuntimeError)
+
+
+class JobQueueTests(AppTestCase):
+
+    def make_job(self, minutes_ago=0):
+        upload = UploadedFile.objects.create(farmer=self.farmer, file='uploads/leaf.jpg')
+        job = enqueue(upload)
+        ProcessingJob.objects.filter(id=job.id).update(created_at=timezone.now() - timedelta(minutes=minutes_ago))
+        return job
+
+    def test_claims_oldest_queued_job_once(self):
+        newer = self.make_job(minutes_ago=1)
+        older = self.make_job(minutes_ago=5)
+
+        claimed = claim_next_job('worker-1')
+        self.assertEqual(claimed.id, older.id)
+        self.assertEqual(claimed.status, ProcessingJob.STATUS_RUNNING)
+        self.assertEqual(claimed.worker, 'worker-1')
+        self.assertEqual(claimed.attempts, 1)
+
+        self.assertEqual(claim_next_job('worker-2').id, newer.id)
+        self.assertIsNone(claim_next_job('worker-3'))
+
+    @override_settings(UPLOAD_JOB_TIMEOUT=60, UPLOAD_JOB_MAX_ATTEMPTS=3)
+    def test_requeues_stale_jobs_and_fails_exhausted_ones(self):
+        stale = self.make_job()
+        exhausted = self.make_job()
+        fresh = self.make_job()
+        long_ago = timezone.now() - timedelta(minutes=10)
+        ProcessingJob.objects.filter(id=stale.id).update(status=ProcessingJob.STATUS_RUNNING, attempts=1, started_at=long_ago)
+        ProcessingJob.objects.filter(id=exhausted.id).update(status=ProcessingJob.STATUS_RUNNING, attempts=3, started_at=long_ago)
+        ProcessingJob.objects.filter(id=fresh.id).update(status=ProcessingJob.STATUS_RUNNING, attempts=1, started_at=timezone.now())
+
+        requeue_stale_jobs()
+
+        for job in (stale, exhausted, fresh):
+            job.refresh_from_db()
+        self.assertEqual(stale.status, ProcessingJob.STATUS_QUEUED)
+        self.assertEqual(fresh.status, ProcessingJob.STATUS_RUNNING)
+        self.assertEqual(exhausted.status, ProcessingJob.STATUS_FAILED)
+        self.assertEqual(exhausted.error, 'Processing timed out')
+        self.assertEqual(exhausted.uploaded_file.prediction, 'Processing failed')
+
+        # The page waiting for the job is told right away
+        event = UserEvent.objects.get(farmer=self.farmer)
+        self.assertEqual(event.kind, UserEvent.KIND_JOB)
+        self.assertEqual(event.data['id'], exhausted.id)
+        self.assertEqual(event.data['status'], ProcessingJob.STATUS_FAILED)
+
+
+class GeocodeCacheTests(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        geocode_cache.memory_cache.clear()
+        self.addCleanup(geocode_cache.memory_cache.clear)
+        self.resolve = mock.Mock(return_value="Ames, Iowa")
+
+    def lookup(self, latitude=42.03451, longitude=-93.62012):
+        return geocode_cache.cached_location_name(latitude, longitude, self.resolve)
+
+    def test_memory_then_database_tiers(self):
+        self.assertEqual(self.lookup(), "Ames, Iowa")
+        self.resolve.assert_called_once_with(42.03451, -93.62012)
+        key = geocode_cache.cell_key(42.03451, -93.62012)
+        self.assertEqual(GeocodeCache.objects.get(geohash=key).location_name, "Ames, Iowa")
+
+        # Same geohash cell, answered from memory
+        self.assertEqual(geocode_cache.cell_key(42.03452, -93.62013), key)
+        self.assertEqual(self.lookup(42.03452, -93.62013), "Ames, Iowa")
+
+        # A new process only has the table
+        geocode_cache.memory_cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.lookup(), "Ames, Iowa")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.lookup(), "Ames, Iowa")
+        self.assertEqual(self.resolve.call_count, 1)
+
+        self.lookup(41.5, -93.6)
+        self.assertEqual(self.resolve.call_count, 2)
+
+    def test_unresolved_points_are_not_cached(self):
+        self.resolve.return_value = None
+        self.assertIsNone(self.lookup())
+        self.assertIsNone(self.lookup())
+        self.assertEqual(self.resolve.call_count, 2)
+        self.assertFalse(GeocodeCache.objects.exists())
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        lru = geocode_cache.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+
+
+class ForecastAggregationTests(SimpleTestCase):
+    """Hourly humidity and dew point summarized per day"""
+
+    dates = ['2025-04-04', '2025-04-05', '2025-04-06']
+    hourly = {
+        # The first hour is outside the forecast days, the 6th has no hourly data
+        'time': ['2025-04-03T23:00', '2025-04-04T00:00', '2025-04-04T01:00', '2025-04-04T02:00',
+                 '2025-04-04T03:00', '2025-04-05T00:00', '2025-04-05T01:00'],
+        'relative_humidity_2m': [50, 80, 95, None, 91, 60, 70],
+        'dew_point_2m': [1, 10, 12, 14, None, 5, 6],
+    }
+
+    def test_summarizes_each_day(self):
+        self.assertEqual(summarize_hourly_by_day(self.hourly, self.dates), [
+            {'humidity': 89, 'humidity_min': 80, 'humidity_max': 95, 'leaf_wetness_hours': 2, 'dew_point': 12.0},
+            {'humidity': 65, 'humidity_min': 60, 'humidity_max': 70, 'leaf_wetness_hours': 0, 'dew_point': 5.5},
+            {'humidity': None, 'humidity_min': None, 'humidity_max': None, 'leaf_wetness_hours': None, 'dew_point': None},
+        ])
+
+    def test_matches_a_scan_per_day(self):
+        rng = random.Random(6)
+        start = datetime(2025, 4, 4)
+        dates = [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(16)]
+        times = [(start + timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M') for i in range(16 * 24)]
+        humidity = [rng.choice([None, rng.randint(20, 100)]) for _ in times]
+
+        summaries = summarize_hourly_by_day({'time': times, 'relative_humidity_2m': humidity}, dates)
+        for date_str, summary in zip(dates, summaries):
+            values = [h for t, h in zip(times, humidity) if t.startswith(date_str) and h is not None]
+            self.assertEqual(summary['humidity'], round(sum(values) / len(values)))
+            self.assertEqual((summary['humidity_min'], summary['humidity_max']), (min(values), max(values)))
+            self.assertEqual(summary['leaf_wetness_hours'], sum(h >= LEAF_WETNESS_HUMIDITY for h in values))
+            self.assertIsNone(summary['dew_point'])
+
+    def test_formatted_days(self):
+        data = format_forecast_data({
+            'daily': {'time': self.dates[:2], 'temperature_2m_max': [70, 72], 'weathercode': [0, 61]},
+            'hourly': self.hourly,
+        }, "Ames, Iowa")
+        first, second = data['days']
+        self.assertEqual(first['date'], '4/4/2025')
+        self.assertEqual((first['temp_high'], first['temp_low']), (70, None))
+        self.assertEqual((first['humidity'], first['leaf_wetness_hours']), (89, 2))
+        self.assertEqual(first['precipitation'], {'amount': 0, 'chance': 0})
+        self.assertEqual(second['humidity_max'], 70)
+
+
+class StoredForecastTests(AppTestCase):
+    """Uploads from the same geohash cell on the same day share one Forecast row"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('upload.forecast.weather_forecast', return_value={'days': [], 'updated': 'now'})
+        self.fetch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_cell_and_day_share_a_row(self):
+        first = stored_forecast(42.0345, -93.6201, 2)
+        # Same 6-character geohash cell; fewer than 14 days is stored as 14
+        second = stored_forecast(42.0350, -93.6205, 7)
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(first.days, 14)
+        self.assertEqual(self.fetch.call_count, 1)
+
+        stored_forecast(41.5, -93.6, 2)
+        self.assertEqual(Forecast.objects.count(), 2)
+
+    def test_stale_and_older_forecasts_are_fetched_again(self):
+        forecast = stored_forecast(42.0345, -93.6201, 14)
+
+        # Fetched too long ago today: refreshed in place
+        Forecast.objects.filter(pk=forecast.pk).update(fetched_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(stored_forecast(42.0345, -93.6201, 14).pk, forecast.pk)
+        self.assertEqual(self.fetch.call_count, 2)
+
+        # Issued on an earlier day: today's forecast gets its own row
+        Forecast.objects.filter(pk=forecast.pk).update(issued_on=timezone.localdate() - timedelta(days=1))
+        self.assertNotEqual(stored_forecast(42.0345, -93.6201, 14).pk, forecast.pk)
+        self.assertEqual(Forecast.objects.count(), 2)
+
+    def test_failed_fetches_are_not_stored(self):
+        self.fetch.return_value = {'days': [], 'error': 'timed out'}
+        forecast = stored_forecast(42.0345, -93.6201, 14)
+        self.assertIsNone(forecast.pk)
+        self.assertEqual(forecast.data['error'], 'timed out')
+        self.assertFalse(Forecast.objects.exists())
+
+
+class KeysetPaginationTests(AppTestCase):
+
+    def test_cursor_round_trip(self):
+        upload = UploadedFile.objects.create(farmer=self.farmer, file='uploads/leaf.jpg')
+        self.assertEqual(decode_cursor(encode_cursor(upload)), (upload.uploaded_at, upload.id))
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_pages_cover_every_row_once_with_tied_timestamps(self):
+        now = timezone.now()
+        # Three rows per timestamp, so page boundaries fall inside ties
+        for i in range(10):
+            UploadedFile.objects.create(farmer=self.farmer, file=f'uploads/{i}.jpg',
+                                        uploaded_at=now - timedelta(minutes=i // 3))
+        expected = list(UploadedFile.objects.order_by('-uploaded_at', '-id').values_list('id', flat=True))
+
+        seen = []
+        cursor = None
+        while True:
+            rows, cursor = keyset_page(UploadedFile.objects.all(), cursor=cursor, page_size=4)
+            seen.extend(row.id for row in rows)
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+
+
+class PublicFeedInvalidationTests(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.upload = UploadedFile.objects.create(farmer=self.farmer, file='uploads/leaf.jpg', prediction='healthy')
+        cache.set(PUBLIC_FEED_CACHE_KEY, ['cached feed'])
+
+    def assertFeedCached(self, cached):
+        self.assertEqual(cache.get(PUBLIC_FEED_CACHE_KEY) is not None, cached)
+
+    def test_new_prediction_invalidates(self):
+        self.upload.prediction = 'blight'
+        self.upload.save()
+        self.assertFeedCached(False)
+
+    def test_unchanged_and_forecast_only_saves_keep_the_feed(self):
+        self.upload.save()
+        self.upload.forecast_days = 5
+        self.upload.save(update_fields=['forecast_days'])
+        loaded = UploadedFile.objects.get(id=self.upload.id)
+        loaded.forecast_days = 3
+        loaded.save()
+        self.assertFeedCached(True)
+
+    def test_uploads_without_predictions_keep_the_feed(self):
+        UploadedFile.objects.create(farmer=self.farmer, file='uploads/other.jpg')
+        self.assertFeedCached(True)
+
+    def test_delete_invalidates(self):
+        self.upload.delete()
+        self.assertFeedCached(False)
+
+
+@skipUnless(find_spec('tensorflow'), "TensorFlow isn't installed")
+class PreprocessingParityTests(SimpleTestCase):
+    """The Pillow/NumPy model input against the original TensorFlow pipeline"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.paths = {}
+        # Odd, non-square sizes, larger and smaller than 224, exercise the resize kernel
+        for fmt, extension in (('PNG', 'png'), ('JPEG', 'jpg')):
+            for width, height in ((517, 300), (150, 97)):
+                path = os.path.join(directory, f"leaf_{width}.{extension}")
+                with open(path, 'wb') as f:
+                    f.write(image_bytes(width, height, fmt=fmt, noise=True))
+                self.paths.setdefault(fmt, []).append(path)
+
+    def max_difference(self, path, reference):
+        return float(np.max(np.abs(preprocess_image(path) - np.asarray(reference, dtype=np.float32))))
+
+    def test_png_matches_exactly(self):
+        for path in self.paths['PNG']:
+            self.assertEqual(self.max_difference(path, load_and_preprocess_image_tf(path)), 0.0)
+
+    def test_jpeg_differs_only_by_the_dct(self):
+        import tensorflow as tf
+
+        for path in self.paths['JPEG']:
+            # The original pipeline decodes with the fast DCT, Pillow with the accurate one
+            self.assertLess(self.max_difference(path, load_and_preprocess_image_tf(path)), 0.03)
+            accurate = tf.io.decode_jpeg(tf.io.read_file(path), channels=3, dct_method='INTEGER_ACCURATE')
+            self.assertEqual(self.max_difference(path, tf.image.resize(accurate, (224, 224)) / 255.0), 0.0)
+
+
+class UploadHandlerTests(AppTestCase):
+    """Uploads ImageUploadHandler refuses before anything is stored"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.farmer)
+
+    def upload(self, name, content):
+        return self.client.post('/', {'file': SimpleUploadedFile(name, content)})
+
+    def assertRejected(self, response, status, message):
+        self.assertEqual(response.status_code, status)
+        self.assertEqual(response.json()['status'], 'error')
+        self.assertIn(message, response.json()['message'])
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_rejects_files_that_are_not_images(self):
+        response = self.upload('notes.jpg', b'these are not the pixels you are looking for')
+        self.assertRejected(response, 400, 'Only image files')
+
+    @override_settings(UPLOAD_MAX_IMAGE_SIZE=4000)
+    def test_rejects_oversized_images_while_streaming(self):
+        content = image_bytes(64, 64, noise=True)
+        self.assertGreater(len(content), 4000)
+        self.assertRejected(self.upload('leaf.png', content), 413, 'File is too large')
+
+    @override_settings(UPLOAD_MAX_IMAGE_SIZE=4000)
+    def test_rejects_oversized_requests_from_content_length(self):
+        content = image_bytes(400, 400, noise=True)
+        self.assertGreater(len(content), 300 * 1024)
+        self.assertRejected(self.upload('leaf.png', content), 413, 'Upload is too large')
+
+    @override_settings(UPLOAD_MAX_IMAGE_PIXELS=30 * 30)
+    def test_rejects_images_with_too_many_pixels(self):
+        self.assertRejected(self.upload('leaf.png', image_bytes(40, 40)), 400, 'Image dimensions are too large')
+
+
+@override_settings(UPLOAD_ASYNC_PROCESSING=False, ML_BATCHING_ENABLED=False)
+class InlineUploadTests(AppTestCase):
+    """An upload processed on the request is decoded once, for thumbnails and the model"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.farmer)
+        self.inputs = []
+
+        def classify_batch(images):
+            self.inputs.extend(np.array(image) for image in images)
+            return [ml_processor.Prediction('healthy', 0.9, 'test') for _ in images]
+
+        for name, value in (('classify_batch', classify_batch), ('model_version', lambda: 'test')):
+            patcher = mock.patch.object(ml_processor, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_decoded_upload_reaches_the_model(self):
+        opened = []
+        real_open = Image.open
+
+        def open_image(source, *args, **kwargs):
+            opened.append(source)
+            return real_open(source, *args, **kwargs)
+
+        with mock.patch('PIL.Image.open', open_image):
+            response = self.client.post('/', {'file': SimpleUploadedFile('leaf.jpg', image_bytes(640, 480, 'JPEG', noise=True))})
+        self.assertEqual(response.json()['processed_info']['prediction'], 'healthy')
+
+        # Besides reading the header from memory, the file is decoded once
+        self.assertEqual(len([source for source in opened if isinstance(source, str)]), 1)
+
+        upload = UploadedFile.objects.get()
+        self.assertEqual((upload.prediction, upload.model_version), ('healthy', 'test'))
+        self.assertTrue(upload.file.storage.exists(derivative_name(upload.file.name, 'thumb')))
+        # The same input a worker would build from the stored file
+        self.assertEqual(len(self.inputs), 1)
+        np.testing.assert_array_equal(self.inputs[0], preprocess_image(upload.file.path))
+
+
+class BlobStorageTests(AppTestCase):
+
+    def store(self, content):
+        upload = SimpleUploadedFile('leaf.png', content)
+        upload.image_type = 'png'
+        uploaded_file = UploadedFile(farmer=self.farmer, content_hash='ab' * 32)
+        store_upload(uploaded_file, upload)
+        return uploaded_file
+
+    def test_blob_is_deleted_with_its_last_upload(self):
+        first = self.store(image_bytes())
+        second = self.store(image_bytes())
+        self.assertEqual(first.file.name, second.file.name)
+        storage = first.file.storage
+        create_derivatives(first.file, kinds=('thumb',))
+        thumb = derivative_name(first.file.name, 'thumb')
+
+        delete_upload(first)
+        self.assertTrue(storage.exists(second.file.name))
+        self.assertTrue(storage.exists(thumb))
+
+        delete_upload(second)
+        self.assertFalse(storage.exists(second.file.name))
+        self.assertFalse(storage.exists(thumb))
+        self.assertFalse(UploadedFile.objects.exists())
+
+
+@override_settings(UPLOAD_ASYNC_PROCESSING=True)
+class BulkUploadTests(AppTestCase):
+    """Limits on bulk uploads and the ZIP archives in them"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.farmer)
+
+    def archive(self, entries):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, content in entries:
+                zf.writestr(name, content)
+        return SimpleUploadedFile('photos.zip', buffer.getvalue())
+
+    def post(self, *files):
+        return self.client.post('/api/uploads/bulk/', {'files': list(files)})
+
+    def statuses(self, response):
+        return {entry['name']: (entry['status'], entry.get('error', '')) for entry in response.json()['manifest']}
+
+    @override_settings(UPLOAD_MAX_BULK_FILES=3)
+    def test_file_count_limit_covers_archive_entries(self):
+        response = self.post(
+            SimpleUploadedFile('a.png', image_bytes(20, 20)),
+            self.archive([
+                ('b.png', image_bytes(21, 21)),
+                ('notes.txt', b'not an image'),
+                ('__MACOSX/._b.png', b'resource fork'),
+                ('c.png', image_bytes(22, 22)),
+                ('d.png', image_bytes(23, 23)),
+            ]),
+        )
+        self.assertEqual(response.status_code, 200)
+        statuses = self.statuses(response)
+        self.assertEqual([name for name, (status, _) in statuses.items() if status == 'queued'], ['a', 'b', 'c'])
+        self.assertIn('Only image files', statuses['photos.zip/notes.txt'][1])
+        self.assertIn('At most 3 files', statuses['photos.zip/d.png'][1])
+        self.assertNotIn('photos.zip/__MACOSX/._b.png', statuses)
+        self.assertEqual(UploadedFile.objects.count(), 3)
+        self.assertTrue(ProcessingJob.objects.get().batch_id)
+
+    @override_settings(UPLOAD_MAX_IMAGE_SIZE=50 * 1000, UPLOAD_MAX_BULK_SIZE=100 * 1000)
+    def test_extracted_sizes_are_limited(self):
+        # Solid BMPs compress to almost nothing, the limits apply to what is extracted
+        small, large = image_bytes(110, 110, 'BMP'), image_bytes(140, 140, 'BMP')
+        self.assertGreater(len(large), 50 * 1000)
+        response = self.post(self.archive([
+            ('large.bmp', large),
+            ('one.bmp', small),
+            ('two.bmp', small),
+            ('three.bmp', small),
+        ]))
+        statuses = self.statuses(response)
+        self.assertIn('File is too large', statuses['photos.zip/large.bmp'][1])
+        self.assertEqual((statuses['one'][0], statuses['two'][0]), ('queued', 'queued'))
+        # Past UPLOAD_MAX_BULK_SIZE for the whole request
+        self.assertIn('File is too large', statuses['photos.zip/three.bmp'][1])
+
+    @override_settings(UPLOAD_MAX_BULK_SIZE=1000)
+    def test_oversized_request_is_refused_unread(self):
+        response = self.post(SimpleUploadedFile('a.png', image_bytes(400, 400, noise=True)))
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('Upload is too large', response.json()['message'])
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_nothing_acceptable(self):
+        response = self.post(SimpleUploadedFile('notes.txt', b'not an image'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.statuses(response)['notes.txt'][0], 'rejected')
+
+
+class ForecastETagTests(AppTestCase):
+    """The forecast API answers 304 only for an If-None-Match that lists its ETag"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('upload.views.get_forecast', return_value={'daily': [{'day': 'Mon'}], 'updated': 'now'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.etag = self.get().headers['ETag']
+
+    def get(self, if_none_match=None):
+        headers = {'If-None-Match': if_none_match} if if_none_match else {}
+        return self.client.get('/api/forecast/', {'lat': '42.03', 'lon': '-93.62'}, headers=headers)
+
+    def test_matching_etags(self):
+        self.assertTrue(self.etag.startswith('W/"'))
+        strong = self.etag.removeprefix('W/')
+        for header in (self.etag, strong, f'"other", {self.etag}', '*'):
+            self.assertEqual(self.get(header).status_code, 304, header)
+
+    def test_other_etags(self):
+        for header in ('W/"other"', self.etag + 'x', f'"x{self.etag}"', 'garbage'):
+            response = self.get(header)
+            self.assertEqual(response.status_code, 200, header)
+            self.assertEqual(response.headers['ETag'], self.etag)
+
+
+class ModelFileHandler(BaseHTTPRequestHandler):
+    """Serves the server's `body` like the model hub: HEAD with its checksum, ranged GETs"""
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        if self.server.sha256:
+            self.send_header('X-Linked-Etag', f'"{self.server.sha256}"')
+        self.end_headers()
+
+    def do_GET(self):
+        body = self.server.body
+        start, end = 0, len(body) - 1
+        if self.headers['Range']:
+            start, end = (int(value) for value in self.headers['Range'].removeprefix('bytes=').split('-'))
+        self.server.ranges.append((start, end))
+        if self.server.cut_after:
+            # Like a connection dropped mid-download, reported honestly as a short range
+            end = min(end, start + self.server.cut_after - 1)
+            self.server.cut_after = None
+        self.send_response(206 if self.headers['Range'] else 200)
+        self.send_header('Content-Range', f"bytes {start}-{end}/{len(body)}")
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        self.wfile.write(body[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class ModelArtifactTests(SimpleTestCase):
+    """ensure_model against a local stand-in for the model hub"""
+
+    def setUp(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            zf.writestr('model.weights.h5', random.Random(19).randbytes(20000))
+        body = buffer.getvalue()
+        self.sha256 = hashlib.sha256(body).hexdigest()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ModelFileHandler)
+        self.server.body = body
+        self.server.sha256 = self.sha256
+        self.server.ranges = []
+        self.server.cut_after = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.target = os.path.join(directory, 'app', 'corn_model_1.keras')
+        self.cache_dir = os.path.join(directory, 'cache')
+        self.mirror_dir = os.path.join(directory, 'mirror')
+        test_settings = override_settings(
+            ML_MODEL_URL=f"http://127.0.0.1:{self.server.server_port}/corn_model_1.keras",
+            ML_MODEL_SHA256='',
+            ML_MODEL_TOKEN='',
+            ML_ARTIFACT_CACHE_DIR=self.cache_dir,
+            ML_MODEL_MIRROR_DIR='',
+            HTTP_CLIENT_RETRIES=0,
+        )
+        test_settings.enable()
+        self.addCleanup(test_settings.disable)
+        http_client._session = None
+        self.addCleanup(setattr, http_client, '_session', None)
+
+    def test_downloads_verifies_and_reuses_the_cache(self):
+        result = artifacts.ensure_model(self.target)
+        self.assertEqual((result['source'], result['sha256']), ('download', self.sha256))
+        self.assertEqual(artifacts.file_sha256(self.target), self.sha256)
+        self.assertTrue(os.path.islink(self.target))
+
+        with override_settings(ML_MODEL_SHA256=self.sha256):
+            self.assertEqual(artifacts.ensure_model(self.target)['source'], 'cache')
+        self.assertEqual(len(self.server.ranges), 1)
+
+    def test_rejects_a_checksum_mismatch(self):
+        with override_settings(ML_MODEL_SHA256='0' * 64):
+            # The hub already reports a different checksum
+            with self.assertRaises(artifacts.ArtifactError):
+                artifacts.ensure_model(self.target)
+            self.assertEqual(self.server.ranges, [])
+
+            # Without one the file is downloaded, then refused
+            self.server.sha256 = None
+            with self.assertRaises(artifacts.ArtifactError):
+                artifacts.ensure_model(self.target)
+        self.assertEqual(len(self.server.ranges), 1)
+        self.assertFalse(os.path.lexists(self.target))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, '0' * 64)))
+
+    @mock.patch('upload.artifacts.RANGE_ATTEMPTS', 1)
+    def test_resumes_an_interrupted_download(self):
+        self.server.cut_after = 5000
+        with self.assertRaises(artifacts.ArtifactError):
+            artifacts.ensure_model(self.target)
+        self.assertFalse(os.path.lexists(self.target))
+
+        # The next attempt (e.g. the next deploy) only asks for the rest
+        self.assertEqual(artifacts.ensure_model(self.target)['source'], 'download')
+        size = len(self.server.body)
+        self.assertEqual(self.server.ranges, [(0, size - 1), (5000, size - 1)])
+        self.assertEqual(artifacts.file_sha256(self.target), self.sha256)
+
+    def test_offline_falls_back_to_the_last_downloaded_version(self):
+        artifacts.ensure_model(self.target)
+        os.remove(self.target)
+        self.server.shutdown()
+        self.server.server_close()
+
+        result = artifacts.ensure_model(self.target)
+        self.assertEqual((result['source'], result['sha256']), ('cache', self.sha256))
+        self.assertEqual(artifacts.file_sha256(self.target), self.sha256)
+
+    def test_offline_without_a_cached_version_fails(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(artifacts.ArtifactError):
+            artifacts.ensure_model(self.target)
+
+    def test_mirror_needs_no_network(self):
+        os.makedirs(self.mirror_dir)
+        with open(os.path.join(self.mirror_dir, 'corn_model_1.keras'), 'wb') as f:
+            f.write(self.server.body)
+        with override_settings(ML_MODEL_MIRROR_DIR=self.mirror_dir, ML_MODEL_SHA256=self.sha256):
+            self.assertEqual(artifacts.ensure_model(self.target)['source'], 'mirror')
+        self.assertEqual(self.server.ranges, [])
+
+
+class ModelRegistryTests(SimpleTestCase):
+    """Switching the active model through the registry file while it serves"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.registry_path = os.path.join(directory, 'registry.json')
+        test_settings = override_settings(ML_MODEL_REGISTRY=self.registry_path, ML_MODEL_REGISTRY_POLL=0)
+        test_settings.enable()
+        self.addCleanup(test_settings.disable)
+
+        # Each version predicts its own class for every image
+        self.loading = {}
+        patcher = mock.patch('upload.ml_processor.load_backend', side_effect=self.load_backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def load_backend(self, backend, path):
+        version = os.path.basename(path)
+        if version in self.loading:
+            self.loading[version]()
+        predicted = {'v1': 0, 'v2': 3}[version]
+        return mock.Mock(predict_on_batch=lambda images: np.eye(4, dtype=np.float32)[[predicted] * len(images)])
+
+    def write(self, active):
+        # Also moves the mtime on, two writes may share a timestamp
+        stat = os.stat(self.registry_path) if os.path.exists(self.registry_path) else None
+        ml_processor.write_registry({
+            'active': active,
+            'shadow': None,
+            'versions': {version: {'path': version, 'backend': 'keras'} for version in ('v1', 'v2')},
+        })
+        if stat:
+            os.utime(self.registry_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+    def classify(self, registry):
+        return registry.current().classify(np.zeros((1, 224, 224, 3), dtype=np.float32))[0]
+
+    def wait_for_switch(self, registry):
+        deadline = time.monotonic() + 5
+        while registry.switching_to is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(registry.switching_to)
+
+    def test_new_version_serves_after_warm_up(self):
+        self.write('v1')
+        registry = ml_processor.ModelRegistry()
+        self.assertEqual(self.classify(registry), ml_processor.Prediction('blight', 1.0, 'v1'))
+
+        loading, release = threading.Event(), threading.Event()
+        self.loading['v2'] = lambda: (loading.set(), release.wait(5))
+        self.write('v2')
+        held = registry.current()
+        self.assertTrue(loading.wait(5))
+
+        # The previous version keeps serving while the new one loads
+        self.assertEqual(registry.switching_to, 'v2')
+        self.assertEqual(self.classify(registry).model_version, 'v1')
+
+        release.set()
+        self.wait_for_switch(registry)
+        self.assertEqual(self.classify(registry), ml_processor.Prediction('healthy', 1.0, 'v2'))
+        # A batch that already had the previous model finishes on it
+        self.assertEqual(held.version, 'v1')
+        self.assertIsNone(registry.error)
+
+    def test_failed_switch_keeps_the_previous_version(self):
+        self.write('v1')
+        registry = ml_processor.ModelRegistry()
+        self.classify(registry)
+
+        def fail():
+            raise OSError("corrupt model file")
+
+        self.loading['v2'] = fail
+        self.write('v2')
+        registry.current()
+        self.wait_for_switch(registry)
+        self.assertEqual(self.classify(registry).model_version, 'v1')
+        self.assertIn('corrupt model file', registry.error)
+
+    def test_switches_directly_before_anything_is_loaded(self):
+        self.write('v1')
+        registry = ml_processor.ModelRegistry()
+        self.write('v2')
+        self.assertEqual(registry.current().version, 'v2')
+        self.assertIsNone(registry.switching_to)
+
+    def test_ignores_a_malformed_registry(self):
+        self.write('v1')
+        registry = ml_processor.ModelRegistry()
+        self.classify(registry)
+        with open(self.registry_path, 'w') as f:
+            json.dump({'active': 'v3', 'versions': {}}, f)
+        os.utime(self.registry_path, ns=(0, time.time_ns() + 10**9))
+
+        self.assertEqual(self.classify(registry).model_version, 'v1')
+        self.assertIn("'v3' is not registered", registry.error)
+
+
+class ShadowEvaluatorTests(AppTestCase):
+    """The candidate model runs beside uploads without holding them up"""
+
+    def test_drops_batches_when_the_queue_is_full(self):
+        started, release = threading.Event(), threading.Event()
+        evaluated = []
+
+        def evaluate(model, images, predictions, latency):
+            started.set()
+            release.wait(5)
+            evaluated.append(predictions)
+
+        evaluator = shadow.ShadowEvaluator(max_pending=1)
+        model = mock.Mock(status='ready', version='v2')
+        images = np.zeros((1, 224, 224, 3), dtype=np.float32)
+        with mock.patch.object(evaluator, 'evaluate', side_effect=evaluate):
+            evaluator.submit(model, images, ['first'], 0.01)
+            self.assertTrue(started.wait(5))
+
+            # One batch waits for the busy thread, the next is dropped instead of waiting
+            start = time.perf_counter()
+            evaluator.submit(model, images, ['second'], 0.01)
+            evaluator.submit(model, images, ['third'], 0.01)
+            self.assertLess(time.perf_counter() - start, 1)
+            self.assertEqual(evaluator.dropped, 1)
+
+            release.set()
+            deadline = time.monotonic() + 5
+            while len(evaluated) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(evaluated, [['first'], ['second']])
+
+    def test_stores_both_predictions(self):
+        candidate = mock.Mock(version='v2')
+        candidate.classify.return_value = [
+            ml_processor.Prediction('blight', 0.7, 'v2'),
+            ml_processor.Prediction('healthy', 0.9, 'v2'),
+        ]
+        active = [
+            ml_processor.Prediction('blight', 0.8, 'v1'),
+            ml_processor.Prediction('common_rust', 0.6, 'v1'),
+        ]
+        shadow.ShadowEvaluator().evaluate(candidate, np.zeros((2, 224, 224, 3), dtype=np.float32), active, 0.05)
+
+        rows = ShadowPrediction.objects.order_by('id')
+        self.assertEqual(
+            [(row.active_prediction, row.candidate_prediction, row.agrees) for row in rows],
+            [('blight', 'blight', True), ('common_rust', 'healthy', False)],
+        )
+        self.assertEqual({(row.active_version, row.candidate_version, row.batch_size) for row in rows}, {('v1', 'v2', 2)})
+        self.assertEqual(rows[0].active_latency_ms, 50.0)
+
+
+@override_settings(EVENTS_POLL_INTERVAL=0.01)
+class EventHubTests(AppTestCase):
+    """The ASGI hub's cursor over the UserEvent table"""
+
+    def test_does_not_skip_rows_committed_between_its_queries(self):
+        other = Farmer.objects.create_user('neighbour', password='secret')
+        aggregate = UserEvent.objects.aaggregate
+
+        async def newest_then_insert(*args, **kwargs):
+            # Another process commits right after the hub read the newest id
+            result = await aggregate(*args, **kwargs)
+            if not inserted:
+                inserted.append(await UserEvent.objects.acreate(
+                    farmer=self.farmer, kind=UserEvent.KIND_JOB, data={'n': 2}))
+            return result
+
+        async def run():
+            hub = events.EventHub()
+            queue = await hub.subscribe(self.farmer.id)
+            await UserEvent.objects.acreate(farmer=other, kind=UserEvent.KIND_JOB, data={'n': 0})
+            await UserEvent.objects.acreate(farmer=self.farmer, kind=UserEvent.KIND_JOB, data={'n': 1})
+            with mock.patch.object(UserEvent.objects, 'aaggregate', side_effect=newest_then_insert):
+                received = [
+                    (await asyncio.wait_for(queue.get(), 5)).data['n'],
+                    (await asyncio.wait_for(queue.get(), 5)).data['n'],
+                ]
+                await asyncio.sleep(0.05)
+            hub.unsubscribe(self.farmer.id, queue)
+            await asyncio.wait_for(hub._task, 5)
+            return received, queue.empty(), hub.last_id
+
+        inserted = []
+        received, drained, last_id = async_to_sync(run)()
+        self.assertEqual(received, [1, 2])
+        # Nothing delivered twice, and the other farmer's event not at all
+        self.assertTrue(drained)
+        # Starts from the newest event again with the next stream
+        self.assertIsNone(last_id)
+
+    def test_subscribe_starts_after_existing_events(self):
+        events.publish(self.farmer.id, UserEvent.KIND_JOB, {'n': 0})
+
+        async def run():
+            hub = events.EventHub()
+            queue = await hub.subscribe(self.farmer.id)
+            await asyncio.sleep(0.05)
+            hub.unsubscribe(self.farmer.id, queue)
+            await asyncio.wait_for(hub._task, 5)
+            return queue.empty()
+
+        self.assertTrue(async_to_sync(run)())
+
+
+class MetricsTests(AppTestCase):
+    """Metrics recorded by several processes, added up at /metrics/"""
+
+    def setUp(self):
+        super().setUp()
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir, ignore_errors=True)
+        test_settings = override_settings(METRICS_ENABLED=True, METRICS_DIR=self.metrics_dir, METRICS_TOKEN='scrape-me')
+        test_settings.enable()
+        self.addCleanup(test_settings.disable)
+        # This process's recorder, fresh for each test
+        patcher = mock.patch('upload.metrics.metrics', Metrics())
+        self.recorder = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Without the flush thread, which would outlive the test's METRICS_DIR
+        self.recorder._pid = os.getpid()
+        flusher = mock.patch.object(self.recorder, '_ensure_flusher')
+        flusher.start()
+        self.addCleanup(flusher.stop)
+
+    def write_process(self, pid, counters=(), histograms=(), gauges=(), age=0):
+        path = os.path.join(self.metrics_dir, f"{pid}.json")
+        with open(path, 'w') as f:
+            json.dump({'pid': pid, 'counters': counters, 'histograms': histograms, 'gauges': gauges}, f)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_adds_up_every_process(self):
+        buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.write_process(
+            101,
+            counters=[['cache_requests_total', {'cache': 'geocode', 'result': 'hit'}, 3]],
+            histograms=[['upload_stage_seconds', {'stage': 'inference'}, buckets[:2] + [1] + buckets[3:] + [0.004]]],
+            gauges=[['inference_queue_depth', {}, 2]],
+        )
+        self.write_process(
+            102,
+            counters=[['cache_requests_total', {'cache': 'geocode', 'result': 'hit'}, 4]],
+            histograms=[['upload_stage_seconds', {'stage': 'inference'}, buckets[:-1] + [1] + [45.0]]],
+            gauges=[['inference_queue_depth', {}, 5]],
+        )
+        lines = render_prometheus([('upload_jobs', {'status': 'queued'}, 7)]).splitlines()
+
+        self.assertIn('cache_requests_total{cache="geocode",result="hit"} 7', lines)
+        self.assertIn('inference_queue_depth{pid="101"} 2', lines)
+        self.assertIn('inference_queue_depth{pid="102"} 5', lines)
+        self.assertIn('upload_jobs{status="queued"} 7', lines)
+        # Cumulative buckets, the second observation only in +Inf
+        self.assertIn('upload_stage_seconds_bucket{stage="inference",le="0.0025"} 0', lines)
+        self.assertIn('upload_stage_seconds_bucket{stage="inference",le="0.005"} 1', lines)
+        self.assertIn('upload_stage_seconds_bucket{stage="inference",le="30"} 1', lines)
+        self.assertIn('upload_stage_seconds_bucket{stage="inference",le="+Inf"} 2', lines)
+        self.assertIn('upload_stage_seconds_sum{stage="inference"} 45.004', lines)
+        self.assertIn('upload_stage_seconds_count{stage="inference"} 2', lines)
+        self.assertEqual(lines.count('# TYPE upload_stage_seconds histogram'), 1)
+        self.assertEqual(lines.count('# TYPE inference_queue_depth gauge'), 1)
+
+    def test_includes_this_process_and_escapes_labels(self):
+        self.recorder.inc('external_api_requests_total', host='api."open"\\meteo')
+        self.recorder.inc('external_api_requests_total', host='api."open"\\meteo')
+        self.recorder.observe('inference_batch_size', 3)
+        lines = render_prometheus().splitlines()
+
+        self.assertIn('external_api_requests_total{host="api.\\"open\\"\\\\meteo"} 2', lines)
+        self.assertIn('inference_batch_size_bucket{le="2"} 0', lines)
+        self.assertIn('inference_batch_size_bucket{le="4"} 1', lines)
+        self.assertIn('inference_batch_size_sum 3.0', lines)
+
+    def test_drops_old_processes(self):
+        self.write_process(101, counters=[['cache_requests_total', {}, 1]], gauges=[['inference_queue_depth', {}, 2]], age=60)
+        self.write_process(102, counters=[['cache_requests_total', {}, 1]], age=2 * 24 * 60 * 60)
+        lines = render_prometheus().splitlines()
+
+        # An exited worker's totals still count, its gauges don't
+        self.assertIn('cache_requests_total 1', lines)
+        self.assertNotIn('inference_queue_depth{pid="101"} 2', lines)
+        self.assertIn('101.json', os.listdir(self.metrics_dir))
+        self.assertNotIn('102.json', os.listdir(self.metrics_dir))
+
+    def test_disabled_records_nothing(self):
+        with override_settings(METRICS_ENABLED=False):
+            self.recorder.inc('cache_requests_total')
+        self.assertEqual(self.recorder.snapshot()['counters'], [])
+
+    def test_endpoint_is_for_staff_and_the_scraper(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.client.force_login(self.farmer)
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+
+        ProcessingJob.objects.create(uploaded_file=UploadedFile.objects.create(farmer=self.farmer, file='uploads/leaf.jpg'))
+        self.client.logout()
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('upload_jobs{status="queued"} 1', response.content.decode().splitlines())
+        self.assertIn('upload_jobs{status="running"} 0', response.content.decode().splitlines())
+
+        self.farmer.is_staff = True
+        self.farmer.save()
+        self.client.force_login(self.farmer)
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_no_token_means_no_scraper(self):
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+@override_settings(PROFILER_ENABLED=True)
+class ProfilerTests(AppTestCase):
+    """Who can run a request under the profiler"""
+
+    def profile_link(self, url):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('profile_link', url, stdout=out, stderr=err)
+        return out.getvalue().splitlines()[0]
+
+    def test_signed_link_profiles_its_page_for_anyone(self):
+        link = self.profile_link('/login/?next=/profile/')
+        self.assertTrue(link.startswith('/login/?next=%2Fprofile%2F&_profile='))
+
+        response = self.client.get(link)
+        self.assertEqual(response.status_code, 200)
+        record = ProfileRecord.objects.get()
+        self.assertEqual(response['X-Profile'], reverse('admin:upload_profilerecord_change', args=[record.id]))
+        self.assertEqual((record.path, record.status_code, record.user), (link, 200, None))
+
+    def test_link_is_only_for_its_path(self):
+        token = signed_profile_token('/login/')
+        response = self.client.get('/register/', {PROFILE_PARAM: token})
+        self.assertNotIn('X-Profile', response)
+        self.assertFalse(ProfileRecord.objects.exists())
+
+    def test_rejects_tampered_and_expired_tokens(self):
+        token = signed_profile_token('/login/')
+        self.assertNotIn('X-Profile', self.client.get('/login/', {PROFILE_PARAM: token[:-1] + 'x'}))
+        self.assertNotIn('X-Profile', self.client.get('/login/', {PROFILE_PARAM: '1'}))
+        with mock.patch('django.core.signing.time.time', return_value=time.time() + 2 * 24 * 60 * 60):
+            self.assertNotIn('X-Profile', self.client.get('/login/', {PROFILE_PARAM: token}))
+        self.assertFalse(ProfileRecord.objects.exists())
+
+    def test_staff_profile_any_page(self):
+        self.client.force_login(self.farmer)
+        self.assertNotIn('X-Profile', self.client.get('/profile/', {PROFILE_PARAM: '1'}))
+
+        self.farmer.is_staff = True
+        self.farmer.save()
+        self.assertIn('X-Profile', self.client.get('/profile/', {PROFILE_PARAM: '1'}))
+        self.assertEqual(ProfileRecord.objects.get().user, self.farmer)
+
+    @override_settings(PROFILER_ENABLED=False)
+    def test_disabled_ignores_valid_tokens(self):
+        token = signed_profile_token('/login/')
+        self.assertNotIn('X-Profile', self.client.get('/login/', {PROFILE_PARAM: token}))
+        self.assertFalse(ProfileRecord.objects.exists())
+
+
+class DiseaseMapTests(AppTestCase):
+
+    def test_covering_ranges_contain_every_point_in_the_box(self):
+        south, west, north, east = 40.5, -97.3, 43.9, -90.2
+        ranges = geohash.covering_ranges(south, west, north, east, 4)
+        self.assertEqual(ranges, sorted(ranges))
+        for (_, stop), (start, _) in zip(ranges, ranges[1:]):
+            # Adjacent ranges are merged, so there is always a gap between two
+            self.assertLess(stop, start)
+
+        rng = random.Random(0)
+        for _ in range(500):
+            code = geohash.encode(rng.uniform(south, north), rng.uniform(west, east), 9)
+            self.assertTrue(any(start <= code and (stop is None or code < stop) for start, stop in ranges), code)
+
+    def test_whole_world_and_antimeridian(self):
+        self.assertEqual(geohash.covering_ranges(-90, -180, 90, 180, 3), [('', None)])
+        ranges = bbox_ranges(-10, 170, 10, -170, 3)
+        for latitude, longitude in ((0, 175), (0, -175), (5, 179.9)):
+            code = geohash.encode(latitude, longitude, 9)
+            self.assertTrue(any(start <= code < (stop or '~') for start, stop in ranges))
+        code = geohash.encode(0, 0, 9)
+        self.assertFalse(any(start <= code < (stop or '~') for start, stop in ranges))
+
+    def test_counts_predictions_in_box_and_window(self):
+        now = timezone.now()
+
+        def upload(latitude, longitude, prediction, days_ago=0):
+            UploadedFile.objects.create(farmer=self.farmer, file='uploads/leaf.jpg', latitude=latitude,
+                                        longitude=longitude, prediction=prediction,
+                                        uploaded_at=now - timedelta(days=days_ago))
+
+        upload(42.03, -93.62, 'common_rust')
+        upload(42.04, -93.61, 'common_rust')
+        upload(42.05, -93.60, 'healthy')
+        upload(42.05, -93.60, 'Processing failed')
+        upload(42.05, -93.60, None)
+        upload(42.05, -93.60, 'blight', days_ago=40)
+        upload(48.85, 2.35, 'blight')
+
+        data = disease_map(41, -95, 43, -92, now - timedelta(days=30), now + timedelta(minutes=1))
+        self.assertEqual(data['totals'], {'common_rust': 2, 'healthy': 1})
+        self.assertEqual(sum(cell['total'] for cell in data['cells']), 3)
+
+        data = disease_map(41, -95, 43, -92, now - timedelta(days=30), now + timedelta(minutes=1), disease='healthy')
+        self.assertEqual(data['totals'], {'healthy': 1})
@@ -0,0 +1,263 @@
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+from PIL import Image
+
+from .derivatives import DERIVATIVES, UPLOAD_DERIVATIVES, open_image
+from .ml_processor import decode_for_model
+
+'''
+    Upload handling for crop photos.
+
+    ImageUploadHandler replaces Django's default handlers on the upload view. It
+    streams each file to a temporary file on disk while:
+
+    - computing its SHA-256, so the content hash is known without reading it again,
+    - checking the first bytes against known image signatures and reading the pixel
+      dimensions from the header, so non-images and decompression bombs are refused
+      before the rest of a slow mobile upload is written to disk,
+    - enforcing UPLOAD_MAX_IMAGE_SIZE, both from Content-Length and while streaming.
+
+    When the file is complete it is decoded once and the decoded image is attached
+    to the upload, so thumbnails are made from memory instead of reading the file
+    again. With UPLOAD_ASYNC_PROCESSING the decode is at reduced scale (see
+    derivatives.open_image), since the model runs in a worker; otherwise it is the
+    model's decode and is handed to inference as well.
+
+    A rejected upload stops processing: the rest of the body, which Content-Length
+    already bounds by the limit, is read and dropped without being stored or
+    hashed, so the client gets the view's error response rather than a connection
+    reset. The reason and an HTTP status are kept on request.upload_error and
+    request.upload_error_status for the view to report. In bulk mode single bad
+    files are skipped instead (see ImageUploadHandler).
+'''
+
+# Leading bytes of the image formats Pillow can decode for the model
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+)
+
+# How much of the start of a file is kept to read its dimensions. JPEG headers
+# come after the EXIF block, which is at most 64 KB.
+HEADER_LIMIT = 256 * 1024
+
+# Allowance for the form fields and multipart boundaries around the file
+FORM_OVERHEAD = 256 * 1024
+
+ZIP_SIGNATURE = b'PK\x03\x04'
+
+
+def sniff_image_type(header):
+    """Image format from a file's first bytes, or None if it isn't a supported image"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for signature, image_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return image_type
+    return None
+
+
+def megabytes(size):
+    return f"{size / (1024 * 1024):.3g} MB"
+
+
+class InvalidImage(Exception):
+    """An upload that isn't an acceptable image; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class HashedUploadedFile(TemporaryUploadedFile):
+    """A TemporaryUploadedFile that also carries its hash, format and decoded image"""
+
+    sha256 = None
+    image_type = None
+    dimensions = None
+    image = None
+    # Set when the upload is processed on the request, see ml_processor.decode_for_model
+    model_image = None
+
+
+class ImageStream:
+    """
+    Checks one file as its chunks arrive: size limit, signature and pixel
+    dimensions. Computes the SHA-256 on the way. Raises InvalidImage.
+    """
+
+    def __init__(self, max_size, allow_archives=False):
+        self.max_size = max_size
+        self.allow_archives = allow_archives
+        self.hasher = hashlib.sha256()
+        self.header = b''
+        self.size = 0
+        self.image_type = None
+        self.dimensions = None
+
+    def feed(self, data):
+        if self.image_type is None:
+            self.header += data
+            if len(self.header) < 12:
+                return self.update(data)
+            self.image_type = sniff_image_type(self.header)
+            if self.image_type is None and self.allow_archives and self.header.startswith(ZIP_SIGNATURE):
+                self.image_type = 'zip'
+            if self.image_type is None:
+                raise InvalidImage("Only image files (JPEG, PNG, WebP, GIF or BMP) can be uploaded.")
+        elif self.dimensions is None and self.image_type != 'zip':
+            self.header += data
+
+        if self.image_type == 'zip':
+            # Archives are checked entry by entry once they are complete
+            self.header = b''
+        elif self.dimensions is None:
+            self.check_dimensions()
+
+        self.update(data)
+
+    def update(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise InvalidImage(f"File is too large, the limit is {megabytes(self.max_size)}.", status=413)
+        self.hasher.update(data)
+
+    def check_dimensions(self):
+        try:
+            with Image.open(io.BytesIO(self.header)) as image:
+                self.dimensions = image.size
+        except Image.DecompressionBombError:
+            raise InvalidImage("Image dimensions are too large.")
+        except Exception:
+            # Header not complete yet
+            if len(self.header) >= HEADER_LIMIT:
+                raise InvalidImage("The uploaded file is not a readable image.")
+            return
+
+        width, height = self.dimensions
+        if width * height > settings.UPLOAD_MAX_IMAGE_PIXELS:
+            raise InvalidImage("Image dimensions are too large.")
+        self.header = b''
+
+    def finish(self, file):
+        """Check the complete file and record what was learned about it on `file`"""
+        if self.image_type is None or (self.image_type != 'zip' and self.dimensions is None):
+            raise InvalidImage("The uploaded file is not a readable image.")
+        file.sha256 = self.hasher.hexdigest()
+        file.image_type = self.image_type
+        file.dimensions = self.dimensions
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """
+    Streams image uploads to disk, hashing and validating them as chunks arrive.
+
+    With bulk=True (the bulk upload endpoint) the request may hold many files and
+    ZIP archives up to UPLOAD_MAX_BULK_SIZE in total. A bad file is then skipped and
+    listed in request.upload_rejected instead of failing the whole request, and
+    files are not decoded here; that happens in the background job.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, request=None, bulk=False):
+        super().__init__(request)
+        self.bulk = bulk
+        self.file_count = 0
+        if bulk:
+            request.upload_rejected = []
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        self.max_size = settings.UPLOAD_MAX_IMAGE_SIZE
+        max_request_size = settings.UPLOAD_MAX_BULK_SIZE if self.bulk else self.max_size
+        if content_length and content_length > max_request_size + FORM_OVERHEAD:
+            # Refuse before reading any of the body. StopUpload can't be raised this
+            # early, so report the request as parsed with no data instead.
+            self.request.upload_error = f"Upload is too large, the limit is {megabytes(max_request_size)}."
+            self.request.upload_error_status = 413
+            return QueryDict(encoding=encoding), MultiValueDict()
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file_count += 1
+        if self.bulk and self.file_count > settings.UPLOAD_MAX_BULK_FILES:
+            self.reject(f"At most {settings.UPLOAD_MAX_BULK_FILES} files can be uploaded at once.", status=413)
+
+        self.file = HashedUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+        # An archive may be as large as the whole bulk upload
+        self.stream = ImageStream(
+            settings.UPLOAD_MAX_BULK_SIZE if self.bulk else self.max_size,
+            allow_archives=self.bulk,
+        )
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            self.stream.feed(raw_data)
+            if self.stream.image_type not in (None, 'zip') and self.stream.size > self.max_size:
+                raise InvalidImage(f"File is too large, the limit is {megabytes(self.max_size)}.", status=413)
+        except InvalidImage as e:
+            if self.bulk:
+                self.skip(str(e))
+                raise SkipFile(str(e))
+            self.reject(str(e), status=e.status)
+
+        self.file.write(raw_data)
+        # This is the only handler, nothing is passed on
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.size = file_size
+        try:
+            self.stream.finish(self.file)
+        except InvalidImage as e:
+            if self.bulk:
+                return self.skip(str(e))
+            self.reject(str(e), status=e.status)
+
+        if self.bulk:
+            return self.file
+
+        try:
+            path = self.file.temporary_file_path()
+            if settings.UPLOAD_ASYNC_PROCESSING:
+                # Only the thumbnails are made on this request, and a reduced-scale
+                # decode large enough for every one of them will do
+                max_size = max(DERIVATIVES[kind][0] for kind in UPLOAD_DERIVATIVES)
+                self.file.image = open_image(path, max_size)
+            else:
+                # Processed on this request: one decode serves the thumbnails and the model
+                self.file.image = self.file.model_image = decode_for_model(path)
+        except Exception as e:
+            print(f"Error decoding upload {self.file_name}: {str(e)}")
+            self.reject("The uploaded file is not a readable image.")
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, 'file'):
+            self.file.close()
+
+    def skip(self, message):
+        """Leave one file of a bulk upload out and note why"""
+        self.request.upload_rejected.append({'name': self.file_name, 'status': 'rejected', 'error': message})
+        self.file.close()
+        return None
+
+    def reject(self, message, status=400):
+        """Stop reading the request and remember why for the view"""
+        self.request.upload_error = message
+        self.request.upload_error_status = status
+        if hasattr(self, 'file'):
+            # Closing the temporary file deletes it
+            self.file.close()
+        # Resetting the connection would save reading the rest, but most clients
+        # would then show a network error instead of the reason
+        raise StopUpload(connection_reset=False)
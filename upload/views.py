@@ -4,26 +4,39 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth import login, authenticate, update_session_auth_hash, logout as auth_logout
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
-from .models import UploadedFile, Farmer
-from .forms import UploadFileForm, FarmerRegistrationForm
-from .ml_processor import predict_image
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
-import os
-import requests
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.db.models import Q
+from django.conf import settings
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_GET
+from .models import UploadedFile, Farmer, ProcessingJob
+from .metrics import render_prometheus, timed
+from .forms import UploadFileForm, FarmerRegistrationForm, BulkUploadForm
+from .ml_processor import model_status
+from .jobs import arun_job, enqueue, job_info, run_job
+from .events import aevent_stream, event_stream, latest_event_id, stream_start
+from .forecast import aget_forecast, get_forecast
+from .pagination import keyset_page
+from .disease_map import cached_disease_map
+from .public_feed import get_public_history
+from .derivatives import create_derivatives
+from .blobs import store_upload, delete_upload
+from .bulk import collect_uploads, create_batch, upload_manifest
+from .upload_handlers import ImageUploadHandler
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import parse_etags
+from datetime import datetime, time, timedelta
+from django.db.models import Count
+import hashlib
+import hmac
+import json
+from asgiref.sync import sync_to_async
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from datetime import datetime
-
-def get_location_name(latitude, longitude):
-    try:
-        geolocator = Nominatim(user_agent="my_agent")
-        location = geolocator.reverse((latitude, longitude))
-        return location.address
-    except GeocoderTimedOut:
-        return f"{latitude}, {longitude}"
 
 def register(request):
     if request.method == 'POST':
@@ -49,12 +62,13 @@ def login_view(request):
         else:
             messages.error(request, 'Invalid username or password.')
     
-    # Get public history of all uploaded files with predictions
-    public_history = UploadedFile.objects.filter(
-        prediction__isnull=False
-    ).select_related('farmer').order_by('-uploaded_at')[:10]  # Show last 10 uploads
-    
-    return render(request, 'upload/login.html', {'public_history': public_history})
+    # Public history of uploaded files with predictions. Passed uncalled: the template
+    # only calls it when its cached fragment has expired, so most hits skip the cache
+    # lookup for the rows as well as the database.
+    return render(request, 'upload/login.html', {
+        'public_history': get_public_history,
+        'public_feed_ttl': settings.PUBLIC_FEED_CACHE_TTL,
+    })
 
 @login_required
 def profile(request):
@@ -94,126 +108,404 @@ def profile(request):
     
     return render(request, 'upload/profile.html')
 
+@csrf_exempt
 @login_required
 def home(request):
+    # Upload handlers can only be replaced before request.POST is first read, which
+    # CSRF checking does, so the check happens in upload_home instead
+    request.upload_handlers = [ImageUploadHandler(request)]
     if request.method == 'POST':
-        form = UploadFileForm(request.POST, request.FILES)
-        if form.is_valid():
-            file = form.save(commit=False)
-            file.farmer = request.user
-            
-            # Get location data from the form
-            latitude = file.latitude
-            longitude = file.longitude
-            
-            # Get days for forecast
-            days = request.POST.get('days')
-            if days and days.isdigit():
-                file.forecast_days = int(days)
-            else:
-                file.forecast_days = 2
-            
-            # Save the file first without location name
-            file.save()
-            
-            # Initialize variables
-            prediction = None
-            confidence = None
-            forecast_data = None
-            error_message = None
-            
-            # Process the image using our ML model
-            try:
-                prediction, confidence = predict_image(file.file.path)
-                file.prediction = prediction
-                file.confidence = confidence
-                
-                # Get forecast data and location name if coordinates are provided
-                if latitude and longitude and file.forecast_days:
-                    try:
-                        from .forecast import weather_forecast, get_location_name
-                        
-                        # Get a proper location name first
-                        file.location_name = get_location_name(latitude, longitude)
-                        
-                        # Get weather forecast
-                        forecast_data = weather_forecast(
-                            longitude, 
-                            latitude, 
-                            file.forecast_days
-                        )
-                        
-                        # Store the forecast data in the session for this file
-                        if not request.session.get('file_forecasts'):
-                            request.session['file_forecasts'] = {}
-                        
-                        # Use the file ID as the key
-                        request.session['file_forecasts'][str(file.id)] = forecast_data
-                        request.session.modified = True
-                        
-                    except Exception as e:
-                        import traceback
-                        print(f"Error fetching weather data: {str(e)}")
-                        print(traceback.format_exc())
-                
-                # Save the file again with prediction and location name
-                file.save()
-                
-                messages.success(request, f'File uploaded and processed successfully! Prediction: {prediction} (Confidence: {confidence:.2%})')
-            except Exception as e:
-                import traceback
-                error_message = f"Error processing image: {str(e)}"
-                print(error_message)
-                print(traceback.format_exc())
-                messages.error(request, error_message)
-                # Still save the file but without prediction
-                file.prediction = "Processing failed"
-                file.confidence = 0
-                file.save()
-            
+        request.POST  # Parse the upload now, with the handler above
+        if hasattr(request, 'upload_error'):
+            # Rejected while streaming: nothing was saved, so no CSRF check is needed to refuse it
             return JsonResponse({
-                'status': 'success' if error_message is None else 'error',
-                'message': 'File uploaded successfully!' if error_message is None else error_message,
-                'redirect_url': '/',
-                'processed_info': {
-                    'prediction': prediction,
-                    'confidence': confidence,
-                    'location': file.location_name,
-                    'forecast': forecast_data,
-                    'processed_at': datetime.now().strftime('%Y-%m-%d %H:%M'),
-                    'error': error_message
-                }
-            })
+                'status': 'error',
+                'message': request.upload_error,
+            }, status=request.upload_error_status)
+    return upload_home(request)
+
+@csrf_protect
+def upload_home(request):
+    if request.method == 'POST':
+        form, job, image = save_upload(request)
+        if job is None:
+            return upload_form_error(form)
+
+        if not settings.UPLOAD_ASYNC_PROCESSING:
+            # No worker pool (e.g. local development): process on this request
+            run_job(job, image=image)
+            report_job_result(request, job)
+
+        return upload_response(job)
+    return render_home(request, UploadFileForm())
+
+@csrf_exempt
+@login_required
+async def home_async(request):
+    """
+    home for ASGI. Without a worker pool, the upload's location name and forecast
+    are fetched at the same time while the model runs (see aprocess_upload).
+    """
+    request.upload_handlers = [ImageUploadHandler(request)]
+    if request.method == 'POST':
+        # Parsing decodes and hashes the image, keep it off the event loop
+        await sync_to_async(lambda: request.POST)()
+        if hasattr(request, 'upload_error'):
+            return JsonResponse({
+                'status': 'error',
+                'message': request.upload_error,
+            }, status=request.upload_error_status)
+    return await upload_home_async(request)
+
+@csrf_protect
+async def upload_home_async(request):
+    if request.method == 'POST':
+        form, job, image = await sync_to_async(save_upload)(request)
+        if job is None:
+            return upload_form_error(form)
+
+        if not settings.UPLOAD_ASYNC_PROCESSING:
+            await arun_job(job, image=image)
+            await sync_to_async(report_job_result)(request, job)
+
+        return upload_response(job)
+    return await sync_to_async(render_home)(request, UploadFileForm())
+
+def save_upload(request):
+    """
+    Validate and store an upload and queue its processing job
+
+    Returns:
+        (form, job, image): job is None if the form is invalid; image is the upload
+        as decoded for the model when it is processed on this request, else None
+    """
+    form = UploadFileForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return form, None, None
+
+    upload = request.FILES['file']
+    file = form.save(commit=False)
+    file.farmer = request.user
+    file.content_hash = upload.sha256 or ''
+    
+    # Get days for forecast
+    days = request.POST.get('days')
+    if days and days.isdigit():
+        file.forecast_days = int(days)
     else:
-        form = UploadFileForm()
+        file.forecast_days = 2
     
-    # Only show files uploaded by the current user
-    files = UploadedFile.objects.filter(farmer=request.user).order_by('-uploaded_at')
+    # Save the file, the slow work happens in a background worker. An image
+    # that was uploaded before reuses the stored copy and its thumbnails.
+    store_upload(file, upload)
+
+    # Thumbnails come from the image the upload handler already decoded
+    try:
+        create_derivatives(file.file, image=upload.image)
+    except Exception as e:
+        print(f"Error creating derivatives: {str(e)}")
+    return form, enqueue(file), upload.model_image
+
+def upload_response(job):
+    return JsonResponse({
+        'status': 'error' if job.status == ProcessingJob.STATUS_FAILED else 'success',
+        'message': job.error or 'File uploaded successfully!',
+        'redirect_url': '/',
+        'job': job_info(job),
+        'processed_info': job.result
+    })
+
+def upload_form_error(form):
+    return JsonResponse({
+        'status': 'error',
+        'message': ' '.join(error for errors in form.errors.values() for error in errors),
+    }, status=400)
+
+def render_home(request, form):
+    # Forecasts used to be kept in the session, drop them from older sessions
+    if 'file_forecasts' in request.session:
+        del request.session['file_forecasts']
     
-    # Add weather data to files from session storage instead of making API calls
-    file_forecasts = request.session.get('file_forecasts', {})
+    # Only show files uploaded by the current user, with their stored forecasts
+    files, next_cursor = keyset_page(file_history_queryset(request.user), page_size=settings.FILE_HISTORY_PAGE_SIZE)
     
-    for file in files:
-        # Add the weather data from session if available
-        file_id = str(file.id)
-        if file_id in file_forecasts:
-            file.weather_data = file_forecasts[file_id]
-        else:
-            # If no weather data in session, set to None - don't fetch it
-            file.weather_data = None
+    context = {
+        'form': form,
+        'files': files,
+        'next_cursor': next_cursor,
+        # The event stream starts here, so nothing between rendering and connecting is missed
+        'events_since': latest_event_id(request.user.id),
+    }
+    with timed('template_render'):
+        return render(request, 'upload/home.html', context)
+
+@csrf_exempt
+@login_required
+def bulk_upload(request):
+    """
+    Upload many images in one request, as several files and/or ZIP archives. The
+    images are processed by one background job; poll its status_url for the
+    per-file manifest.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'POST required'}, status=405)
+
+    # As in home, the handler must be set before request.POST is read
+    request.upload_handlers = [ImageUploadHandler(request, bulk=True)]
+    request.POST
+    if hasattr(request, 'upload_error'):
+        return JsonResponse({
+            'status': 'error',
+            'message': request.upload_error,
+        }, status=request.upload_error_status)
+    return bulk_upload_files(request)
+
+@csrf_protect
+def bulk_upload_files(request):
+    form = BulkUploadForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'status': 'error', 'message': form.errors}, status=400)
+
+    rejected = request.upload_rejected
+    files = [upload for field in request.FILES for upload in request.FILES.getlist(field)]
+    uploads = collect_uploads(files, rejected)
+    if not uploads:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'No images to process.',
+            'manifest': rejected,
+        }, status=400)
+
+    batch, job, uploaded_files = create_batch(
+        request.user,
+        uploads,
+        rejected,
+        latitude=form.cleaned_data['latitude'],
+        longitude=form.cleaned_data['longitude'],
+        days=form.cleaned_data['days'],
+    )
+
+    if not settings.UPLOAD_ASYNC_PROCESSING:
+        run_job(job)
+
+    return JsonResponse({
+        'status': 'success',
+        'message': f"{len(uploaded_files)} image(s) uploaded",
+        'batch': batch.id,
+        'job': job_info(job),
+        'manifest': job.result['manifest'] if job.is_finished else upload_manifest(batch, uploaded_files),
+    })
+
+def file_history_queryset(user):
+    # Only the columns the file list renders
+    return (UploadedFile.objects
+            .filter(farmer=user)
+            .select_related('forecast')
+            .only('id', 'file', 'uploaded_at', 'location_name', 'prediction', 'confidence', 'forecast__data'))
+
+@login_required
+def file_history(request):
+    """Next page of the user's uploads for the home page's infinite scroll"""
+    try:
+        files, next_cursor = keyset_page(
+            file_history_queryset(request.user),
+            cursor=request.GET.get('cursor'),
+            page_size=settings.FILE_HISTORY_PAGE_SIZE,
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     
-    return render(request, 'upload/home.html', {'form': form, 'files': files})
+    with timed('template_render'):
+        html = ''.join(
+            render_to_string('upload/_file_item.html', {'file': file}, request=request)
+            for file in files
+        )
+    return JsonResponse({
+        'html': html,
+        'files': [{
+            'id': file.id,
+            'name': file.file.name,
+            'url': file.file.url,
+            'uploaded_at': file.uploaded_at.isoformat(),
+            'location': file.location_name,
+            'prediction': file.prediction,
+            'confidence': file.confidence,
+            'weather': file.weather_data,
+        } for file in files],
+        'next_cursor': next_cursor,
+    })
+
+def report_job_result(request, job):
+    """Show the outcome of a finished job once"""
+    reported = request.session.get('reported_jobs', [])
+    if job.id in reported:
+        return
+
+    result = job.result or {}
+    if job.batch_id and job.status == ProcessingJob.STATUS_DONE:
+        messages.success(request, f"Batch processed: {result['processed']} image(s) classified, {result['failed'] + result['rejected']} could not be processed")
+    elif job.status == ProcessingJob.STATUS_DONE:
+        messages.success(request, f"File uploaded and processed successfully! Prediction: {result['prediction']} (Confidence: {result['confidence']:.2%})")
+    else:
+        messages.error(request, job.error)
+
+    # Only the most recent jobs need remembering, older ones are never polled again
+    request.session['reported_jobs'] = (reported + [job.id])[-20:]
+
+@login_required
+def job_status(request, job_id):
+    """Polled by the home page until the upload's (or bulk upload's) processing job has finished"""
+    job = get_object_or_404(
+        ProcessingJob.objects.filter(Q(uploaded_file__farmer=request.user) | Q(batch__farmer=request.user)),
+        id=job_id,
+    )
+    data = job_info(job)
+
+    if job.is_finished:
+        data['processed_info'] = job.result
+        data['error'] = job.error or None
+        report_job_result(request, job)
+    elif job.result:
+        # Bulk uploads report how many images have been through the model
+        data['progress'] = job.result.get('progress')
+
+    return JsonResponse(data)
+
+@login_required
+def events(request):
+    """
+    Server-sent events for the home page: finished jobs and changed forecasts. Under
+    WSGI the stream closes as soon as it has sent what is new (see events.py).
+    """
+    return event_stream_response(event_stream(request.user.id, stream_start(request)))
+
+@login_required
+async def events_async(request):
+    """events for ASGI, the stream stays open"""
+    user = await request.auser()
+    return event_stream_response(aevent_stream(user.id, stream_start(request)))
+
+def event_stream_response(stream):
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Don't let nginx-style proxies buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+@require_GET
+def disease_map_view(request):
+    """
+    Disease counts per map cell, over everyone's uploads in a bounding box and time window
+
+    Query parameters:
+        bbox (str): west,south,east,north in degrees (west > east crosses the antimeridian)
+        since, until (str, optional): ISO date or datetime window of upload times
+            (default: the last DISEASE_MAP_DEFAULT_DAYS days, to the current minute)
+        precision (int, optional): Geohash length of the cells (default: the finest
+            that keeps the box within DISEASE_MAP_MAX_CELLS cells)
+        disease (str, optional): Only count this prediction, e.g. common_rust
+    """
+    try:
+        bbox, since, until, precision = parse_map_query(request.GET)
+        data = cached_disease_map(*bbox, since, until, precision=precision, disease=request.GET.get('disease'))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    south, west, north, east = bbox
+    response = JsonResponse(dict(
+        data,
+        bbox=[west, south, east, north],
+        since=since.isoformat(),
+        until=until.isoformat(),
+    ))
+    patch_cache_control(response, private=True, max_age=settings.DISEASE_MAP_CACHE_TTL)
+    return response
+
+def parse_map_query(query):
+    """
+    Validated ((south, west, north, east), since, until, precision) from the disease
+    map's query parameters
+
+    Raises:
+        ValueError: with the message returned to the client
+    """
+    try:
+        west, south, east, north = (float(value) for value in query.get('bbox', '').split(','))
+    except ValueError:
+        raise ValueError("bbox must be west,south,east,north in degrees")
+    if not (-90 <= south < north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError("bbox must have -90 <= south < north <= 90 and longitudes between -180 and 180")
+
+    # Whole minutes, so requests for the latest map share a cache entry
+    until = parse_map_time(query.get('until'), 'until') or timezone.now().replace(second=0, microsecond=0)
+    since = parse_map_time(query.get('since'), 'since') or until - timedelta(days=settings.DISEASE_MAP_DEFAULT_DAYS)
+    if since >= until:
+        raise ValueError("since must be before until")
+
+    precision = query.get('precision')
+    if precision is not None:
+        if not precision.isdigit() or not 1 <= int(precision) <= settings.UPLOAD_GEOHASH_PRECISION:
+            raise ValueError(f"precision must be between 1 and {settings.UPLOAD_GEOHASH_PRECISION}")
+        precision = int(precision)
+    return (south, west, north, east), since, until, precision
+
+def parse_map_time(value, name):
+    """Aware datetime from an ISO date (its midnight) or datetime, None if not given"""
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            parsed = datetime.combine(day, time.min) if day else None
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValueError(f"{name} must be an ISO date or datetime")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
 
 @login_required
 def delete_file(request, file_id):
     file = get_object_or_404(UploadedFile, id=file_id, farmer=request.user)
-    if file.file:
-        if os.path.exists(file.file.path):
-            os.remove(file.file.path)
-    file.delete()
+    # The image is only removed once no other upload uses it
+    delete_upload(file)
     messages.success(request, 'File deleted successfully!')
     return redirect('home')
 
+def monitoring_allowed(request):
+    """Staff users, or a scraper sending METRICS_TOKEN as a bearer token"""
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get('Authorization', '')
+    scraper = bool(token) and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+    return scraper or request.user.is_staff
+
+def model_status_view(request):
+    """
+    Report whether the ML model is loaded and how long loading took. Never triggers a load.
+    Paths, the registry and load errors are only shown to staff and the metrics scraper.
+    """
+    status = model_status()
+    if not monitoring_allowed(request):
+        return JsonResponse({'ready': status['status'] == 'ready'})
+    return JsonResponse(status)
+
+def metrics_view(request):
+    """
+    Metrics of every web and upload worker process in Prometheus text format. For
+    staff users, or a scraper sending METRICS_TOKEN as a bearer token.
+    """
+    if not monitoring_allowed(request):
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+
+    # Queue depth comes from the job table rather than any one process
+    waiting = [ProcessingJob.STATUS_QUEUED, ProcessingJob.STATUS_RUNNING]
+    jobs = dict(ProcessingJob.objects.filter(status__in=waiting).values_list('status').annotate(Count('id')).order_by())
+    job_gauges = [('upload_jobs', {'status': value}, jobs.get(value, 0)) for value in waiting]
+    return HttpResponse(render_prometheus(job_gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def logout_view(request):
     auth_logout(request)
     request.session.flush()  # Clear the session
@@ -230,224 +522,100 @@ def forecast(request):
         days (int, optional): Number of forecast days (default: 15, max: 16)
         units (str, optional): Temperature units ('fahrenheit' or 'celsius', default: 'fahrenheit')
     """
-    # Get query parameters
-    lat = request.GET.get('lat')
-    lon = request.GET.get('lon')
-    days = request.GET.get('days', '15')
-    units = request.GET.get('units', 'fahrenheit').lower()
+    try:
+        lat, lon, days, units = parse_forecast_query(request.GET)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
-    # Validate parameters
-    if not lat or not lon:
+    try:
+        response_data = get_forecast(lat, lon, days, units)
+    except Exception as e:
         return Response(
-            {"error": "Latitude and longitude parameters are required"}, 
-            status=status.HTTP_400_BAD_REQUEST
+            {"error": f"Error fetching weather data: {str(e)}"}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
     
+    # The ETag covers the forecast itself, not the "updated" time it was formatted at,
+    # so clients and proxies can revalidate instead of downloading it again
+    etag = forecast_etag(response_data)
+    if forecast_not_modified(request, etag):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(response_data)
+    return forecast_cache_headers(response, etag)
+
+@require_GET
+async def forecast_async(request):
+    """
+    forecast for ASGI, same parameters and responses (JSON only, no browsable API).
+    The forecast and the location name are fetched at the same time.
+    """
+    try:
+        lat, lon, days, units = parse_forecast_query(request.GET)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        response_data = await aget_forecast(lat, lon, days, units)
+    except Exception as e:
+        return JsonResponse(
+            {"error": f"Error fetching weather data: {str(e) or type(e).__name__}"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+    etag = forecast_etag(response_data)
+    if forecast_not_modified(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(response_data)
+    return forecast_cache_headers(response, etag)
+
+def parse_forecast_query(query):
+    """
+    Validated (lat, lon, days, units) from the forecast API's query parameters
+
+    Raises:
+        ValueError: with the message returned to the client
+    """
+    lat = query.get('lat')
+    lon = query.get('lon')
+    days = query.get('days', '15')
+    units = query.get('units', 'fahrenheit').lower()
+    
+    # Validate parameters
+    if not lat or not lon:
+        raise ValueError("Latitude and longitude parameters are required")
+    
     try:
         lat = float(lat)
         lon = float(lon)
         days = int(days)
     except ValueError:
-        return Response(
-            {"error": "Latitude and longitude must be valid numbers, and days must be an integer"}, 
-            status=status.HTTP_400_BAD_REQUEST
-        )
+        raise ValueError("Latitude and longitude must be valid numbers, and days must be an integer")
     
     # Validate days parameter
     if days < 1 or days > 16:
-        return Response(
-            {"error": "Days parameter must be between 1 and 16"}, 
-            status=status.HTTP_400_BAD_REQUEST
-        )
+        raise ValueError("Days parameter must be between 1 and 16")
     
     # Validate units parameter
     if units not in ['fahrenheit', 'celsius']:
-        return Response(
-            {"error": "Units parameter must be 'fahrenheit' or 'celsius'"}, 
-            status=status.HTTP_400_BAD_REQUEST
-        )
-    
-    try:
-        # Get the location name
-        location_name = get_location_name(lat, lon)
-        
-        # Get weather forecast data
-        forecast_data = get_simplified_forecast(lat, lon, days, units)
-        
-        # Build the response
-        response_data = {
-            "location": location_name,
-            "units": {
-                "temperature": units,
-                "precipitation": "inches" if units == "fahrenheit" else "mm"
-            },
-            "days": forecast_data,
-            "updated": datetime.now().strftime('%Y-%m-%d %H:%M')
-        }
-        
-        return Response(response_data)
-    
-    except Exception as e:
-        return Response(
-            {"error": f"Error fetching weather data: {str(e)}"}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        raise ValueError("Units parameter must be 'fahrenheit' or 'celsius'")
+    return lat, lon, days, units
 
-def get_location_name(lat, lon):
-    """Get location name using a free reverse geocoding service"""
-    try:
-        # Use Open-Meteo Geocoding API for reverse geocoding
-        url = f"https://geocoding-api.open-meteo.com/v1/search?latitude={lat}&longitude={lon}&count=1"
-        response = requests.get(url)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if 'results' in data and len(data['results']) > 0:
-                result = data['results'][0]
-                name = result.get('name', 'Unknown')
-                admin1 = result.get('admin1', '')
-                country = result.get('country', '')
-                
-                if admin1 and country:
-                    return f"{name}, {admin1}, {country}"
-                elif admin1:
-                    return f"{name}, {admin1}"
-                elif country:
-                    return f"{name}, {country}"
-                else:
-                    return name
-        
-        # Fallback to coordinates if geocoding fails
-        return f"Location at {lat:.4f}, {lon:.4f}"
-    
-    except Exception:
-        # If any error occurs, return a fallback location name
-        return f"Location at {lat:.4f}, {lon:.4f}"
+def forecast_cache_headers(response, etag):
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=settings.FORECAST_HTTP_MAX_AGE)
+    return response
 
-def get_simplified_forecast(lat, lon, days=15, units="fahrenheit"):
-    """Get simplified daily weather forecast"""
-    
-    # Open-Meteo API URL
-    url = "https://api.open-meteo.com/v1/forecast"
-    
-    # Set units based on temperature preference
-    temp_unit = units
-    precip_unit = "inch" if units == "fahrenheit" else "mm"
-    windspeed_unit = "mph" if units == "fahrenheit" else "kmh"
-    
-    # Parameters for the API request
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "temperature_unit": temp_unit,
-        "precipitation_unit": precip_unit,
-        "windspeed_unit": windspeed_unit,
-        "timezone": "auto",
-        "forecast_days": days,
-        "daily": [
-            "temperature_2m_max",
-            "temperature_2m_min",
-            "precipitation_sum",
-            "precipitation_probability_max",
-            "weathercode",
-            "sunrise",
-            "sunset"
-        ],
-        "hourly": [
-            "relative_humidity_2m"
-        ]
-    }
-    
-    # Make API request
-    response = requests.get(url, params=params)
-    response.raise_for_status()
-    data = response.json()
-    
-    # Format date in MM/DD/YYYY format (e.g. 4/4/2025)
-    def format_date(date_str):
-        try:
-            date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-            return date_obj.strftime("%-m/%-d/%Y")
-        except Exception:
-            return date_str
-    
-    # Process daily forecast data
-    daily_forecasts = []
-    if 'daily' in data and 'time' in data['daily']:
-        daily = data['daily']
-        for i, date_str in enumerate(daily['time']):
-            # Calculate average humidity for the day
-            avg_humidity = None
-            if 'hourly' in data and 'time' in data['hourly'] and 'relative_humidity_2m' in data['hourly']:
-                # Filter hourly data for this day
-                hourly_times = data['hourly']['time']
-                hourly_humidity = data['hourly']['relative_humidity_2m']
-                
-                day_humidity = []
-                for j, hourly_time in enumerate(hourly_times):
-                    if hourly_time.startswith(date_str) and j < len(hourly_humidity):
-                        if hourly_humidity[j] is not None:
-                            day_humidity.append(hourly_humidity[j])
-                
-                if day_humidity:
-                    avg_humidity = round(sum(day_humidity) / len(day_humidity))
-            
-            # Get weather description
-            weather_code = daily['weathercode'][i] if 'weathercode' in daily and i < len(daily['weathercode']) else None
-            weather_description = get_weather_description(weather_code)
-            
-            # Format data for this day
-            formatted_date = format_date(date_str)
-            day_data = {
-                "date": formatted_date,
-                "temp_high": daily['temperature_2m_max'][i] if 'temperature_2m_max' in daily and i < len(daily['temperature_2m_max']) else None,
-                "temp_low": daily['temperature_2m_min'][i] if 'temperature_2m_min' in daily and i < len(daily['temperature_2m_min']) else None,
-                "humidity": avg_humidity,
-                "precipitation": {
-                    "amount": daily['precipitation_sum'][i] if 'precipitation_sum' in daily and i < len(daily['precipitation_sum']) else 0,
-                    "chance": daily['precipitation_probability_max'][i] if 'precipitation_probability_max' in daily and i < len(daily['precipitation_probability_max']) else 0
-                },
-                "weather": weather_description
-            }
-            
-            daily_forecasts.append(day_data)
-    
-    return daily_forecasts
-
-def get_weather_description(code):
-    """Convert weather code to description"""
-    weather_codes = {
-        0: "Clear sky",
-        1: "Mainly clear",
-        2: "Partly cloudy",
-        3: "Overcast",
-        45: "Fog",
-        48: "Depositing rime fog",
-        51: "Light drizzle",
-        53: "Moderate drizzle",
-        55: "Dense drizzle",
-        56: "Light freezing drizzle",
-        57: "Dense freezing drizzle",
-        61: "Slight rain",
-        63: "Moderate rain",
-        65: "Heavy rain",
-        66: "Light freezing rain",
-        67: "Heavy freezing rain",
-        71: "Slight snow fall",
-        73: "Moderate snow fall",
-        75: "Heavy snow fall",
-        77: "Snow grains",
-        80: "Slight rain showers",
-        81: "Moderate rain showers",
-        82: "Violent rain showers",
-        85: "Slight snow showers",
-        86: "Heavy snow showers",
-        95: "Thunderstorm",
-        96: "Thunderstorm with slight hail",
-        99: "Thunderstorm with heavy hail"
-    }
-    
-    if code is None:
-        return "Unknown"
-    
-    return weather_codes.get(code, "Unknown")
+def forecast_not_modified(request, etag):
+    """Whether If-None-Match lists this ETag, compared weakly as RFC 9110 asks for"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or etag.removeprefix('W/') in {tag.removeprefix('W/') for tag in etags}
+
+def forecast_etag(forecast_data):
+    payload = {key: value for key, value in forecast_data.items() if key != 'updated'}
+    digest = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    return f'W/"{digest}"'